@@ -0,0 +1,114 @@
+import os
+import sys
+import math
+import time
+import multiprocessing
+from fractions import Fraction
+import numpy as np
+import soundfile
+from config import config_to_dict, config_from_dict
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".ogg", ".mp3")
+
+# Decode an audio file to mono float32. WAV/FLAC/OGG are read straight into a float32 buffer with soundfile,
+# anything it can't open (i.e. mp3) goes through librosa/audioread instead.
+def read_audio(filename):
+    try:
+        data, sample_rate = soundfile.read(filename, dtype='float32')
+    except RuntimeError:
+        import librosa
+        return librosa.load(filename, sr=None, mono=True)
+    if data.ndim > 1:
+        data = np.mean(data, axis=1, dtype=np.float32)
+    return data, sample_rate
+
+# Number of samples the file will have once it's loaded and resampled to target_rate, without decoding it.
+# Returns None for files soundfile can't open.
+def get_length(filename, target_rate):
+    try:
+        info = soundfile.info(filename)
+    except RuntimeError:
+        return None
+    if info.samplerate == target_rate:
+        return info.frames
+    # Both resamplers round the length up
+    return int(math.ceil(info.frames * target_rate / info.samplerate))
+
+# Polyphase resampling is a lot faster than librosa's default kaiser_best and good enough for what we need.
+# Set resampler to kaiser_best in the config to get the old behaviour back.
+def resample(data, sample_rate, target_rate, resampler="polyphase"):
+    if sample_rate == target_rate:
+        return data
+    if resampler == "polyphase":
+        from scipy.signal import resample_poly
+        ratio = Fraction(target_rate, sample_rate)
+        return resample_poly(data, ratio.numerator, ratio.denominator).astype(np.float32, copy=False)
+    import librosa
+    return librosa.resample(data, sample_rate, target_rate, res_type=resampler)
+
+# Runs in a worker process - converts one file to the configured sample rate and writes it as a mono 16-bit wav
+def normalize_file(task):
+    source, destination, config_values = task
+    config = config_from_dict(config_values)
+    data, sample_rate = read_audio(source)
+    data = resample(data, sample_rate, config.getint("song", "sample_size"), config.get("song", "resampler"))
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    soundfile.write(destination + ".partial", np.clip(data, -1, 1), config.getint("song", "sample_size"), subtype="PCM_16", format="WAV")
+    os.replace(destination + ".partial", destination)
+    return os.path.getsize(source)
+
+# Convert every audio file in a directory tree to the configured sample rate in mono, so that loading them later
+# doesn't need any resampling. The directory structure is kept, files that already exist in the output are skipped.
+def normalize_corpus(logger, config, source, destination):
+    if not os.path.isdir(source):
+        logger.critical("Folder %s does not exist!", source)
+        sys.exit(8)
+    tasks = []
+    config_values = config_to_dict(config)
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for file in sorted(filter(lambda f: f.lower().endswith(AUDIO_EXTENSIONS), files)):
+            output = os.path.join(destination, os.path.relpath(root, source), os.path.splitext(file)[0] + ".wav")
+            if os.path.isfile(output):
+                continue
+            tasks.append((os.path.join(root, file), output, config_values))
+    workers = config.getint("dataset", "workers")
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    logger.info("Converting %i files on %i processes...", len(tasks), workers)
+    started = time.time()
+    total_size = 0
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        for number, size in enumerate(pool.imap_unordered(normalize_file, tasks)):
+            total_size += size
+            elapsed = max(time.time() - started, 1e-6)
+            logger.info("Converted %i/%i files (%.2f files/s, %.1f MB/s).", number + 1, len(tasks), (number + 1) / elapsed, total_size / elapsed / (1024 * 1024))
+
+# AudioWriter: Writes a mono wav file a block at a time. The file is written under a temporary name and only
+# renamed once it's complete, so a crash never leaves a half-written output behind.
+class AudioWriter:
+    def __init__(self, filename, sample_rate, subtype="PCM_16"):
+        self.filename = filename
+        self.file = soundfile.SoundFile(filename + ".partial", 'w', sample_rate, 1, subtype=subtype, format="WAV")
+
+    def write(self, data):
+        if len(data) > 0:
+            self.file.write(np.clip(data, -1, 1))
+
+    def close(self):
+        self.file.close()
+        os.replace(self.filename + ".partial", self.filename)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.filename + ".partial")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, *args):
+        if exception_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
@@ -0,0 +1,184 @@
+import os
+import sys
+import csv
+import time
+import queue
+import logging
+import threading
+import collections
+import multiprocessing
+from song import Song
+from cache import FeatureCache
+from mask import get_masks
+from stream import SpectrogramWriter
+from profiling import profiler
+from audio import AUDIO_EXTENSIONS
+from config import config_to_dict, config_from_dict
+
+# Runs in a worker process - loads a song and computes its stft so that the main process only has to run the network
+def prepare_song(name, filename, config_values):
+    started = time.time()
+    config = config_from_dict(config_values)
+    song = Song(logging, name, config)
+    song.load_features(filename, FeatureCache(logging, config) if config.getboolean("cache", "enabled") else None, keep_spectrogram=True)
+    return song.get_amplitude(), song.get_spectrogram(), song.get_length(), time.time() - started
+
+# BatchSeparator: Separates a whole catalog of songs with a single loaded model.
+# Songs are decoded by a pool of worker processes ahead of time and the outputs are written by a background thread,
+# so the network is kept busy as long as the workers can keep up with it.
+class BatchSeparator:
+    def __init__(self, logger, config, model, output_folder, save_accompaniment=True):
+        self.logger=logger
+        self.config=config
+        self.model=model
+        self.output_folder=output_folder
+        self.save_accompaniment=save_accompaniment
+        self.workers=config.getint("separate", "workers")
+        self.timings=[]
+        self.failed=0
+        self.failed_lock=threading.Lock() # Failures are counted by both the main thread and the writer thread
+
+    # Accepts either a directory (every audio file in it is separated) or a manifest with one file per line.
+    # Songs stored as song/mixture.wav are named after their directory, other files after their path. Directories with
+    # a mixture file are dataset songs, so only the mixture is separated and not the stems next to it.
+    def find_tracks(self, source):
+        files = []
+        if os.path.isdir(source):
+            for root, dirs, names in os.walk(source):
+                dirs.sort()
+                names = list(filter(lambda f: f.lower().endswith(AUDIO_EXTENSIONS), names))
+                mixtures = [name for name in names if os.path.splitext(name)[0].lower() == "mixture"]
+                for name in sorted(mixtures if len(mixtures) > 0 else names):
+                    files.append((source, os.path.join(root, name)))
+        elif os.path.isfile(source):
+            base = os.path.dirname(os.path.abspath(source))
+            with open(source, 'r') as f:
+                for line in filter(None, map(str.strip, f)):
+                    files.append((base, line if os.path.isabs(line) else os.path.join(base, line)))
+        else:
+            self.logger.critical("%s is neither a directory nor a manifest file!", source)
+            sys.exit(18)
+        # A manifest can list the same file more than once
+        files = list(collections.OrderedDict.fromkeys((base, os.path.normpath(filename)) for base, filename in files))
+        tracks = []
+        for base, filename in files:
+            relative = os.path.relpath(filename, base)
+            stem, _ = os.path.splitext(relative)
+            name = os.path.dirname(relative) if os.path.basename(stem).lower() == "mixture" else stem
+            tracks.append((name, relative, filename))
+        # Files that would get the same name (like song.mp3 next to song.wav) keep their extension, otherwise the
+        # second one would be skipped as already separated or overwrite the outputs of the first
+        names = collections.Counter(name for name, _, _ in tracks)
+        for name in sorted(name for name, count in names.items() if count > 1):
+            self.logger.warning("%i files would be named %s, their outputs are named after the whole file name instead.", names[name], name)
+        return [(name if names[name] == 1 else relative, filename) for name, relative, filename in tracks]
+
+    def get_outputs(self, name):
+        folder = os.path.join(self.output_folder, name)
+        return os.path.join(folder, "estimated_vocals.wav"), (os.path.join(folder, "estimated_accompaniment.wav") if self.save_accompaniment is True else None)
+
+    def is_done(self, name):
+        return all(path is None or os.path.isfile(path) for path in self.get_outputs(name))
+
+    def run(self, source):
+        tracks = self.find_tracks(source)
+        pending = [track for track in tracks if not self.is_done(track[0])]
+        self.logger.info("Found %i songs, %i of them have already been separated.", len(tracks), len(tracks) - len(pending))
+        if len(pending) == 0:
+            return
+        config_values = config_to_dict(self.config)
+        writer_queue = queue.Queue(maxsize=max(self.workers, 1))
+        writer = threading.Thread(target=self.write_outputs, args=(writer_queue,), daemon=True)
+        writer.start()
+        started = time.time()
+        # Spawn instead of fork so the workers don't inherit the state of tensorflow
+        with multiprocessing.get_context("spawn").Pool(max(self.workers, 1)) as pool:
+            # Only keep a few songs in flight, otherwise the workers would fill the memory with spectrograms faster than we can use them
+            in_flight = collections.deque()
+            tracks = iter(pending)
+            for name, filename in tracks:
+                in_flight.append((name, filename, pool.apply_async(prepare_song, (name, filename, config_values))))
+                if len(in_flight) >= self.workers * 2:
+                    break
+            while len(in_flight) > 0:
+                name, filename, result = in_flight.popleft()
+                for next_name, next_filename in tracks:
+                    in_flight.append((next_name, next_filename, pool.apply_async(prepare_song, (next_name, next_filename, config_values))))
+                    break
+                self.separate(name, filename, result, writer_queue)
+        writer_queue.put(None)
+        writer.join()
+        self.logger.info("Separated %i songs in %.1fs, %i failed.", len(self.timings), time.time() - started, self.failed)
+        self.save_timings()
+
+    def separate(self, name, filename, result, writer_queue):
+        try:
+            amplitude, spectrogram, length, load_time = result.get()
+        except Exception as e:
+            self.logger.error("Could not load %s: %s", filename, e)
+            with self.failed_lock:
+                self.failed += 1
+            return
+        song = Song(self.logger, name, self.config)
+        song.set_amplitude(amplitude)
+        song.set_spectrogram(spectrogram)
+        song.set_length(length)
+        predict_started = time.time()
+        prediction = self.model.predict(song)
+        with profiler.stage("mask"):
+            vocals, accompaniment = get_masks(self.logger, prediction, self.config.get("separate", "mask_type"), self.config.getfloat("separate", "mask_threshold"), self.save_accompaniment)
+        writer_queue.put((song, vocals, accompaniment, load_time, time.time() - predict_started))
+
+    # Runs in a background thread - applies the masks, reverses the stft and writes the results
+    def write_outputs(self, writer_queue):
+        while True:
+            item = writer_queue.get()
+            if item is None:
+                break
+            song, vocals, accompaniment, load_time, predict_time = item
+            started = time.time()
+            try:
+                vocals_path, accompaniment_path = self.get_outputs(song.get_name())
+                os.makedirs(os.path.dirname(vocals_path), exist_ok=True)
+                spectrogram = song.get_spectrogram()
+                for mask, path in ((accompaniment, accompaniment_path), (vocals, vocals_path)):
+                    if mask is None:
+                        continue
+                    if self.config.getboolean("separate", "streaming") is True:
+                        self.write_streaming(spectrogram, mask, path, song.get_length())
+                        continue
+                    song.set_spectrogram(spectrogram)
+                    song.apply_binary_mask(mask)
+                    song.reverse_stft()
+                    song.save_file(path + ".partial")
+                    os.replace(path + ".partial", path)
+            except Exception as e:
+                self.logger.error("Could not write the outputs of %s: %s", song.get_name(), e)
+                with self.failed_lock:
+                    self.failed += 1
+                continue
+            write_time = time.time() - started
+            self.logger.info("%s: load %.2fs, predict %.2fs, write %.2fs.", song.get_name(), load_time, predict_time, write_time)
+            self.timings.append((song.get_name(), load_time, predict_time, write_time))
+
+    # Inverts the masked spectrogram a chunk at a time, so the masked copy of the whole spectrogram is never made
+    def write_streaming(self, spectrogram, mask, path, length):
+        writer = SpectrogramWriter(self.config, path, length)
+        try:
+            chunk_size = max(self.config.getint("separate", "chunk_size"), 1)
+            for start in range(0, spectrogram.shape[1], chunk_size):
+                writer.write(spectrogram[:, start : start + chunk_size] * mask[:, start : start + chunk_size])
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+
+    def save_timings(self):
+        os.makedirs(self.output_folder, exist_ok=True)
+        filename = os.path.join(self.output_folder, "timings.csv")
+        exists = os.path.isfile(filename)
+        with open(filename, 'a') as f:
+            w = csv.writer(f)
+            if not exists:
+                w.writerow(("name", "load", "predict", "write"))
+            w.writerows(self.timings)
@@ -0,0 +1,187 @@
+# Benchmarks for the separate stages of preprocessing, training and separation.
+# Uses synthetic audio so that no dataset is needed, which also makes the results comparable between machines and runs.
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import librosa
+from config import prepare_config
+
+# Generates a song with a "vocal" track (a vibrato tone that comes and goes) and an "accompaniment" (chords and noise)
+def generate_song(seed, duration, sample_rate):
+    random = np.random.RandomState(seed)
+    time_axis = np.arange(int(duration * sample_rate)) / sample_rate
+    pitch = random.uniform(180, 400) * (1 + 0.02 * np.sin(2 * np.pi * 5 * time_axis))
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    vocals = sum(np.sin(phase * harmonic) / harmonic for harmonic in range(1, 6))
+    vocals *= np.repeat(random.rand(int(duration) + 1) > 0.4, sample_rate)[:len(time_axis)]
+    accompaniment = sum(np.sin(2 * np.pi * frequency * time_axis) for frequency in random.uniform(80, 1000, 4))
+    accompaniment += 0.3 * random.randn(len(time_axis))
+    vocals = (0.3 * vocals / np.max(np.abs(vocals) + 1e-9)).astype(np.float32)
+    accompaniment = (0.3 * accompaniment / np.max(np.abs(accompaniment))).astype(np.float32)
+    return vocals + accompaniment, vocals
+
+def get_peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 if sys.platform != "darwin" else peak / (1024 * 1024)
+
+# Benchmark: Times each stage a few times and keeps the fastest run
+class Benchmark:
+    def __init__(self, logger, config, repeat=3):
+        self.logger=logger
+        self.config=config
+        self.repeat=repeat
+        self.results={}
+
+    def time(self, name, function, repeat=None, **extra):
+        timings = []
+        for _ in range(0, repeat if repeat is not None else self.repeat):
+            started = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started)
+        self.results[name] = dict(seconds=min(timings), peak_rss_mb=get_peak_rss(), **extra)
+        self.logger.info("%s: %.4fs (peak RSS %.1f MB)", name, min(timings), self.results[name]["peak_rss_mb"])
+
+    def run(self, folder, songs, duration, sample_rate, model_stages=True):
+        from song import Song
+        from dataset import Dataset
+        data_folder = os.path.join(folder, "data")
+        for number in range(0, songs):
+            mixture, vocals = generate_song(number, duration, sample_rate)
+            os.makedirs(os.path.join(data_folder, "song%i" % number), exist_ok=True)
+            librosa.output.write_wav(os.path.join(data_folder, "song%i" % number, "mixture.wav"), mixture, sample_rate)
+            librosa.output.write_wav(os.path.join(data_folder, "song%i" % number, "vocals.wav"), vocals, sample_rate)
+        mixture_path = os.path.join(data_folder, "song0", "mixture.wav")
+        length = self.config.getint("song", "sample_length")
+
+        song = Song(self.logger, "benchmark", self.config)
+        self.time("load_file", lambda: song.load_file(mixture_path), audio_seconds=duration)
+        data = song.get_raw_data()
+        def compute_stft():
+            song.data = data
+            song.compute_stft(keep_spectrogram=True)
+        self.time("compute_stft", compute_stft)
+        self.results["compute_stft"]["frames"] = song.get_amplitude().shape[1]
+        # The windows are views, the copy the consumers make is what costs time
+        self.time("split_spectrogram", lambda: np.ascontiguousarray(song.split_spectrogram(length)))
+        self.time("split_slidingwindow", lambda: np.ascontiguousarray(song.split_slidingwindow(length)))
+        self.time("get_labels", lambda: song.get_labels(length))
+
+        def load_dataset():
+            dataset = Dataset(self.logger, self.config)
+            dataset.load(data_folder)
+            return dataset
+        self.time("dataset_load", load_dataset, repeat=1, songs=songs)
+        datasets = [load_dataset() for _ in range(0, self.repeat)]
+        self.time("get_data_for_cnn", lambda: datasets.pop().get_data_for_cnn())
+        if not model_stages:
+            return
+        from model import Model
+        dataset = load_dataset()
+        dataset.get_data_for_cnn()
+        dataset.get_labels_for_cnn()
+        model = Model(self.logger, self.config, dataset, dataset)
+        model.build()
+        batch = 32
+        steps = int(np.ceil(len(dataset.mixture_windows) / batch))
+        self.time("train_epoch", lambda: model.train(1, batch), repeat=1, steps=steps)
+        self.results["train_epoch"]["steps_per_second"] = steps / self.results["train_epoch"]["seconds"]
+        # Lets the effect of settings like the dtype on the accuracy be compared between runs
+        loss, accuracy = model.model.evaluate(dataset.mixture_windows, dataset.labels, batch_size=batch, verbose=0)
+        self.results["train_epoch"]["loss"] = float(loss)
+        self.results["train_epoch"]["accuracy"] = float(accuracy)
+
+        def isolate():
+            mixture = Song(self.logger, "benchmark", self.config)
+            mixture.load_file(mixture_path)
+            mixture.compute_stft(keep_spectrogram=True)
+            model.isolate(mixture, "vocals.wav", save_accompaniment=True) # Written to the temporary directory
+        self.time("isolate", isolate, repeat=1)
+        self.results["isolate"]["seconds_per_audio_minute"] = self.results["isolate"]["seconds"] / (duration / 60)
+
+        # The convolutional engine is only worth using if its output is close enough to the sliding one's. The SDR of the
+        # vocals each engine separates shows how much of the difference is audible.
+        mixture = Song(self.logger, "benchmark", self.config)
+        mixture.load_file(mixture_path)
+        mixture.compute_stft(keep_spectrogram=True)
+        vocals = Song(self.logger, "benchmark", self.config)
+        vocals.load_file(os.path.join(data_folder, "song0", "vocals.wav"))
+        for engine in ("sliding", "convolutional"):
+            self.time("predict_" + engine, lambda: model.predict(mixture, engine=engine), repeat=1)
+        self.results["predict_convolutional"].update(model.compare_engines(mixture, vocals=vocals.get_raw_data()))
+        self.logger.info("Convolutional engine: %.1fx faster, probabilities differ by %.4f at most (%.4f on average), %.2f%% of the mask changes, vocal SDR %.2f dB (%+.2f dB).", self.results["predict_sliding"]["seconds"] / self.results["predict_convolutional"]["seconds"],
+            self.results["predict_convolutional"]["max_abs_diff"], self.results["predict_convolutional"]["mean_abs_diff"], self.results["predict_convolutional"]["mask_bins_changed"] * 100,
+            self.results["predict_convolutional"]["sdr_convolutional"], self.results["predict_convolutional"]["sdr_delta"])
+
+    # Time how long main.py takes to start for modes that shouldn't need tensorflow. The evaluation directory doesn't
+    # exist, so the script exits right after it has started, which is the part that is being measured.
+    def run_startup(self, folder):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        for name, arguments in (("startup_help", ["--help"]), ("startup_evaluate", ["--mode=evaluate", "--evaluationdir=" + os.path.join(folder, "missing")]), ("startup_cache_purge", ["--mode=cache-purge"])):
+            self.time(name, lambda: subprocess.run([sys.executable, script] + arguments, cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    # Compare with the results of an earlier run. Stages that got slower than the tolerance allows are returned.
+    def compare(self, baseline, tolerance):
+        regressions = []
+        for name, result in sorted(self.results.items()):
+            if name not in baseline:
+                continue
+            ratio = result["seconds"] / max(baseline[name]["seconds"], 1e-9)
+            self.logger.info("%s: %.4fs vs %.4fs (%+.1f%%)", name, result["seconds"], baseline[name]["seconds"], (ratio - 1) * 100)
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+        return regressions
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+    parser = argparse.ArgumentParser(description="Benchmarks for the preprocessing, training and separation stages")
+    parser.add_argument("--output", default="benchmark.json", type=str, help="File to which the results will be written to. Default is benchmark.json.")
+    parser.add_argument("--baseline", default="", type=str, help="Results of an earlier run to compare with. Exits with an error if a stage got slower than the tolerance allows.")
+    parser.add_argument("--tolerance", default=0.2, type=float, help="How much slower (as a fraction) a stage can get before it's considered a regression. Default is 0.2.")
+    parser.add_argument("--songs", default=4, type=int, help="Number of synthetic songs to generate. Default is 4.")
+    parser.add_argument("--duration", default=30, type=float, help="Length of each synthetic song in seconds. Default is 30.")
+    parser.add_argument("--sample_rate", default=44100, type=int, help="Sample rate of the synthetic songs. Default is 44100, which means that they have to be resampled.")
+    parser.add_argument("--repeat", default=3, type=int, help="How many times each stage is run. The fastest run is kept. Default is 3.")
+    parser.add_argument("--dtype", default="float32", type=str, help="Precision in which the amplitudes are stored (float32/float16). Default is float32.")
+    parser.add_argument("--skip_model", default="false", type=str, help="If set to true, the training and separation stages (which need tensorflow) are skipped.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        # Always benchmark with the default settings and without the feature cache, so runs stay comparable
+        config = prepare_config(os.path.join(folder, "config.ini"))
+        config.set("cache", "enabled", "false")
+        config.set("dataset", "workers", "1")
+        config.set("song", "dtype", args.dtype)
+        benchmark = Benchmark(logging, config, args.repeat)
+        benchmark.run_startup(folder)
+        working_directory = os.getcwd()
+        os.chdir(folder)
+        try:
+            benchmark.run(folder, args.songs, args.duration, args.sample_rate, args.skip_model.lower() not in ("yes", "true", "y", "t", "1"))
+        finally:
+            os.chdir(working_directory)
+
+    results = {
+        "machine": {"platform": platform.platform(), "processor": platform.processor(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "settings": {"songs": args.songs, "duration": args.duration, "sample_rate": args.sample_rate, "repeat": args.repeat, "dtype": args.dtype},
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "stages": benchmark.results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    logging.info("Results saved to %s.", args.output)
+    if args.baseline != "":
+        with open(args.baseline, 'r') as f:
+            regressions = benchmark.compare(json.load(f)["stages"], args.tolerance)
+        if len(regressions) > 0:
+            logging.critical("Regressions found in: %s", ", ".join(regressions))
+            sys.exit(1)
+        logging.info("No regressions found.")
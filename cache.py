@@ -0,0 +1,156 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+def hash_file(filename):
+    file_hash = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+# FeatureCache: Stores computed amplitudes (and optionally spectrograms) on disk so that we don't have to decode,
+# resample and STFT the same audio files on every run. Entries are keyed on the contents of the audio file and
+# the song settings that affect the STFT, so changing the config or the file invalidates the entry automatically.
+# The decoded audio can be kept as well, so that trying other STFT settings doesn't mean decoding every file again.
+class FeatureCache:
+    def __init__(self, logger, config):
+        self.logger=logger
+        self.config=config
+        self.folder=config.get("cache", "directory")
+        self.max_size=config.getint("cache", "max_size") * 1024 * 1024 # Config value is in megabytes
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+
+    # The key is the hash of the audio file and the parameters used to compute the features from it.
+    def get_key(self, filename, file_hash=None):
+        parameters = "%i-%i-%i-%s-%s" % (self.config.getint("song", "sample_size"), self.config.getint("song", "window_size"), self.config.getint("song", "hop_length"), self.config.get("song", "resampler"), self.config.get("song", "dtype"))
+        return (file_hash if file_hash is not None else self.get_file_hash(filename)) + "-" + parameters
+
+    # Decoded audio only depends on the sample rate and the resampler, so it can be shared between different stft settings
+    def get_audio_key(self, filename, file_hash=None):
+        parameters = "%i-%s" % (self.config.getint("song", "sample_size"), self.config.get("song", "resampler"))
+        return (file_hash if file_hash is not None else self.get_file_hash(filename)) + "-" + parameters
+
+    # Hashing every file of a big dataset takes about as long as loading its features from the cache, so the hash of
+    # each file is kept along with its size and modification time and only computed again when either of them changes,
+    # the same way build_shards decides whether a song has changed.
+    def get_file_hash(self, filename):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        record_path = os.path.join(self.folder, hashlib.sha1(path.encode()).hexdigest() + "-hash.json")
+        try:
+            with open(record_path, 'r') as f:
+                record = json.load(f)
+            if record["path"] == path and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime_ns:
+                return record["hash"]
+        except (IOError, ValueError, KeyError):
+            pass
+        # The file is stat'ed before it's hashed, so a change while hashing shows up as a different time next time
+        file_hash = hash_file(path)
+        temporary = record_path + ".%i.tmp" % os.getpid()
+        with open(temporary, 'w') as f:
+            json.dump({"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": file_hash}, f)
+        os.replace(temporary, record_path)
+        return file_hash
+
+    # Returns the decoded and resampled samples or None if they aren't cached
+    def get_audio(self, key):
+        path = self.get_path(key, "audio")
+        if not os.path.isfile(path):
+            return None
+        try:
+            data = np.load(path)
+        except (IOError, ValueError):
+            self.logger.warning("Cache entry %s is corrupted, ignoring it.", key)
+            os.remove(path)
+            return None
+        os.utime(path, None)
+        return data
+
+    def put_audio(self, key, data):
+        self.write_array(self.get_path(key, "audio"), data)
+        self.evict()
+
+    def get_path(self, key, kind):
+        return os.path.join(self.folder, key + "-" + kind + ".npy")
+
+    # Returns (amplitude, spectrogram) or None if the entry (or the requested spectrogram) isn't cached.
+    # With mmap the amplitude is memory mapped instead of being read into RAM.
+    def get(self, key, keep_spectrogram=False, mmap=False):
+        amplitude_path = self.get_path(key, "amplitude")
+        spectrogram_path = self.get_path(key, "spectrogram")
+        if not os.path.isfile(amplitude_path) or (keep_spectrogram is True and not os.path.isfile(spectrogram_path)):
+            self.logger.debug("Cache miss for %s.", key)
+            return None
+        try:
+            amplitude = np.load(amplitude_path, mmap_mode='r' if mmap is True else None)
+            spectrogram = np.load(spectrogram_path) if keep_spectrogram is True else None
+        except (IOError, ValueError):
+            self.logger.warning("Cache entry %s is corrupted, ignoring it.", key)
+            self.remove(key)
+            return None
+        # Mark the entry as recently used so that eviction keeps it around
+        os.utime(amplitude_path, None)
+        if keep_spectrogram is True:
+            os.utime(spectrogram_path, None)
+        self.logger.debug("Cache hit for %s.", key)
+        return amplitude, spectrogram
+
+    def put(self, key, amplitude, spectrogram=None):
+        self.write_array(self.get_path(key, "amplitude"), amplitude)
+        if spectrogram is not None:
+            self.write_array(self.get_path(key, "spectrogram"), spectrogram)
+        self.evict()
+
+    # Write to a temporary file first so that a crash (or another process) never sees a half-written entry
+    def write_array(self, path, array):
+        temporary = path + ".%i.tmp" % os.getpid()
+        with open(temporary, 'wb') as f:
+            np.save(f, array)
+        os.replace(temporary, path)
+
+    def remove(self, key):
+        for kind in ("amplitude", "spectrogram", "audio"):
+            path = self.get_path(key, kind)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def get_entries(self):
+        entries = []
+        for file in filter(lambda f: f.endswith(".npy"), os.listdir(self.folder)):
+            path = os.path.join(self.folder, file)
+            try:
+                stat = os.stat(path)
+            except OSError: # Removed by someone else in the meantime
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    # Remove the least recently used files until the cache fits in the configured size
+    def evict(self):
+        entries = self.get_entries()
+        size = sum(entry[1] for entry in entries)
+        if size <= self.max_size:
+            return
+        for _, file_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            self.logger.debug("Evicting %s from the cache.", path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= file_size
+
+    def purge(self):
+        entries = self.get_entries()
+        self.logger.info("Removing %i files from the cache.", len(entries))
+        for _, _, path in entries:
+            os.remove(path)
+        for file in filter(lambda f: f.endswith("-hash.json"), os.listdir(self.folder)):
+            os.remove(os.path.join(self.folder, file))
+
+    def get_size(self):
+        return sum(entry[1] for entry in self.get_entries())
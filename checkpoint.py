@@ -0,0 +1,69 @@
+# Checkpoints that contain everything needed to continue training where it stopped - the weights together with the
+# state of the optimizer (model.save stores both), the epoch and step counters, the state of the random number
+# generators and a reference to the dataset that was used, so that it can be checked that the same data is used again.
+import os
+import json
+import random
+import numpy as np
+
+# Checkpoint: A <filename>.h5 file with the model and the optimizer state and a <filename>.json file with the rest.
+# keras is only imported when a checkpoint is loaded, the callback that saves them during training is in model.py.
+class Checkpoint:
+    def __init__(self, logger, config, filename=None):
+        self.logger=logger
+        self.config=config
+        self.filename=filename if filename is not None else config.get("checkpoint", "filename")
+
+    def exists(self):
+        return os.path.isfile(self.filename + ".h5") and os.path.isfile(self.filename + ".json")
+
+    # Both files are written to temporary files first, so that being interrupted while saving leaves the old checkpoint intact
+    # settings are anything else the way the training continues depends on, which is checked when it's loaded
+    def save(self, model, epoch, step, dataset=None, sequence=None, random_state=None, settings=None):
+        model.save(self.filename + ".h5.tmp", overwrite=True, include_optimizer=True)
+        numpy_random, python_random = random_state if random_state is not None else (np.random.get_state(), random.getstate())
+        state = {
+            "epoch": epoch,
+            "step": step,
+            "numpy_random": encode_random_state(numpy_random),
+            "python_random": [python_random[0], list(python_random[1]), python_random[2]],
+            "sequence_seed": sequence.seed if sequence is not None else None,
+            "dataset": dataset.get_reference() if dataset is not None else None,
+            "settings": settings
+        }
+        with open(self.filename + ".json.tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(self.filename + ".h5.tmp", self.filename + ".h5")
+        os.replace(self.filename + ".json.tmp", self.filename + ".json")
+
+    # Returns the model with its optimizer state and the saved state. The random number generators are restored as well,
+    # so that the data is shuffled the same way it would have been had training not been interrupted. The order of a
+    # WindowSequence only depends on its seed and the epoch, so passing sequence_seed to it is enough.
+    def load(self, dataset=None, settings=None):
+        with open(self.filename + ".json", 'r') as f:
+            state = json.load(f)
+        model = self.load_model(self.filename + ".h5")
+        np.random.set_state(decode_random_state(state["numpy_random"]))
+        random.setstate((state["python_random"][0], tuple(state["python_random"][1]), state["python_random"][2]))
+        if dataset is not None and state["dataset"] is not None and state["dataset"] != dataset.get_reference():
+            self.logger.warning("The training data has changed since the checkpoint was saved.")
+        if settings is not None and state.get("settings") != settings:
+            self.logger.warning("The checkpoint was saved with different settings (%s, now %s), so training won't continue the same way.", state.get("settings"), settings)
+        self.logger.info("Loaded the checkpoint from epoch %i (step %i).", state["epoch"], state["step"])
+        return model, state
+
+    def load_model(self, filename):
+        import keras
+        return keras.models.load_model(filename)
+
+    def remove(self):
+        for extension in (".h5", ".json"):
+            if os.path.isfile(self.filename + extension):
+                os.remove(self.filename + extension)
+
+# numpy's random state contains an array, which json can't store directly
+def encode_random_state(state):
+    return [state[0], state[1].tolist()] + list(state[2:])
+
+def decode_random_state(state):
+    return (state[0], np.array(state[1], dtype=np.uint32)) + tuple(state[2:])
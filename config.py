@@ -1,8 +1,12 @@
+import os
 import configparser
 
-def prepare_config(filename):
+# Reads the config and fills in the defaults of missing options. With write the file is updated with them, tools that
+# only read the config pass write=False so that they never change it.
+def prepare_config(filename, write=True):
     config = configparser.ConfigParser()
     config.read(filename)
+    values = config_to_dict(config)
 
     # Set defaults
     config_get(config, 'logging', 'logfile', 'log.txt')
@@ -10,15 +14,92 @@ def prepare_config(filename):
     config_get(config, 'logging', 'logtype', 'console') #file/console
 
     config_get(config, 'song', 'sample_size', "22050") #Sample rate of the audio we will work with. If loaded audio doesn't match, it will be resampled.
+    config_get(config, 'song', 'resampler', "polyphase") #polyphase/kaiser_best/kaiser_fast. Polyphase is the fastest, kaiser_best is what librosa uses by default.
     config_get(config, 'song', 'window_size', "1024") #We will get window size / 2 + 1 frequency bins to work with. 1024-1568 seems to be the perfect vales.
     config_get(config, 'song', 'hop_length', "256") #Size of each bin = hop size / sample size (in ms). The smaller it is, the more bins we get, but we don't need that much resolution.
+    config_get(config, 'song', 'dtype', "float32") #float32/float16. Precision in which amplitudes are stored. float16 halves the memory used by the dataset and rounds the amplitudes by at most 1/32 dB (tests/test_precision.py), labels are always stored as uint8 and spectrograms as complex64.
     config_get(config, 'song', 'sample_length', "25") #Dictates how many frequency bins we give to the neural net for context. Less samples means more guesswork from the network, but also more samples from each song.
+    config_get(config, 'song', 'label_threshold', "1") #Bins of the vocal track louder than this (in dB) are labelled as vocals. Also used by the scripts in misc that create reference masks.
 
     config_get(config, 'model', 'save_history', "true") #Saves keras accuracy and loss history per epoch
     config_get(config, 'model', 'history_filename', "history.csv")
 
-    with open(filename, 'w') as configfile: # If the file didn't exist, write default values to it
-        config.write(configfile)
+    config_get(config, 'checkpoint', 'filename', "checkpoint") #Training state is saved to <filename>.h5 (weights and optimizer) and <filename>.json (epoch, step, random state and dataset) after every epoch. Continue from it with --resume=true.
+    config_get(config, 'checkpoint', 'steps', "0") #Also save a checkpoint every this many batches. Resuming from one of these repeats the rest of its epoch. 0 only saves at the end of each epoch.
+
+    config_get(config, 'separate', 'chunk_size', "512") #How many frames are passed to the network at once when separating. Lower values use less memory. 0 processes the whole song at once.
+    config_get(config, 'separate', 'backend', "keras") #keras/tflite. tflite separates with the model exported with --mode=export, which doesn't need keras and is faster on CPUs.
+    config_get(config, 'separate', 'workers', "2") #Number of processes that decode songs and compute their stft ahead of time in separate-batch mode.
+    config_get(config, 'separate', 'mask_type', "binary") #binary/soft. Binary masks assign each bin either to the vocals or to the accompaniment, soft masks split the bin according to the predicted probability.
+    config_get(config, 'separate', 'mask_threshold', "0.45") #Probability above which a bin is considered to be vocals when using binary masks. Higher values tend to make voice unintelligible.
+    config_get(config, 'separate', 'streaming', "false") #Invert the masked spectrogram and write the outputs a chunk at a time while the network is still running, instead of all at once at the end. Uses less memory, but the outputs aren't normalized to full volume like they are otherwise, so they are quieter.
+    config_get(config, 'separate', 'output_subtype', "PCM_16") #PCM_16/PCM_24/FLOAT. Format of the wav files written when streaming is enabled.
+
+    config_get(config, 'export', 'filename', "network.tflite") #File the model is exported to with --mode=export and loaded from when the backend is tflite
+    config_get(config, 'export', 'quantization', "weights") #none/weights/float16. weights stores the weights as int8, float16 as float16 (needs a newer tensorflow).
+    config_get(config, 'export', 'evaluation_directory', "") #Directory with songs (mixture.wav, vocals.wav and accompaniment.wav in a directory per song) used to compare the exported model with the original. Leave empty to skip the comparison.
+    config_get(config, 'export', 'report', "export_quality.json") #The metrics of both models and the difference between them are written here
+
+    config_get(config, 'server', 'host', "127.0.0.1")
+    config_get(config, 'server', 'port', "8080")
+    config_get(config, 'server', 'socket', "") #Path to a unix socket to listen on instead of host:port. Leave empty to use TCP.
+    config_get(config, 'server', 'max_requests', "4") #How many requests are processed at the same time. Others wait in the queue.
+    config_get(config, 'server', 'queue_size', "16") #How many requests can wait for processing before new ones are rejected.
+    config_get(config, 'server', 'max_batch', "512") #Maximum number of windows from concurrent requests that are passed to the network at once.
+    config_get(config, 'server', 'max_wait', "10") #How long (in ms) to wait for windows from other requests before running the network.
+
+    config_get(config, 'realtime', 'input', "stdin") #stdin/tcp. Where the realtime mode reads 16-bit mono PCM at sample_size from. The output goes to stdout or back to the TCP connection.
+    config_get(config, 'realtime', 'host', "127.0.0.1")
+    config_get(config, 'realtime', 'port', "8081")
+    config_get(config, 'realtime', 'block_size', "512") #Number of samples read at a time
+    config_get(config, 'realtime', 'lookahead', "4") #How many frames after the current one the network waits for (up to sample_length / 2). Each frame adds hop_length samples of latency, missing frames are zeros like at the end of a song.
+    config_get(config, 'realtime', 'stem', "accompaniment") #vocals/accompaniment
+    config_get(config, 'realtime', 'batch', "32")
+
+    config_get(config, 'dataset', 'storage', "memory") #memory/shards/sampler. Shards keep the training data on disk and only load the batches that are being used, which is slower but lets you train on datasets that don't fit in RAM. The sampler draws a new set of windows from whole songs every epoch (see the sampler section).
+    config_get(config, 'dataset', 'shard_directory', "shards")
+    config_get(config, 'dataset', 'workers', "0") #Number of processes that load songs and compute their stft in parallel. 0 uses all cores.
+
+    config_get(config, 'sampler', 'epoch_size', "20000") #Number of windows drawn for each epoch with storage = sampler, no matter how many songs there are
+    config_get(config, 'sampler', 'samples_per_song', "500") #Maximum number of windows drawn from a single song in an epoch, so that long songs don't take over. 0 for no limit.
+    config_get(config, 'sampler', 'strata', "0.01,0.1,0.3") #Windows are grouped by the fraction of vocal bins in their labelled frame at these boundaries, and every group gets the same share of the epoch. Without it most windows would have (almost) no vocals.
+
+    config_get(config, 'distributed', 'workers', "0") #Number of processes that train copies of the network in train-distributed mode. 0 uses all cores.
+    config_get(config, 'distributed', 'sync_steps', "20") #How many batches each worker trains on before the weights of all workers are averaged. Lower values keep the copies closer together but spend more time synchronizing.
+    config_get(config, 'distributed', 'checkpoint', "distributed") #The averaged weights are saved to <checkpoint>.h5 and the training state to <checkpoint>.json after every epoch. Continue from it with --resume=true.
+    config_get(config, 'distributed', 'seed', "0") #Seed for shuffling the windows. The epoch is added to it, so resumed runs go through the windows in the same order.
+
+    config_get(config, 'sweep', 'parameters', "song.window_size=1024,1536; song.sample_length=25,51") #Settings tried by --mode=sweep, as section.option=value,value,... separated by semicolons
+    config_get(config, 'sweep', 'search', "grid") #grid/random. Grid tries every combination of the values, random tries a random subset of them.
+    config_get(config, 'sweep', 'trials', "8") #Number of combinations tried by random search
+    config_get(config, 'sweep', 'seed', "0") #Seed for picking the combinations in random search
+    config_get(config, 'sweep', 'workers', "2") #Number of trials trained at the same time. Each of them loads its own copy of the dataset.
+    config_get(config, 'sweep', 'epochs', "1") #How many epochs each trial is trained for
+    config_get(config, 'sweep', 'directory', "sweep") #Each trial writes its weights, history and log to trial_<number> in this directory
+    config_get(config, 'sweep', 'evaluation_directory', "") #Directory with songs (mixture.wav, vocals.wav and accompaniment.wav in a directory per song) each trial is evaluated on. Leave empty to only measure the training time.
+    config_get(config, 'sweep', 'results', "results") #The table of all trials is written to <results>.csv and <results>.json in the sweep directory
+
+    config_get(config, 'evaluation', 'workers', "0") #Number of songs evaluated in parallel. 0 uses all cores.
+    config_get(config, 'evaluation', 'window', "0") #Length (in seconds) of the windows for framewise metrics. 0 evaluates each song as a whole.
+    config_get(config, 'evaluation', 'hop', "1") #Hop (in seconds) between the windows for framewise metrics.
+    config_get(config, 'evaluation', 'cache_directory', "cache/evaluation") #Metrics of songs whose files haven't changed are loaded from here.
+    config_get(config, 'evaluation', 'results', "results") #Metrics are written to <results>.csv and a summary to <results>.json.
+
+    config_get(config, 'profiling', 'enabled', "false") #Record the wall time, CPU time and memory usage of each stage (decode, resample, stft, windowing, predict, mask, istft, write). Can also be enabled with --profile.
+    config_get(config, 'profiling', 'output', "profile") #Stages are written to <output>.jsonl or <output>.json, cProfile stats to <output>.prof
+    config_get(config, 'profiling', 'format', "jsonl") #jsonl/chrome. Chrome traces can be opened in chrome://tracing.
+    config_get(config, 'profiling', 'cprofile', "false") #Also run cProfile for the whole script. Slows everything down.
+    config_get(config, 'profiling', 'tracemalloc', "false") #Also track python memory allocations of each stage. Slows everything down.
+
+    config_get(config, 'cache', 'enabled', "true") #Cache the amplitudes and spectrograms of loaded files on disk so that they don't have to be recomputed on the next run
+    config_get(config, 'cache', 'directory', "cache")
+    config_get(config, 'cache', 'audio', "false") #Also cache the decoded and resampled audio, so that changing the stft settings doesn't mean decoding everything again. Takes about 5 MB per minute of audio.
+    config_get(config, 'cache', 'max_size', "8192") #Maximum size of the cache in megabytes. Least recently used entries are removed first.
+
+    # Only written if the file didn't exist or some of the options were missing from it
+    if write is True and (not os.path.isfile(filename) or config_to_dict(config) != values):
+        with open(filename, 'w') as configfile:
+            config.write(configfile)
     return config
 
 def config_get(config, section, key, default):
@@ -29,3 +110,12 @@ def config_get(config, section, key, default):
         config.set(section, key, default)
     except configparser.NoOptionError:
         config.set(section, key, default)
+
+# ConfigParser objects don't survive being sent to other processes, so they're passed around as dictionaries instead
+def config_to_dict(config):
+    return {section: dict(config.items(section)) for section in config.sections()}
+
+def config_from_dict(values):
+    config = configparser.ConfigParser()
+    config.read_dict(values)
+    return config
@@ -1,9 +1,29 @@
 import os
 import sys
+import time
 import logging
+import multiprocessing
 from song import Song
+from cache import FeatureCache, hash_file
+from shards import ShardStore
+from sampler import WindowSampler
+from profiling import profiler
+from config import config_to_dict, config_from_dict
 import numpy as np
 
+# Runs in a worker process - computes the amplitudes of the mixture and the vocals of a song.
+# Only the amplitudes are sent back to keep the amount of data passed between processes down.
+def load_song(task):
+    name, mixture_path, vocals_path, config_values = task
+    config = config_from_dict(config_values)
+    cache = FeatureCache(logging, config) if config.getboolean("cache", "enabled") else None
+    amplitudes = []
+    for path in (mixture_path, vocals_path):
+        song = Song(logging, name, config)
+        song.load_features(path, cache)
+        amplitudes.append(song.get_amplitude())
+    return amplitudes
+
 # Dataset: Loads and passes test data to the model
 class Dataset:
     def __init__(self, logger, config):
@@ -15,31 +35,173 @@ class Dataset:
         # Outputs for CNN
         self.mixture_windows = []
         self.labels = []
+        # On-disk storage for the outputs when the dataset is too big to fit in RAM
+        self.store = None
+        # Draws the windows of each epoch from whole songs instead
+        self.sampler = None
+        self.folder = None
+        self.cache = FeatureCache(logger, config) if config.getboolean("cache", "enabled") else None
 
     # Load mixture and vocals and generates STFT for them
     def load(self, folder):
-        if os.path.isdir(folder):
-            for root, dirs, files in os.walk(folder):
-                for file in filter(lambda f: f.endswith(".wav"), files):
-                    self.logger.info("Loading song %s and computing stft for it.", os.path.join(root, file))
-                    song_type = os.path.splitext(file)[0].lower()
-                    if song_type == "mixture" or song_type == "vocals":
-                        song = Song(self.logger, os.path.basename(root), self.config)
-                        song.load_file(os.path.join(root,file))
-                        song.compute_stft()
-                        if(song_type == "mixture"):
-                            self.mixtures.append(song)
-                        elif(song_type == "vocals"):
-                            self.vocals.append(song)
-                        self.logger.debug("%s loaded successfully.", song_type)
-                    else:
-                        self.logger.debug("File %s is not named correctly. Ignoring...", song_type)
-        else:
+        self.folder = folder
+        songs = self.find_songs(folder)
+        for name, mixture, vocals in self.load_songs(songs):
+            self.mixtures.append(mixture)
+            self.vocals.append(vocals)
+
+    # Computes the amplitudes of the given songs on a pool of worker processes and yields the mixture and vocals of
+    # each of them in the same order as the songs were given, so that they stay paired.
+    def load_songs(self, songs):
+        workers = self.config.getint("dataset", "workers")
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(songs))
+        config_values = config_to_dict(self.config)
+        tasks = [(name, mixture_path, vocals_path, config_values) for name, mixture_path, vocals_path in songs]
+        total_size = 0
+        started = time.time()
+        pool = multiprocessing.get_context("spawn").Pool(workers) if workers > 1 else None
+        try:
+            results = pool.imap(load_song, tasks) if pool is not None else map(load_song, tasks)
+            for number, ((name, mixture_path, vocals_path), amplitudes) in enumerate(zip(songs, results)):
+                total_size += os.path.getsize(mixture_path) + os.path.getsize(vocals_path)
+                elapsed = max(time.time() - started, 1e-6)
+                self.logger.info("Loaded song %s (%i/%i, %.2f songs/s, %.1f MB/s).", name, number + 1, len(songs), (number + 1) / elapsed, total_size / elapsed / (1024 * 1024))
+                mixture = Song(self.logger, name, self.config)
+                mixture.set_amplitude(amplitudes[0])
+                vocals = Song(self.logger, name, self.config)
+                vocals.set_amplitude(amplitudes[1])
+                yield name, mixture, vocals
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    # Find all song folders that contain both a mixture and a vocal track
+    def find_songs(self, folder):
+        if not os.path.isdir(folder):
             self.logger.critical("Folder %s does not exist!", folder)
             sys.exit(8)
-        if (len(self.mixtures) != len(self.vocals)):
-            self.logger.critical("There doesn't appear to be a vocal track for each mixture (or the other way around).")
-            sys.exit(15)
+        songs = []
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            tracks = {}
+            for file in filter(lambda f: f.endswith(".wav"), files):
+                tracks[os.path.splitext(file)[0].lower()] = os.path.join(root, file)
+            if "mixture" in tracks and "vocals" in tracks:
+                # Songs are named after their path in the dataset, so that songs with the same name in different folders don't get mixed up
+                name = os.path.relpath(root, folder) if root != folder else os.path.basename(os.path.abspath(folder))
+                songs.append((name, tracks["mixture"], tracks["vocals"]))
+            elif "mixture" in tracks or "vocals" in tracks:
+                self.logger.critical("There doesn't appear to be a vocal track for each mixture (or the other way around) in %s.", root)
+                sys.exit(15)
+        return songs
+
+    # Everything that changes the contents of the shards
+    def get_shard_settings(self):
+        return {key: self.config.get("song", key) for key in ("sample_size", "window_size", "hop_length", "sample_length", "resampler", "dtype", "label_threshold")}
+
+    def get_file_info(self, path):
+        stat = os.stat(path)
+        return {"path": os.path.abspath(path), "mtime": stat.st_mtime, "size": stat.st_size, "hash": None}
+
+    # A file is unchanged if it has the same path, size and modification time. If only the time changed, the contents are compared.
+    def is_unchanged(self, old, new):
+        if old is None or old["path"] != new["path"] or old["size"] != new["size"]:
+            return False
+        if old["mtime"] == new["mtime"]:
+            return True
+        if old["hash"] is None:
+            return False
+        new["hash"] = hash_file(new["path"])
+        return old["hash"] == new["hash"]
+
+    # Identifies the data the dataset was loaded from, which is stored in training checkpoints
+    def get_reference(self):
+        reference = {
+            "folder": os.path.abspath(self.folder) if self.folder is not None else None,
+            "shards": os.path.abspath(self.store.folder) if self.store is not None else None,
+            "samples": len(self.store) if self.store is not None else len(self.sampler) if self.sampler is not None else len(self.mixture_windows),
+            "settings": self.get_shard_settings()
+        }
+        # The windows drawn by the sampler also depend on its settings
+        if self.sampler is not None:
+            reference["sampler"] = dict(self.config.items("sampler"))
+        return reference
+
+    # Keep the amplitudes of whole songs for the sampler. Songs that are already in the feature cache are memory mapped
+    # from it, so they take no memory and don't have to be loaded again. The rest are computed and kept in RAM.
+    def load_sampler(self, folder):
+        self.folder = folder
+        songs = self.find_songs(folder)
+        amplitudes = {}
+        pending = []
+        for name, mixture_path, vocals_path in songs:
+            entries = [self.cache.get(self.cache.get_key(path), mmap=True) for path in (mixture_path, vocals_path)] if self.cache is not None else [None]
+            if None in entries:
+                pending.append((name, mixture_path, vocals_path))
+            else:
+                amplitudes[name] = [amplitude for amplitude, _ in entries]
+        self.logger.info("%i of %i songs are memory mapped from the cache.", len(songs) - len(pending), len(songs))
+        for name, mixture, vocals in self.load_songs(pending):
+            amplitudes[name] = [mixture.get_amplitude(), vocals.get_amplitude()]
+        # Songs are added in the same order every time, so that the windows drawn with a seed don't depend on what was cached
+        self.sampler = WindowSampler(self.logger, self.config)
+        for name, _, _ in songs:
+            self.sampler.add(name, *amplitudes[name])
+        if len(self.sampler.names) == 0:
+            self.logger.critical("No mixtures for training found. Did you name them wrong?")
+            sys.exit(9)
+        self.logger.info("%s contains %i windows from %i songs.", folder, len(self.sampler), len(self.sampler.names))
+        self.sampler.log_strata()
+
+    # Generate CNN inputs and labels one song at a time and write them to memory mapped shards instead of keeping them in RAM.
+    # Only songs that are new or have changed since the last run are processed, shards of songs that are gone are removed.
+    def build_shards(self, folder, shard_folder):
+        length = self.config.getint("song", "sample_length")
+        self.folder = folder
+        self.store = ShardStore(self.logger, shard_folder)
+        settings = self.get_shard_settings()
+        if self.store.settings != settings:
+            if len(self.store.shards) > 0:
+                self.logger.info("Song settings have changed since the shards in %s were generated, generating them again.", shard_folder)
+            self.store.clear()
+            self.store.set_settings(settings)
+        songs = self.find_songs(folder)
+        if len(songs) == 0:
+            self.logger.critical("No mixtures for training found. Did you name them wrong?")
+            sys.exit(9)
+        names = set(name for name, _, _ in songs)
+        for name in set(shard["name"] for shard in self.store.shards) - names:
+            self.logger.info("Song %s was removed, removing its shard.", name)
+            self.store.remove(name)
+        pending = []
+        files = {}
+        for name, mixture_path, vocals_path in songs:
+            files[name] = {"mixture": self.get_file_info(mixture_path), "vocals": self.get_file_info(vocals_path)}
+            shard = self.store.get_shard_info(name)
+            if shard is not None and all(self.is_unchanged(shard["files"].get(track), files[name][track]) for track in ("mixture", "vocals")):
+                for track in ("mixture", "vocals"):
+                    shard["files"][track]["mtime"] = files[name][track]["mtime"]
+                continue
+            if shard is not None:
+                self.logger.info("Song %s has changed, generating its shard again.", name)
+                self.store.remove(name)
+            pending.append((name, mixture_path, vocals_path))
+        self.store.save_index()
+        self.logger.info("%i of %i songs are new or have changed.", len(pending), len(songs))
+        for name, mixture, vocals in self.load_songs(pending):
+            with profiler.stage("windowing"):
+                windows = mixture.split_spectrogram(length)
+                labels = vocals.get_labels(length)
+            if len(windows) == 0:
+                # Still gets an (empty) shard, so that it isn't processed again on the next run
+                self.logger.warning("Song %s is too short, skipping it.", name)
+            for track in ("mixture", "vocals"):
+                if files[name][track]["hash"] is None:
+                    files[name][track]["hash"] = hash_file(files[name][track]["path"])
+            self.store.write(name, windows.reshape(windows.shape + (1,)), labels, files[name])
+        self.logger.info("%s contains %i windows.", shard_folder, len(self.store))
 
     def get_data_for_cnn(self):
         length = self.config.getint("song", "sample_length")
@@ -48,17 +210,16 @@ class Dataset:
             self.logger.critical("No mixtures for training found. Did you name them wrong?")
             sys.exit(9)
         self.logger.debug("Preparing %i songs...", len(self.mixtures))
-        amplitudes = None
+        amplitudes = []
         for num in range(0, len(self.mixtures)):
-            if amplitudes is None:
-                amplitudes = self.mixtures[0].split_spectrogram(length)
-            else:
-                amplitudes = np.vstack((amplitudes, self.mixtures[0].split_spectrogram(length)))
+            with profiler.stage("windowing"):
+                amplitudes.append(self.mixtures[0].split_spectrogram(length))
             del self.mixtures[0]
+        amplitudes = np.concatenate(amplitudes)
         self.logger.debug("Got %i slices. Each slice has %i frequency bins, and each frequency bin has %i time slices.", len(amplitudes), len(amplitudes[0]), len(amplitudes[0][0]))
         self.logger.debug("Adding a 4th dimension to placate the CNN model...")
         # Add a dimension to make the CNN accept the data. Signifies that we have a greyscale "picture"
-        amplitudes = np.array(amplitudes).reshape(len(amplitudes), len(amplitudes[0]), len(amplitudes[0][0]), 1)
+        amplitudes = amplitudes.reshape(amplitudes.shape + (1,))
         self.mixture_windows = amplitudes
 
     def get_labels_for_cnn(self):
@@ -70,7 +231,8 @@ class Dataset:
         self.logger.debug("Preparing %i songs...", len(self.vocals))
         labels = []
         for num in range(0, len(self.vocals)):
-            labels.extend(self.vocals[0].get_labels(length))
+            with profiler.stage("windowing"):
+                labels.append(self.vocals[0].get_labels(length))
             del self.vocals[0]
-        self.logger.debug("Got %i slices.", len(labels))
-        self.labels = np.array(labels)
+        self.labels = np.concatenate(labels)
+        self.logger.debug("Got %i slices.", len(self.labels))
@@ -0,0 +1,202 @@
+# Data-parallel training: every worker process holds a copy of the network and trains it on its own part of the
+# windows in the ShardStore. After a fixed number of batches the weights of all workers are averaged and sent back to
+# them, so the workers never drift too far apart. Only local processes are supported.
+import os
+import sys
+import time
+import logging
+import tempfile
+import multiprocessing
+import numpy as np
+from config import config_to_dict, config_from_dict
+from checkpoint import Checkpoint
+
+# State of a worker process - set up once by the pool initializer and kept between rounds
+worker = {}
+
+def init_worker(config_values, folder, threads, buffer_filename):
+    import tensorflow as tf
+    import keras
+    from model import Model
+    from shards import ShardStore
+    # Without this every worker would try to use all of the cores
+    keras.backend.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)))
+    config = config_from_dict(config_values)
+    worker["model"] = Model(logging, config)
+    worker["model"].build()
+    worker["store"] = ShardStore(logging, folder)
+    worker["buffer"] = WeightBuffer(buffer_filename)
+
+# The weights of the network followed by the state of its optimizer. The variables of the optimizer are only created
+# along with the training function, so it's made first.
+def get_state(model):
+    model._make_train_function()
+    return model.get_weights() + model.optimizer.get_weights()
+
+def set_state(model, state):
+    model._make_train_function()
+    layers = len(model.weights)
+    model.set_weights(state[:layers])
+    model.optimizer.set_weights(state[layers:])
+
+# WeightBuffer: The flattened state of the network in a memory mapped file that the master and the workers share, so
+# that the weights aren't pickled and sent through the pipes of the pool every round. Row 0 holds the averaged state
+# and row n the state of the worker that trained the n-th part of the round.
+class WeightBuffer:
+    def __init__(self, filename, state=None, rows=None):
+        if state is not None:
+            self.data = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(rows, sum(layer.size for layer in state)))
+        else:
+            self.data = np.load(filename, mmap_mode='r+')
+
+    # Returns the state in a row, split into arrays of the given shapes
+    def read(self, row, shapes):
+        state = []
+        offset = 0
+        for shape in shapes:
+            size = int(np.prod(shape))
+            state.append(self.data[row, offset : offset + size].reshape(shape))
+            offset += size
+        return state
+
+    def write(self, row, state):
+        offset = 0
+        for layer in state:
+            self.data[row, offset : offset + layer.size] = np.ravel(layer)
+            offset += layer.size
+
+    # Writes the mean of the given rows, weighted by counts, to row 0
+    def average(self, rows, counts):
+        total = sum(counts)
+        self.data[0] = sum(self.data[row] * (count / total) for row, count in zip(rows, counts))
+
+# Runs in a worker process - trains a copy of the network on the given windows, starting from the averaged state, and
+# writes the state it ends up with to its row of the buffer
+def train_round(task):
+    row, indices, batch = task
+    model = worker["model"].model
+    buffer = worker["buffer"]
+    if "shapes" not in worker:
+        worker["shapes"] = [np.shape(layer) for layer in get_state(model)]
+    set_state(model, buffer.read(0, worker["shapes"]))
+    losses = []
+    for start in range(0, len(indices), batch):
+        # Sorting the indices inside a batch keeps the reads from each shard sequential
+        windows, labels = worker["store"].get(np.sort(indices[start : start + batch]))
+        losses.append(model.train_on_batch(windows, labels))
+    buffer.write(row, get_state(model))
+    return row, len(indices), np.mean(losses, axis=0) if len(losses) > 0 else None
+
+# DistributedTrainer: Splits every epoch into rounds. In each round every worker gets sync_steps batches of the
+# shuffled windows, after which their weights and the state of their optimizers are averaged (weighted by the number
+# of windows each of them trained on). The model is only updated with the average at the end of each epoch.
+# initializer sets up the model and the shards in each worker process.
+class DistributedTrainer:
+    def __init__(self, logger, config, model, dataset, validation_data=None, initializer=init_worker):
+        self.logger=logger
+        self.config=config
+        self.model=model
+        self.dataset=dataset
+        self.validation_data=validation_data
+        self.initializer=initializer
+        self.sync_steps=config.getint("distributed", "sync_steps")
+        self.checkpoint=Checkpoint(logger, config, config.get("distributed", "checkpoint"))
+        self.seed=config.getint("distributed", "seed")
+        self.buffer=None
+        self.shapes=None
+
+    def get_workers(self):
+        workers = self.config.getint("distributed", "workers")
+        return workers if workers > 0 else multiprocessing.cpu_count()
+
+    # Starts the workers along with a buffer that holds the current state of the model. It's kept in /dev/shm where
+    # available, so that exchanging the weights never touches the disk.
+    def start_pool(self, workers, folder):
+        state = get_state(self.model.model)
+        filename = os.path.join(folder, "weights.npy")
+        self.shapes = [np.shape(layer) for layer in state]
+        self.buffer = WeightBuffer(filename, state, workers + 1)
+        self.buffer.write(0, state)
+        threads = max(multiprocessing.cpu_count() // workers, 1)
+        return multiprocessing.get_context("spawn").Pool(workers, self.initializer, (config_to_dict(self.config), self.dataset.store.folder, threads, filename))
+
+    def get_buffer_folder(self):
+        return tempfile.TemporaryDirectory(dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+    # Copies the averaged state from the buffer to the model
+    def update_model(self):
+        set_state(self.model.model, [np.array(layer) for layer in self.buffer.read(0, self.shapes)])
+
+    # Trains for one epoch (or only the first rounds of it) and returns the number of windows that were used
+    def run_epoch(self, pool, workers, epoch, batch, rounds=None):
+        # Seeding with the epoch makes a resumed run see the same order as an uninterrupted one
+        order = np.random.RandomState(self.seed + epoch).permutation(len(self.dataset.store))
+        step = self.sync_steps * batch
+        windows = 0
+        losses = []
+        for number, start in enumerate(range(0, len(order), step * workers)):
+            if rounds is not None and number >= rounds:
+                break
+            tasks = []
+            for offset in range(start, min(start + step * workers, len(order)), step):
+                tasks.append((len(tasks) + 1, order[offset : offset + step], batch))
+            results = pool.map(train_round, tasks, chunksize=1)
+            self.buffer.average([row for row, _, _ in results], [count for _, count, _ in results])
+            windows += sum(count for _, count, _ in results)
+            losses.extend(result for _, _, result in results if result is not None)
+        return windows, np.mean(losses, axis=0) if len(losses) > 0 else None
+
+    # The order of the windows depends on these as well as on the epoch
+    def get_settings(self, workers):
+        return {"workers": workers, "sync_steps": self.sync_steps, "seed": self.seed}
+
+    # Continues from the checkpoint with resume, the same way --resume does for normal training. The checkpoint
+    # is only saved at the end of an epoch, so the epoch is all that's needed to continue in the same order. The
+    # averaged optimizer state is saved with the weights, so the workers continue with it as well.
+    def train(self, epochs, batch=32, resume=False):
+        if self.dataset.store is None:
+            self.logger.critical("Distributed training needs the dataset to be stored in shards.")
+            sys.exit(19)
+        workers = self.get_workers()
+        first_epoch = 0
+        if resume is True and self.checkpoint.exists():
+            self.model.model, state = self.checkpoint.load(self.dataset, self.get_settings(workers))
+            first_epoch = state["epoch"]
+            if first_epoch >= epochs:
+                self.logger.info("The checkpoint is already at epoch %i, increase --epochs to continue training.", first_epoch)
+                return
+        elif resume is True:
+            self.logger.warning("No checkpoint found, starting from the beginning.")
+        self.logger.info("Training on %i samples with %i workers, averaging the weights every %i batches...", len(self.dataset.store), workers, self.sync_steps)
+        with self.get_buffer_folder() as folder, self.start_pool(workers, folder) as pool:
+            for epoch in range(first_epoch, epochs):
+                started = time.time()
+                windows, loss = self.run_epoch(pool, workers, epoch, batch)
+                elapsed = time.time() - started
+                self.logger.info("Epoch %i/%i: %.1f samples/s, loss %s.", epoch + 1, epochs, windows / elapsed, loss)
+                self.update_model()
+                if self.validation_data is not None and self.validation_data.store is not None:
+                    from model import WindowSequence
+                    validation = self.model.model.evaluate_generator(WindowSequence(self.validation_data.store, batch, shuffle=False))
+                    self.logger.info("Validation loss and accuracy: %s.", validation)
+                self.checkpoint.save(self.model.model, epoch + 1, 0, self.dataset, settings=self.get_settings(workers))
+        self.buffer = None
+
+    # Trains for a few rounds with 1, 2, 4... workers and reports how close the throughput gets to perfect scaling.
+    # The rounds only change the buffer, so the model is left as it was and this can be run on a real model.
+    def measure_scaling(self, batch=32, rounds=3, max_workers=None):
+        max_workers = max_workers if max_workers is not None else self.get_workers()
+        counts = sorted(set([2 ** power for power in range(0, int(np.log2(max_workers)) + 1)] + [max_workers]))
+        results = []
+        for workers in counts:
+            with self.get_buffer_folder() as folder, self.start_pool(workers, folder) as pool:
+                # The first round builds the models in the workers, so it isn't timed
+                self.run_epoch(pool, workers, 0, batch, rounds=1)
+                started = time.time()
+                windows, _ = self.run_epoch(pool, workers, 1, batch, rounds=rounds)
+                throughput = windows / (time.time() - started)
+            efficiency = throughput / (workers * results[0]["throughput"]) if len(results) > 0 else 1.0
+            results.append({"workers": workers, "throughput": throughput, "speedup": throughput / (results[0]["throughput"] if len(results) > 0 else throughput), "efficiency": efficiency})
+            self.logger.info("%i workers: %.1f samples/s, scaling efficiency %.0f%%.", workers, throughput, efficiency * 100)
+        self.buffer = None
+        return results
@@ -1,96 +1,221 @@
 # Evaluate the accuracy of the neural network by calculating SDR (distortion)
 # SIR (interference from other sources) and SAR (artifacts)
 import numpy as np
-import museval
 import os
 import sys
+import csv
+import json
+import shutil
+import tempfile
+import hashlib
+import logging
+import multiprocessing
 from song import Song
+from cache import FeatureCache, hash_file
+from config import config_to_dict, config_from_dict
+
+SONG_TYPES = ("vocals", "accompaniment", "estimated_vocals", "estimated_accompaniment")
+
+# Load the four tracks of a song and return the original and estimated sources in the format museval expects.
+# Only one song is loaded at a time, so the memory used doesn't depend on the size of the evaluation set.
+def load_song(logger, config, name, paths):
+    data = {}
+    for song_type in SONG_TYPES:
+        logger.info("Loading song %s.", paths[song_type])
+        song = Song(logger, name, config)
+        song.load_file(paths[song_type])
+        data[song_type] = np.expand_dims(song.get_raw_data(), 1)
+    # Outputs written without knowing the length of the original (and the ones from older versions) can be slightly shorter,
+    # so we cut off the part that we can't compare. Simply padding WOULD be a better idea, but we can't assume that the
+    # last few miliseconds have nothing going on in them.
+    if np.shape(data["vocals"])[0] > np.shape(data["estimated_vocals"])[0]:
+        logger.debug("Reshaping arrays for %s...", name)
+        length = np.shape(data["estimated_vocals"])[0]
+        data["vocals"] = data["vocals"][:length]
+        data["accompaniment"] = data["accompaniment"][:length]
+    return np.stack((data["vocals"], data["accompaniment"])), np.stack((data["estimated_vocals"], data["estimated_accompaniment"]))
+
+# museval is only imported once it's needed, so songs with cached metrics never have to load it
+def calculate_song_metrics(original_data, estimated_data, window, hop):
+    import museval
+    museval.metrics.validate(original_data, estimated_data)
+    sdr, _, sir, sar, _ = museval.metrics.bss_eval(original_data, estimated_data, window=window, hop=hop)
+    return sdr, sir, sar
+
+# Runs in a worker process - loads a single song and calculates its metrics
+def evaluate_song(task):
+    name, paths, config_values, window, hop = task
+    original_data, estimated_data = load_song(logging, config_from_dict(config_values), name, paths)
+    return calculate_song_metrics(original_data, estimated_data, window, hop)
 
 class Evaluator:
     def __init__(self, logger, config):
         self.logger=logger
         self.config=config
-        self.vocals=None
-        self.accompaniments=None
-        self.estimated_vocals=None
-        self.estimated_accompaniments=None
         self.names=None
+        self.paths=None
+        self.cache_folder=config.get("evaluation", "cache_directory")
 
-    def load_data(self, folder):
-        self.vocals=[]
-        self.accompaniments=[]
-        self.estimated_vocals=[]
-        self.estimated_accompaniments=[]
+    # Find the songs to evaluate. Nothing is loaded yet, each song is read from the disk when it's evaluated.
+    # The paths are kept in a list next to the names, since songs in different folders can have the same name.
+    def find_songs(self, folder):
+        self.names=[]
+        self.paths=[]
         if os.path.isdir(folder):
-            for root, firs, files in os.walk(folder):
+            for root, dirs, files in os.walk(folder):
+                dirs.sort()
+                tracks = {}
                 for file in filter(lambda f: f.endswith(".wav"), files):
-                    song_type = os.path.splitext(file)[0].lower()
-                    self.logger.info("Loading song %s.", os.path.join(root, file))
-                    if song_type == "vocals" or song_type == "accompaniment" or song_type == "estimated_vocals" or song_type == "estimated_accompaniment":
-                        song = Song(self.logger, os.path.basename(root), self.config)
-                        song.load_file(os.path.join(root,file))
-                        if(song_type == "vocals"):
-                            self.vocals.append(song)
-                        elif(song_type == "accompaniment"):
-                            self.accompaniments.append(song)
-                        elif(song_type == "estimated_vocals"):
-                            self.estimated_vocals.append(song)
-                        elif(song_type == "estimated_accompaniment"):
-                            self.estimated_accompaniments.append(song)
-                        self.logger.debug("%s loaded successfully.", song_type)
+                    song_type = os.path.splitext(file)[0].lower().replace("-", "_")
+                    if song_type in SONG_TYPES:
+                        tracks[song_type] = os.path.join(root, file)
                     else:
                         self.logger.debug("File %s is not named correctly. Ignoring...", song_type)
+                if len(tracks) == 0:
+                    continue
+                if len(tracks) != len(SONG_TYPES):
+                    self.logger.critical("Song %s doesn't have all of the required files. Did you misname a file?", root)
+                    sys.exit(14)
+                name = os.path.basename(root)
+                self.names.append(name)
+                self.paths.append(tracks)
         else:
             self.logger.critical("Folder %s does not exist!", folder)
             sys.exit(13)
-        if (len(self.vocals) != len(self.accompaniments)) or (len(self.accompaniments) != len(self.estimated_vocals)) or (len(self.estimated_vocals) != len(self.estimated_accompaniments)):
-            self.logger.critical("Array size mismatch. Did you misname a file?")
-            sys.exit(14)
+        if len(self.names) == 0:
+            self.logger.critical("No songs with vocals, accompaniment, estimated_vocals and estimated_accompaniment found in %s.", folder)
+            sys.exit(13)
+        self.logger.info("Found %i songs to evaluate.", len(self.names))
+
+    # Yields the original and estimated sources of one song at a time
+    def iter_songs(self, elements):
+        for element in elements:
+            original_data, estimated_data = load_song(self.logger, self.config, self.names[element], self.paths[element])
+            yield self.names[element], original_data, estimated_data
 
-    # Extracts data from the dataset and sets the correct dimensions
-    def prepare_data(self):
-        self.names = []
-        for element in range(0, len(self.vocals)):
-            self.logger.debug("Processing %s...", self.vocals[element].get_name())
-            self.names.append(self.vocals[element].get_name())
-            self.vocals[element] = np.expand_dims(self.vocals[element].get_raw_data(), 1)
-            self.accompaniments[element] = np.expand_dims(self.accompaniments[element].get_raw_data(), 1)
-            self.estimated_vocals[element] = np.expand_dims(self.estimated_vocals[element].get_raw_data(), 1)
-            self.estimated_accompaniments[element] = np.expand_dims(self.estimated_accompaniments[element].get_raw_data(), 1)
-        self.vocals = np.array(self.vocals)
-        self.accompaniments = np.array(self.accompaniments)
-        self.estimated_vocals = np.array(self.estimated_vocals)
-        self.estimated_accompaniments = np.array(self.estimated_accompaniments)
-        # Since the neural net outputs slightly less data than in the original, we will cut off the part that we can't compare
-        # Simply padding WOULD be a better idea, but we can't assume that the last few miliseconds have nothing going on in them.
-        for element in range(0, len(self.vocals)):
-            if np.shape(self.vocals[element])[0] > np.shape(self.estimated_vocals[element])[0]:
-                self.logger.debug("Reshaping arrays for %s...", self.names[element])
-                difference = np.shape(self.vocals[element])[0] - np.shape(self.estimated_vocals[element])[0]
-                self.vocals[element] = self.vocals[element,:-difference,:]
-                self.accompaniments[element] = self.accompaniments[element,:-difference,:]
+    # The window and hop are set in seconds in the config, 0 means that the whole song is evaluated at once
+    def get_window(self):
+        sample_size = self.config.getint("song", "sample_size")
+        window = self.config.getfloat("evaluation", "window")
+        if window <= 0:
+            return np.inf, 0
+        return int(window * sample_size), int(self.config.getfloat("evaluation", "hop") * sample_size)
+
+    # Results only depend on the input files, the window and how the files are resampled when they are loaded, so they
+    # can be reused until any of those changes
+    def get_cache_path(self, element):
+        window, hop = self.get_window()
+        key = hashlib.sha1()
+        for song_type in SONG_TYPES:
+            key.update(hash_file(self.paths[element][song_type]).encode())
+        key.update(("%s-%i-%i-%s" % (window, hop, self.config.getint("song", "sample_size"), self.config.get("song", "resampler"))).encode())
+        return os.path.join(self.cache_folder, key.hexdigest() + ".json")
 
     def calculate_metrics(self):
-        sdr = sir = sar = []
-        for element in range(0, len(self.vocals)):
-            original_data = np.stack((self.vocals[element], self.accompaniments[element]))
-            estimated_data = np.stack((self.estimated_vocals[element], self.estimated_accompaniments[element]))
-            museval.metrics.validate(original_data, estimated_data)
-            self.logger.info("Calculating metrics for %s...", self.names[element])
-            obtained_sdr, _, obtained_sir, obtained_sar, _ = museval.metrics.bss_eval(original_data, estimated_data, window=np.inf, hop=0)
-            if element == 0:
-                sdr = obtained_sdr
-                sir = obtained_sir
-                sar = obtained_sar
+        window, hop = self.get_window()
+        results = [None] * len(self.names)
+        tasks = []
+        # Cached songs don't even have to be loaded
+        for element in range(0, len(self.names)):
+            cache_path = self.get_cache_path(element)
+            if os.path.isfile(cache_path):
+                self.logger.info("Using cached metrics for %s.", self.names[element])
+                with open(cache_path, 'r') as f:
+                    cached = json.load(f)
+                results[element] = tuple(np.array(cached[metric], dtype=float) for metric in ("sdr", "sir", "sar"))
+            else:
+                tasks.append((element, cache_path))
+        workers = self.config.getint("evaluation", "workers")
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(tasks))
+        self.logger.info("Calculating metrics for %i songs on %i processes...", len(tasks), max(workers, 1))
+        config_values = config_to_dict(self.config)
+        # Each worker loads the song it's evaluating by itself, so at most one song per worker is in memory
+        pool = multiprocessing.get_context("spawn").Pool(workers) if workers > 1 else None
+        try:
+            elements = [element for element, _ in tasks]
+            if pool is not None:
+                computed = pool.imap(evaluate_song, [(self.names[element], self.paths[element], config_values, window, hop) for element in elements])
             else:
-                sdr = np.column_stack((sdr, obtained_sdr))
-                sir = np.column_stack((sir, obtained_sir))
-                sar = np.column_stack((sar, obtained_sar))
+                computed = (calculate_song_metrics(original_data, estimated_data, window, hop) for _, original_data, estimated_data in self.iter_songs(elements))
+            for (element, cache_path), result in zip(tasks, computed):
+                self.logger.info("Calculated metrics for %s.", self.names[element])
+                results[element] = result
+                os.makedirs(self.cache_folder, exist_ok=True)
+                with open(cache_path, 'w') as f:
+                    json.dump({metric: np.asarray(values).tolist() for metric, values in zip(("sdr", "sir", "sar"), result)}, f)
+        finally:
+            if pool is not None:
+                pool.terminate()
+        # Framewise metrics are summarized with the median of each song (ignoring silent frames), like museval does
+        sdr = np.column_stack([np.nanmedian(result[0], axis=1) for result in results])
+        sir = np.column_stack([np.nanmedian(result[1], axis=1) for result in results])
+        sar = np.column_stack([np.nanmedian(result[2], axis=1) for result in results])
         return sdr, sir, sar
 
+    # Write the metrics of each song to a CSV file and the summary of all songs to a JSON file
+    def save_metrics(self, sdr, sir, sar, filename="results"):
+        self.logger.info("Saving results to %s.csv and %s.json...", filename, filename)
+        with open(filename + ".csv", 'w') as f:
+            w = csv.writer(f)
+            w.writerow(("name", "vocals_sdr", "vocals_sir", "vocals_sar", "accompaniment_sdr", "accompaniment_sir", "accompaniment_sar"))
+            for element in range(0, len(self.names)):
+                w.writerow((self.names[element], sdr[0][element], sir[0][element], sar[0][element], sdr[1][element], sir[1][element], sar[1][element]))
+        summary = {"songs": len(self.names)}
+        for source, row in (("vocals", 0), ("accompaniment", 1)):
+            summary[source] = {}
+            for metric, values in (("sdr", sdr), ("sir", sir), ("sar", sar)):
+                summary[source][metric] = {
+                    "mean": float(np.nanmean(values[row])),
+                    "median": float(np.nanmedian(values[row])),
+                    "std": float(np.nanstd(values[row])),
+                    "min": float(np.nanmin(values[row])),
+                    "max": float(np.nanmax(values[row]))
+                }
+        with open(filename + ".json", 'w') as f:
+            json.dump(summary, f, indent=1)
+
     def print_metrics(self, sdr, sir, sar):
         self.logger.info("Printing results...")
         for element in range(0, len(self.names)):
             self.logger.info("Song name: %s", self.names[element])
             self.logger.info("Vocals: SDR: %.2f, SIR: %.2f, SAR: %.2f", sdr[0][element], sir[0][element], sar[0][element])
             self.logger.info("Accompaniments: SDR: %.2f, SIR: %.2f, SAR: %.2f", sdr[1][element], sir[1][element], sar[1][element])
+
+# Separate every song in the folder (each one in its own directory with mixture.wav, vocals.wav and accompaniment.wav)
+# with each of the separators and evaluate the results. Returns the median SDR, SIR and SAR of each separator and
+# how much they differ from the first one. Used to compare exported models and the trials of a sweep.
+def compare_separators(logger, config, separators, folder):
+    cache = FeatureCache(logger, config) if config.getboolean("cache", "enabled") else None
+    songs = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        if all(name in files for name in ("mixture.wav", "vocals.wav", "accompaniment.wav")):
+            songs.append(root)
+    if len(songs) == 0:
+        logger.critical("No songs with mixture.wav, vocals.wav and accompaniment.wav found in %s.", folder)
+        sys.exit(13)
+    report = {}
+    with tempfile.TemporaryDirectory() as output_folder:
+        for name, separator in separators:
+            for number, song_folder in enumerate(songs):
+                destination = os.path.join(output_folder, name, "%i_%s" % (number, os.path.basename(song_folder)))
+                os.makedirs(destination)
+                for track in ("vocals.wav", "accompaniment.wav"):
+                    shutil.copyfile(os.path.join(song_folder, track), os.path.join(destination, track))
+                mixture = Song(logger, os.path.basename(song_folder), config)
+                mixture.load_features(os.path.join(song_folder, "mixture.wav"), cache, keep_spectrogram=True)
+                separator.isolate(mixture, os.path.join(destination, "estimated_vocals.wav"), save_accompaniment=True)
+                os.replace(os.path.join(destination, "instrumental_estimated_vocals.wav"), os.path.join(destination, "estimated_accompaniment.wav"))
+            evaluator = Evaluator(logger, config)
+            evaluator.find_songs(os.path.join(output_folder, name))
+            sdr, sir, sar = evaluator.calculate_metrics()
+            report[name] = {source: {metric: float(np.nanmedian(values[row])) for metric, values in (("sdr", sdr), ("sir", sir), ("sar", sar))} for source, row in (("vocals", 0), ("accompaniment", 1))}
+    reference = separators[0][0]
+    for name, _ in separators[1:]:
+        report[name]["delta"] = {source: {metric: report[name][source][metric] - report[reference][source][metric] for metric in ("sdr", "sir", "sar")} for source in ("vocals", "accompaniment")}
+        for source in ("vocals", "accompaniment"):
+            delta = report[name]["delta"][source]
+            logger.info("%s vs %s, %s: SDR %+.2f dB, SIR %+.2f dB, SAR %+.2f dB.", name, reference, source, delta["sdr"], delta["sir"], delta["sar"])
+    return report
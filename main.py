@@ -6,63 +6,144 @@ import logging
 import argparse
 import os
 import sys
-from dataset import Dataset
-from model import Model
-from song import Song
 from config import prepare_config
-from evaluate import Evaluator
-
-# Set up - Load config, arguments and set up logging
-config = prepare_config('config.ini')
-if config.get("logging", "logtype") == "file":
-    logging.basicConfig(filename=config.get('logging', 'logfile'), level=logging.getLevelName(config.get('logging', 'loglevel')), filemode='a', format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S')
-elif config.get("logging", "logtype") == "console":
-    logging.basicConfig(level=logging.getLevelName(config.get('logging', 'loglevel')), format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S')
-logging.addLevelName(55, "Hello!")
-logging.addLevelName(56, "Goodbye!")
-
-parser = argparse.ArgumentParser(description="Neural network for vocal and music splitting")
-parser.add_argument("--mode", default="train", type=str, help="Mode in which the script is run (train/separate/evaluate).")
-parser.add_argument("--weights", default="network.weights", type=str, help="File containing the weights to be used with the neural network. Will be created if it doesn't exist. Required for separation. Default is network.weights.")
-parser.add_argument("--datadir", default="data", type=str, help="Directory in which the training data is located in. Default is data. (requires --mode=train)")
-parser.add_argument("--validationdir", default="data-valid", type=str, help="Directory in which the validation data is located in. Default is data-valid. (requires --mode=train)")
-parser.add_argument("--evaluationdir", default="evaluate", type=str, help="Directory in which separated data and the originals are located in. Default is evaluate. (requires --mode=evaluate)")
-parser.add_argument("--epochs", default=1, type=int, help="How many times will the network go over the data. default - 1. (requires --mode=train)")
-parser.add_argument("--file", default="mixture.wav", type=str, help="Name of the file from which to extract vocals. (requires --mode=separate)")
-parser.add_argument("--output", default="vocals.wav", type=str, help="Name of the file to which the vocals will be written to. (requires --mode=separate)")
-parser.add_argument("--dump_data", default="false", type=str, help="If set to true, dumps raw data for everything. Takes up a lot of space, but can be potentially useful for comparing results. (requires --mode=separate)")
-parser.add_argument("--save_accompaniment", default="false", type=str, help="If set to true, the accompaniment will also be saved as a separate file (requires --mode=separate)")
-args = parser.parse_args()
-
-logging.log(55, 'Script started.')
-if args.mode == "train":
+from profiling import profiler
+
+# Everything that needs tensorflow, librosa or museval is only imported by the modes that use it, so that modes
+# which don't need them (and --help) start quickly
+
+# Returns the keras model with the given weights, or the exported model if the tflite backend is selected
+def load_separator(config, weights):
+    if config.get("separate", "backend") == "tflite":
+        from tflite import TFLiteSeparator
+        return TFLiteSeparator(logging, config, config.get("export", "filename"))
+    from model import Model
+    model = Model(logging, config)
+    model.build()
+    if os.path.isfile(weights):
+        model.load(weights)
+    else:
+        logging.critical("Couldn't find a weights file.")
+        sys.exit(11)
+    return model
+
+def run_train(config, args):
     logging.info("Preparing to train a model...")
+    from dataset import Dataset
+    from model import Model
+    from checkpoint import Checkpoint
     dataset = Dataset(logging, config)
-    dataset.load(args.datadir)
-    dataset.get_data_for_cnn()
-    dataset.get_labels_for_cnn()
     validation_set = Dataset(logging, config)
-    validation_set.load(args.validationdir)
-    validation_set.get_data_for_cnn()
-    validation_set.get_labels_for_cnn()
+    if config.get("dataset", "storage") == "shards":
+        dataset.build_shards(args.datadir, os.path.join(config.get("dataset", "shard_directory"), "train"))
+        validation_set.build_shards(args.validationdir, os.path.join(config.get("dataset", "shard_directory"), "validation"))
+    elif config.get("dataset", "storage") == "sampler":
+        dataset.load_sampler(args.datadir)
+        validation_set.load_sampler(args.validationdir)
+    else:
+        dataset.load(args.datadir)
+        dataset.get_data_for_cnn()
+        dataset.get_labels_for_cnn()
+        validation_set.load(args.validationdir)
+        validation_set.get_data_for_cnn()
+        validation_set.get_labels_for_cnn()
+    model = Model(logging, config, dataset, validation_set)
+    checkpoint = Checkpoint(logging, config)
+    state = {"epoch": 0, "step": 0, "sequence_seed": None}
+    if args.resume.lower() in ("yes", "true", "y", "t", "1") and checkpoint.exists():
+        # The checkpoint contains the whole model, including the optimizer state
+        model.model, state = checkpoint.load(dataset)
+        if state["epoch"] >= args.epochs:
+            logging.info("The checkpoint is already at epoch %i, increase --epochs to continue training.", state["epoch"])
+    else:
+        if args.resume.lower() in ("yes", "true", "y", "t", "1"):
+            logging.warning("No checkpoint found, starting from the beginning.")
+        model.build(output_summary=True)
+        if os.path.isfile(args.weights):
+            logging.info("Found existing weights, loading them...")
+            model.load(args.weights)
+    model.train(args.epochs, save_log=config.getboolean("model", "save_history"), log_name=config.get("model", "history_filename"), checkpoint=checkpoint, initial_epoch=state["epoch"], initial_step=state["step"], seed=state["sequence_seed"])
+    logging.info("Saving weights...")
+    model.save(args.weights)
+
+def run_train_distributed(config, args):
+    logging.info("Preparing to train a model on multiple processes...")
+    from dataset import Dataset
+    from model import Model
+    from distributed import DistributedTrainer
+    # The workers read their batches from the shards themselves, so the dataset is always stored in shards
+    dataset = Dataset(logging, config)
+    dataset.build_shards(args.datadir, os.path.join(config.get("dataset", "shard_directory"), "train"))
+    validation_set = None
+    if args.mode == "train-distributed":
+        validation_set = Dataset(logging, config)
+        validation_set.build_shards(args.validationdir, os.path.join(config.get("dataset", "shard_directory"), "validation"))
     model = Model(logging, config, dataset, validation_set)
     model.build(output_summary=True)
     if os.path.isfile(args.weights):
         logging.info("Found existing weights, loading them...")
         model.load(args.weights)
-    model.train(args.epochs, save_log=config.getboolean("model", "save_history"), log_name=config.get("model", "history_filename"))
-    logging.info("Saving weights...")
-    model.save(args.weights)
-elif args.mode == "separate":
+    trainer = DistributedTrainer(logging, config, model, dataset, validation_set)
+    if args.mode == "scaling":
+        trainer.measure_scaling()
+    else:
+        trainer.train(args.epochs, resume=args.resume.lower() in ("yes", "true", "y", "t", "1"))
+        logging.info("Saving weights...")
+        model.save(args.weights)
+
+def run_sweep(config, args):
+    logging.info("Preparing a hyperparameter sweep...")
+    from sweep import Sweeper
+    sweeper = Sweeper(logging, config)
+    sweeper.run(args.datadir, args.validationdir)
+    logging.info("Results of %i trials saved to %s.", len(sweeper.results), os.path.join(sweeper.folder, config.get("sweep", "results") + ".csv"))
+
+def run_separate(config, args):
     logging.info("Preparing to separate vocals from instrumentals...")
+    from song import Song
+    from cache import FeatureCache
     mixture = Song(logging, "a mixture", config)
-    mixture.load_file(args.file)
-    mixture.compute_stft(keep_spectrogram=True)
+    mixture.load_features(args.file, FeatureCache(logging, config) if config.getboolean("cache", "enabled") else None, keep_spectrogram=True)
     dump_data = True if args.dump_data.lower() in ("yes", "true", "y", "t", "1") else False
     save_accompaniment = True if args.save_accompaniment.lower() in ("yes", "true", "y", "t", "1") else False
     if dump_data is True:
         mixture.dump_amplitude("original")
         mixture.dump_spectrogram("original")
+    model = load_separator(config, args.weights)
+    if dump_data is True:
+        model.isolate(mixture, args.output, save_accompaniment=save_accompaniment, save_original_mask=True, save_original_probabilities=True)
+        mixture.dump_spectrogram("processed")
+    else:
+        model.isolate(mixture, args.output, save_accompaniment=save_accompaniment)
+
+def run_separate_batch(config, args):
+    logging.info("Preparing to separate vocals from a batch of songs...")
+    from batch import BatchSeparator
+    model = load_separator(config, args.weights)
+    save_accompaniment = True if args.save_accompaniment.lower() in ("yes", "true", "y", "t", "1") else False
+    BatchSeparator(logging, config, model, args.outputdir, save_accompaniment).run(args.input)
+
+def run_serve(config, args):
+    logging.info("Preparing to serve separation requests...")
+    from server import serve
+    model = load_separator(config, args.weights)
+    serve(logging, config, model)
+
+def run_realtime(config, args):
+    logging.info("Preparing to separate a live stream...")
+    from realtime import serve_realtime
+    serve_realtime(logging, config, load_separator(config, args.weights))
+
+def run_realtime_simulate(config, args):
+    logging.info("Feeding %s through the realtime separator...", args.file)
+    from realtime import simulate
+    simulate(logging, config, load_separator(config, args.weights), args.file, args.output)
+
+def run_export(config, args):
+    logging.info("Exporting the model...")
+    from model import Model
+    from tflite import export_tflite, save_report, TFLiteSeparator
+    from evaluate import compare_separators
     model = Model(logging, config)
     model.build()
     if os.path.isfile(args.weights):
@@ -70,19 +151,93 @@ elif args.mode == "separate":
     else:
         logging.critical("Couldn't find a weights file.")
         sys.exit(11)
-    if dump_data is True:
-        model.isolate(mixture, args.output, save_accompaniment=save_accompaniment, save_original_mask=True, save_original_probabilities=True)
-        mixture.dump_spectrogram("processed")
-    else:
-        model.isolate(mixture, args.output)
-elif args.mode == "evaluate":
+    export_tflite(logging, config, model, config.get("export", "filename"))
+    if config.get("export", "evaluation_directory") != "":
+        logging.info("Comparing the exported model with the original...")
+        report = compare_separators(logging, config, [("keras", model), ("tflite", TFLiteSeparator(logging, config, config.get("export", "filename")))], config.get("export", "evaluation_directory"))
+        save_report(report, config.get("export", "report"))
+
+def run_evaluate(config, args):
     logging.info("Preparing to evaluate the effectiveness of an output")
+    from evaluate import Evaluator
     evaluator = Evaluator(logging, config)
-    evaluator.load_data(args.evaluationdir)
-    evaluator.prepare_data()
+    evaluator.find_songs(args.evaluationdir)
     sdr, sir, sar = evaluator.calculate_metrics()
     evaluator.print_metrics(sdr, sir, sar)
-else:
-    logging.critical("Invalid action - %s", args.mode)
-    sys.exit(12)
-logging.log(56, "Script finished!")
+    evaluator.save_metrics(sdr, sir, sar, config.get("evaluation", "results"))
+
+def run_normalize(config, args):
+    logging.info("Converting %s to %i Hz mono...", args.datadir, config.getint("song", "sample_size"))
+    from audio import normalize_corpus
+    normalize_corpus(logging, config, args.datadir, args.outputdir)
+
+def run_cache_prewarm(config, args):
+    logging.info("Filling the feature cache...")
+    from dataset import Dataset
+    dataset = Dataset(logging, config)
+    if dataset.cache is None:
+        logging.critical("The feature cache is disabled in the config.")
+        sys.exit(16)
+    for folder in (args.datadir, args.validationdir):
+        if os.path.isdir(folder):
+            for _ in dataset.load_songs(dataset.find_songs(folder)):
+                pass
+    logging.info("Cache size is now %.1f MB.", dataset.cache.get_size() / (1024 * 1024))
+
+def run_cache_purge(config, args):
+    logging.info("Purging the feature cache...")
+    from cache import FeatureCache
+    FeatureCache(logging, config).purge()
+
+MODES = {
+    "train": run_train,
+    "train-distributed": run_train_distributed,
+    "scaling": run_train_distributed,
+    "sweep": run_sweep,
+    "separate": run_separate,
+    "separate-batch": run_separate_batch,
+    "serve": run_serve,
+    "realtime": run_realtime,
+    "realtime-simulate": run_realtime_simulate,
+    "export": run_export,
+    "evaluate": run_evaluate,
+    "normalize": run_normalize,
+    "cache-prewarm": run_cache_prewarm,
+    "cache-purge": run_cache_purge
+}
+
+# The guard keeps worker processes (which import this file when they're spawned) from running the script again
+if __name__ == "__main__":
+    # Set up - Load config, arguments and set up logging
+    config = prepare_config('config.ini')
+    if config.get("logging", "logtype") == "file":
+        logging.basicConfig(filename=config.get('logging', 'logfile'), level=logging.getLevelName(config.get('logging', 'loglevel')), filemode='a', format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+    elif config.get("logging", "logtype") == "console":
+        logging.basicConfig(level=logging.getLevelName(config.get('logging', 'loglevel')), format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+    logging.addLevelName(55, "Hello!")
+    logging.addLevelName(56, "Goodbye!")
+
+    parser = argparse.ArgumentParser(description="Neural network for vocal and music splitting")
+    parser.add_argument("--mode", default="train", type=str, help="Mode in which the script is run (%s)." % "/".join(MODES))
+    parser.add_argument("--weights", default="network.weights", type=str, help="File containing the weights to be used with the neural network. Will be created if it doesn't exist. Required for separation and export. Default is network.weights.")
+    parser.add_argument("--datadir", default="data", type=str, help="Directory in which the training data is located in. Default is data. (requires --mode=train, --mode=train-distributed, --mode=scaling, --mode=sweep, --mode=normalize or --mode=cache-prewarm)")
+    parser.add_argument("--validationdir", default="data-valid", type=str, help="Directory in which the validation data is located in. Default is data-valid. (requires --mode=train, --mode=train-distributed, --mode=sweep or --mode=cache-prewarm)")
+    parser.add_argument("--evaluationdir", default="evaluate", type=str, help="Directory in which separated data and the originals are located in. Default is evaluate. (requires --mode=evaluate)")
+    parser.add_argument("--epochs", default=1, type=int, help="How many times will the network go over the data. default - 1. (requires --mode=train or --mode=train-distributed)")
+    parser.add_argument("--file", default="mixture.wav", type=str, help="Name of the file from which to extract vocals. (requires --mode=separate or --mode=realtime-simulate)")
+    parser.add_argument("--output", default="vocals.wav", type=str, help="Name of the file to which the vocals (or the realtime output) will be written to. (requires --mode=separate or --mode=realtime-simulate)")
+    parser.add_argument("--input", default="songs", type=str, help="Directory with the songs (or a file listing one song per line) from which to extract vocals. (requires --mode=separate-batch)")
+    parser.add_argument("--outputdir", default="separated", type=str, help="Directory to which the separated songs will be written to. Songs that already have outputs there are skipped. (requires --mode=separate-batch or --mode=normalize)")
+    parser.add_argument("--dump_data", default="false", type=str, help="If set to true, dumps raw data for everything. Takes up a lot of space, but can be potentially useful for comparing results. (requires --mode=separate)")
+    parser.add_argument("--save_accompaniment", default="false", type=str, help="If set to true, the accompaniment will also be saved as a separate file (requires --mode=separate or --mode=separate-batch)")
+    parser.add_argument("--resume", default="false", type=str, help="If set to true, training continues from the last checkpoint with the optimizer state, epoch and random state it was saved with. --epochs is the total number of epochs, including the ones before the checkpoint. (requires --mode=train or --mode=train-distributed)")
+    parser.add_argument("--profile", default="", type=str, help="If set to true, the time and memory used by each stage is recorded. Overrides the setting in config.ini.")
+    args = parser.parse_args()
+    profiler.configure(config, (args.profile.lower() in ("yes", "true", "y", "t", "1")) if args.profile != "" else None)
+
+    logging.log(55, 'Script started.')
+    if args.mode not in MODES:
+        logging.critical("Invalid action - %s", args.mode)
+        sys.exit(12)
+    MODES[args.mode](config, args)
+    logging.log(56, "Script finished!")
@@ -0,0 +1,33 @@
+import sys
+import numpy as np
+
+# Functions for turning the probabilities predicted by the network into masks that can be applied to a spectrogram.
+# All of them work on whole arrays at once, so they're cheap compared to the network itself.
+
+# 1 for every bin of a (decibel) amplitude that is loud enough to count as vocal activity. The same threshold is used
+# for the training labels and for the reference masks made by the scripts in misc, so that they always agree.
+def label_mask(amplitude, threshold=1):
+    return (amplitude > threshold).astype(np.uint8)
+
+# 1 for every bin where the probability is above the threshold, 0 everywhere else
+def binary_mask(probabilities, threshold=0.45):
+    return (probabilities > threshold).astype(np.float32)
+
+# Use the probabilities themselves as the ratio of the bin that belongs to the vocals
+def soft_mask(probabilities):
+    return np.clip(probabilities, 0, 1).astype(np.float32, copy=False)
+
+# The accompaniment gets whatever the vocals don't
+def complement_mask(mask):
+    return 1 - mask
+
+# Returns the vocal mask and the accompaniment mask (or None if it's not needed)
+def get_masks(logger, probabilities, mask_type="binary", threshold=0.45, accompaniment=True):
+    if mask_type == "binary":
+        vocals = binary_mask(probabilities, threshold)
+    elif mask_type == "soft":
+        vocals = soft_mask(probabilities)
+    else:
+        logger.critical("Unknown mask type - %s", mask_type)
+        sys.exit(17)
+    return vocals, (complement_mask(vocals) if accompaniment is True else None)
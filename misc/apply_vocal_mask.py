@@ -2,62 +2,85 @@
 # This is used to create files that can be compared with CNNs
 # output. Because of this it also generates and uses binary masks
 # so that any problems caused by that method don't impact the comparison.
-import numpy as np
-import librosa
+# The masks are made with the same code and settings (config.ini) that are used for the training labels.
+import os
 import sys
+import time
+import logging
 import argparse
+import multiprocessing
+import numpy as np
+import librosa
+import soundfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from config import prepare_config, config_to_dict, config_from_dict
+from mask import label_mask, complement_mask
+from song import Song
 
-parser = argparse.ArgumentParser(description="A small tool to obtain instrumentals from a mixture provided a vocal track")
-parser.add_argument("mixture", default="mixture.wav", type=str, help="Path to the mixture")
-parser.add_argument("vocals", default="vocals.wav", type=str, help="Path to the vocal track")
-args = parser.parse_args()
-
-print("Loading files...")
-mixture, mixture_sample_rate = librosa.load(args.mixture)
-vocals, vocal_sample_rate = librosa.load(args.vocals)
-
-if mixture_sample_rate != vocal_sample_rate:
-    print("Sample rates don't match. Resample your data and try again.")
-    sys.exit(2)
-
-print("Processing audio data...")
-mixture_spectrogram = librosa.stft(mixture, 2048, 256)
-vocal_spectrogram = librosa.stft(vocals, 2048, 256)
+# Returns the vocals and the instrumentals of the mixture, masked with the binary mask of the vocal track
+def separate(config, mixture_path, vocals_path):
+    mixture = Song(logging, "mixture", config)
+    mixture.load_file(mixture_path)
+    length = len(mixture.get_raw_data())
+    mixture.compute_stft(keep_spectrogram=True)
+    vocals = Song(logging, "vocals", config)
+    vocals.load_file(vocals_path)
+    vocals.compute_stft()
+    # The tracks might differ by a few frames
+    frames = min(mixture.get_amplitude().shape[1], vocals.get_amplitude().shape[1])
+    vocal_mask = label_mask(vocals.get_amplitude()[:, :frames], config.getfloat("song", "label_threshold"))
+    spectrogram = mixture.get_spectrogram()[:, :frames]
+    outputs = []
+    for mask in (vocal_mask, complement_mask(vocal_mask)):
+        outputs.append(librosa.istft(spectrogram * mask, config.getint("song", "hop_length"), config.getint("song", "window_size"), length=length))
+    return outputs
 
-vocal_amplitude = librosa.power_to_db(np.abs(vocal_spectrogram)**2)
-mixture_magnitude, mixture_phase = librosa.core.magphase(mixture_spectrogram)
+# Writes a 16-bit wav so that the file can be loaded without ffmpeg
+def write(filename, data, sample_rate):
+    soundfile.write(filename + ".partial", np.clip(data, -1, 1), sample_rate, subtype="PCM_16", format="WAV")
+    os.replace(filename + ".partial", filename)
 
-# Create a binary mask for the vocals
-# We can actually work with just the raw spectrograms if we need to,
-# but that's not the point of this script
-print("Generating masks...")
-vocal_mask = []
-instrumental_mask = []
-for x in range(0, vocal_amplitude.shape[0]):
-    vocal_slice = []
-    instrumental_slice = []
-    for y in range(0, vocal_amplitude.shape[1]):
-        # This is the same algorithm as used in song.py
-        # Please refer to that file for more information on what it does
-        # And the problems this has.
-        if vocal_amplitude[x][y] > 0.01:
-            vocal_slice.append(1)
-            instrumental_slice.append(0)
-        else:
-            vocal_slice.append(0)
-            instrumental_slice.append(1)
-    vocal_mask.append(vocal_slice)
-    instrumental_mask.append(instrumental_slice)
+# Runs in a worker process - creates accompaniment.wav in the folder of a song
+def process_song(task):
+    folder, config_values = task
+    config = config_from_dict(config_values)
+    _, instrumentals = separate(config, os.path.join(folder, "mixture.wav"), os.path.join(folder, "vocals.wav"))
+    write(os.path.join(folder, "accompaniment.wav"), instrumentals, config.getint("song", "sample_size"))
+    return folder
 
-print("Applying masks...")
-output_vocals = np.multiply(mixture_magnitude, vocal_mask) * mixture_phase
-output_instrumentals = np.multiply(mixture_magnitude, instrumental_mask) * mixture_phase
+# Every folder in the tree that has a mixture and vocals but no accompaniment yet
+def find_songs(folder):
+    songs = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        if "mixture.wav" in files and "vocals.wav" in files and "accompaniment.wav" not in files:
+            songs.append(root)
+    return songs
 
-print("Processing audio data...")
-vocal_data = librosa.istft(output_vocals, 256, 2048)
-instrumental_data = librosa.istft(output_instrumentals, 256, 2048)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A small tool to obtain instrumentals from a mixture provided a vocal track")
+    parser.add_argument("mixture", default="mixture.wav", nargs='?', type=str, help="Path to the mixture")
+    parser.add_argument("vocals", default="vocals.wav", nargs='?', type=str, help="Path to the vocal track")
+    parser.add_argument("--batch", default="", type=str, help="Directory tree with songs (mixture.wav and vocals.wav in a directory per song). An accompaniment.wav is written next to each of them.")
+    parser.add_argument("--workers", default=0, type=int, help="Number of songs processed in parallel in batch mode. 0 uses all cores.")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.ini"), type=str, help="Config with the song settings. Default is the one in the parent directory.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    config = prepare_config(args.config, write=False)
 
-print("Outputting files...")
-librosa.output.write_wav("processed_vocals.wav", vocal_data, mixture_sample_rate, norm=True)
-librosa.output.write_wav("processed_instrumentals.wav", instrumental_data, mixture_sample_rate, norm=True)
-print("Completed. Output can be found in processed_vocals.wav and processed_instrumentals.wav.")
+    if args.batch != "":
+        songs = find_songs(args.batch)
+        workers = args.workers if args.workers > 0 else multiprocessing.cpu_count()
+        print("Creating accompaniments for %i songs on %i processes..." % (len(songs), workers))
+        started = time.time()
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            for number, folder in enumerate(pool.imap_unordered(process_song, [(folder, config_to_dict(config)) for folder in songs])):
+                print("%i/%i - %s (%.2f songs/s)" % (number + 1, len(songs), folder, (number + 1) / max(time.time() - started, 1e-6)))
+        print("Completed.")
+    else:
+        print("Processing audio data...")
+        vocal_data, instrumental_data = separate(config, args.mixture, args.vocals)
+        print("Outputting files...")
+        write("processed_vocals.wav", vocal_data, config.getint("song", "sample_size"))
+        write("processed_instrumentals.wav", instrumental_data, config.getint("song", "sample_size"))
+        print("Completed. Output can be found in processed_vocals.wav and processed_instrumentals.wav.")
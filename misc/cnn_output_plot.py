@@ -2,13 +2,19 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import argparse
+import os
 import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from config import prepare_config
+from mask import binary_mask
 
 parser = argparse.ArgumentParser(description="Create a visualisation for NN output")
 parser.add_argument("file", type=str, help="Path to the outputs (saved numpy array, i.e. labels.out)")
 parser.add_argument("type", type=str, default="binary", nargs='?', help="Type of graph to output (normal/binary)")
 parser.add_argument("output", default="", nargs='?', type=str, help="Path to output file (png)")
+parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.ini"), type=str, help="Config with the mask threshold. Default is the one in the parent directory.")
 args = parser.parse_args()
+config = prepare_config(args.config, write=False)
 
 data = np.loadtxt(args.file)
 
@@ -35,9 +41,8 @@ if args.type == "normal":
             s = '%.2f' % newdata[i][j]
             ax.text(j, i, s, fontsize=5, ha='center', va='center')
 elif args.type == "binary":
-    processed = np.empty(np.shape(data))
-    processed[data>0.45] = [1]
-    processed[data<0.45] = [0]
+    # Same mask as the one used when separating
+    processed = binary_mask(data, config.getfloat("separate", "mask_threshold"))
     plt.imshow(processed, interpolation='nearest', cmap="Greys", origin='lower')
 else:
     print("Invalid action - ", args.type)
@@ -4,12 +4,19 @@ import numpy as np
 import librosa
 import librosa.display
 import argparse
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from config import prepare_config
+from mask import label_mask
 
 parser = argparse.ArgumentParser(description="Create spectrogram from a wav file")
 parser.add_argument("file", type=str, help="Path to the file (wav)")
 parser.add_argument("mel", type=str, nargs='?', default="false", help="Should this spectrogram be rendered as a mel spectrogram? (true/false)")
 parser.add_argument("output", default="", nargs='?', type=str, help="Path to output file (png)")
+parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.ini"), type=str, help="Config with the label threshold. Default is the one in the parent directory.")
 args = parser.parse_args()
+config = prepare_config(args.config, write=False)
 audio, sampleRate = librosa.load(args.file)
 plt.figure(figsize=(10,4))
 
@@ -20,15 +27,8 @@ if mel is True:
 else:
     amplitude = librosa.power_to_db(np.abs(librosa.stft(audio)))
 
-slices = []
-for x in range(0, amplitude.shape[0]):
-    _slice = []
-    for y in range(0, amplitude.shape[1]):
-        if amplitude[x][y] > 0.01:
-            _slice.append(1)
-        else:
-            _slice.append(0)
-    slices.append(_slice)
+# Same threshold as the training labels
+slices = label_mask(amplitude, config.getfloat("song", "label_threshold"))
 
 plt.imshow(slices, interpolation='nearest', cmap="Greys", origin='lower')
 #librosa.display.specshow(slices, y_axis='mel', fmax=sampleRate, x_axis='time')
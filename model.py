@@ -1,18 +1,118 @@
 import os
 import sys
+import random
 import numpy as np
 import math
 import keras
 from keras.models import Sequential
-from keras.layers import Dense, Dropout, Flatten, Conv2D, MaxPooling2D, Activation
+from keras.models import Model as KerasModel
+from keras.layers import Dense, Dropout, Flatten, Conv2D, MaxPooling2D, Activation, Input, Cropping2D
 from dataset import Dataset
+from separator import Separator
+from profiling import profiler
+from mask import get_masks
+from stream import StreamingISTFT
 
-# Class to manage the model, it's state.
-class Model:
+# Feeds shuffled batches from a ShardStore to keras so that the whole dataset never has to be loaded into RAM
+class WindowSequence(keras.utils.Sequence):
+    def __init__(self, store, batch_size=32, shuffle=True, seed=None, epoch=0):
+        self.store = store
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        # The order of each epoch only depends on the seed and the epoch, so a resumed run goes through the same batches
+        self.seed = seed if seed is not None else np.random.randint(2**31)
+        self.epoch = epoch
+        self.order = np.arange(len(store))
+        self.shuffle_order()
+
+    def __len__(self):
+        return int(math.ceil(len(self.store) / self.batch_size))
+
+    def __getitem__(self, index):
+        # Sorting the indices inside a batch keeps the reads from each shard sequential
+        indices = np.sort(self.order[index * self.batch_size : (index + 1) * self.batch_size])
+        return self.store.get(indices)
+
+    def shuffle_order(self):
+        if self.shuffle is True:
+            self.order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.store))
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.shuffle_order()
+
+# Feeds the windows a WindowSampler draws for each epoch to keras. Like with WindowSequence, the windows of an epoch
+# only depend on the seed and the epoch. Without shuffling the same non-overlapping windows are used every epoch.
+class SamplerSequence(keras.utils.Sequence):
+    def __init__(self, sampler, batch_size=32, shuffle=True, seed=None, epoch=0):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed if seed is not None else np.random.randint(2**31)
+        self.epoch = epoch
+        self.draw()
+
+    def __len__(self):
+        return int(math.ceil(len(self.songs) / self.batch_size))
+
+    def __getitem__(self, index):
+        songs = self.songs[index * self.batch_size : (index + 1) * self.batch_size]
+        starts = self.starts[index * self.batch_size : (index + 1) * self.batch_size]
+        # Reading the windows of each song in order keeps the reads from the memory mapped amplitudes sequential
+        order = np.lexsort((starts, songs))
+        return self.sampler.get_windows(songs[order], starts[order])
+
+    def draw(self):
+        if self.shuffle is True:
+            self.songs, self.starts = self.sampler.get_epoch(self.seed + self.epoch)
+        else:
+            self.songs, self.starts = self.sampler.get_grid()
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        if self.shuffle is True:
+            self.draw()
+
+# Saves a checkpoint at the end of every epoch and every few batches in between
+class CheckpointCallback(keras.callbacks.Callback):
+    def __init__(self, checkpoint, initial_epoch=0, initial_step=0, steps=0, dataset=None, sequence=None):
+        super(CheckpointCallback, self).__init__()
+        self.checkpoint=checkpoint
+        self.epoch=initial_epoch
+        self.step=initial_step
+        self.steps=steps
+        self.dataset=dataset
+        self.sequence=sequence
+        self.random_state=None
+        self.epoch_step=initial_step
+
+    # keras shuffles the data right after this, so this is the state that reproduces the order of this epoch
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_step = self.step
+        self.random_state = (np.random.get_state(), random.getstate())
+
+    def on_batch_end(self, batch, logs=None):
+        self.step += 1
+        # Checkpoints saved in the middle of an epoch continue from the start of that epoch, with the weights and the
+        # optimizer state from the middle of it
+        if self.steps > 0 and self.step % self.steps == 0:
+            self.checkpoint.save(self.model, self.epoch, self.epoch_step, self.dataset, self.sequence, self.random_state)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.checkpoint.save(self.model, epoch + 1, self.step, self.dataset, self.sequence)
+
+# Signal to distortion ratio of an estimate in dB. Unlike BSS-Eval the estimate isn't allowed any filtering, which is
+# enough to compare two estimates of the same signal.
+def get_sdr(reference, estimate):
+    return float(10 * np.log10((np.sum(np.square(reference, dtype=np.float64)) + 1e-12) / (np.sum(np.square(reference - estimate, dtype=np.float64)) + 1e-12)))
+
+# Class to manage the model, it's state. Separation itself is done by Separator.
+class Model(Separator):
     def __init__(self, logger, config, dataset=None, validation_data=None):
-        self.logger = logger
-        self.config = config
+        super(Model, self).__init__(logger, config)
         self.model = None
+        self.convolutional_model = None
         self.dataset = dataset
         self.validation_data = validation_data
 
@@ -42,13 +142,31 @@ class Model:
             model.summary()
         self.model = model
 
-    def train(self, epochs, batch=32, save_log=False, log_name="history.csv"):
+    # Trains until the given epoch. initial_epoch is the number of epochs that have already been done when resuming from a checkpoint.
+    def train(self, epochs, batch=32, save_log=False, log_name="history.csv", checkpoint=None, initial_epoch=0, initial_step=0, seed=None):
         if self.model is not None:
             self.logger.info("Training the model...")
-            self.logger.info("Beggining training with %i samples.", len(self.dataset.mixture_windows))
             weights_backup = keras.callbacks.ModelCheckpoint('weights{epoch:08d}.h5', save_weights_only=True, period=5)
-            #TODO: Evaluate the use of fit_generator or train_on_batch to load data from disk instead of storing it all in RAM since it takes up a lot of memory otherwise.
-            training = self.model.fit(self.dataset.mixture_windows, self.dataset.labels, batch_size=batch, epochs=epochs, validation_data=(self.validation_data.mixture_windows, self.validation_data.labels), callbacks=[weights_backup])
+            callbacks = [weights_backup]
+            if self.dataset.sampler is not None:
+                # Every epoch draws a new, balanced set of windows from whole songs
+                self.logger.info("Beggining training with %i samples per epoch drawn from %i windows.", self.config.getint("sampler", "epoch_size"), len(self.dataset.sampler))
+                sequence = SamplerSequence(self.dataset.sampler, batch, seed=seed, epoch=initial_epoch)
+                if checkpoint is not None:
+                    callbacks.append(CheckpointCallback(checkpoint, initial_epoch, initial_step, self.config.getint("checkpoint", "steps"), self.dataset, sequence))
+                training = self.model.fit_generator(sequence, epochs=epochs, initial_epoch=initial_epoch, validation_data=SamplerSequence(self.validation_data.sampler, batch, shuffle=False), callbacks=callbacks)
+            elif self.dataset.store is not None:
+                # Out-of-core training - batches are read from the memory mapped shards as they are needed
+                self.logger.info("Beggining training with %i samples from %s.", len(self.dataset.store), self.dataset.store.folder)
+                sequence = WindowSequence(self.dataset.store, batch, seed=seed, epoch=initial_epoch)
+                if checkpoint is not None:
+                    callbacks.append(CheckpointCallback(checkpoint, initial_epoch, initial_step, self.config.getint("checkpoint", "steps"), self.dataset, sequence))
+                training = self.model.fit_generator(sequence, epochs=epochs, initial_epoch=initial_epoch, validation_data=WindowSequence(self.validation_data.store, batch, shuffle=False), callbacks=callbacks)
+            else:
+                self.logger.info("Beggining training with %i samples.", len(self.dataset.mixture_windows))
+                if checkpoint is not None:
+                    callbacks.append(CheckpointCallback(checkpoint, initial_epoch, initial_step, self.config.getint("checkpoint", "steps"), self.dataset))
+                training = self.model.fit(self.dataset.mixture_windows, self.dataset.labels, batch_size=batch, epochs=epochs, initial_epoch=initial_epoch, validation_data=(self.validation_data.mixture_windows, self.validation_data.labels), callbacks=callbacks)
             self.logger.info("Training finished.")
             if save_log is True:
                 self.logger.info("Exporting statistics.")
@@ -72,36 +190,89 @@ class Model:
             self.logger.critical("Cannot load weights - model not set up or file not found")
             sys.exit(3)
 
-    def isolate(self, mixture, output="output.wav", save_accompaniment=True, save_original_mask=False, save_original_probabilities=False):
-        if self.model is not None:
-            #TODO: For some reason the output loses ~0.004s (3*BINS+1) worth of samples
-            self.logger.info("Preparing the song...")
-            split_x = np.array(mixture.split_slidingwindow(self.config.getint("song", "sample_length")))
-            split_x = split_x.reshape(len(split_x), len(split_x[0]), len(split_x[0][0]), 1)
-            self.logger.info("Extracting vocals from the audio file...")
-            prediction = self.model.predict(split_x)
-            prediction = np.transpose(prediction) # Transpose the mask into the format librosa uses
-            if save_original_probabilities is True:
-                np.savetxt('original_predicted_probabilities.out', prediction)
-            self.logger.info("Calculating the binary mask...")
-            # Probability to label conversion, as there's no other way to get the output from the network in the right format
-            #TODO: don't fill the accompaniment array if save_accompaniment is set to False
-            accompaniment = np.zeros(np.shape(prediction))
-            for x in range(0, len(prediction)):
-                for y in range(0, len(prediction[x])):
-                    prediction[x][y] = 1 if prediction[x][y] > 0.45 else 0 # Higher values tend to make voice unintelligible.
-                    accompaniment[x][y] = 0 if prediction[x][y] > 0.45 else 1
-            if save_original_mask is True:
-                np.savetxt('predicted_mask.out', prediction)
-            if save_accompaniment is True:
-                spectrogram_bak = mixture.get_spectrogram()
-                mixture.apply_binary_mask(accompaniment)
-                mixture.reverse_stft()
-                mixture.save_file("instrumental_"+output)
-                mixture.set_spectrogram(spectrogram_bak)
-            mixture.apply_binary_mask(prediction)
-            mixture.reverse_stft()
-            mixture.save_file(output)
-        else:
-            self.logger.critical("Model not set up, cannot attempt to isolate.")
-            sys.exit(4)
+    # Builds a fully convolutional version of the model that takes a whole block of the spectrogram and predicts every
+    # frame in it at once. The convolutions are computed once for the whole block instead of once for every window that
+    # contains a column, which makes it several times faster. Since the windows aren't padded with zeros inside the
+    # block, the frames near the edge of a window see real context instead, so the output differs slightly.
+    # The weights are taken from the trained model.
+    def build_convolutional(self):
+        self.logger.info("Building the fully convolutional model...")
+        bins = math.ceil(self.config.getint("song", "window_size")/2)+1
+        width = (self.config.getint("song", "sample_length") // 2) // 2 # Width of a window after both pooling layers
+        layers = [layer for layer in self.model.layers if isinstance(layer, (Conv2D, Dense))]
+        convolutions = [Conv2D(layer.filters, layer.kernel_size, padding="same", activation='relu') for layer in layers[:4]]
+        # The dense layers only ever see a single window, so they can be expressed as convolutions that slide over the pooled block
+        dense = Conv2D(layers[4].units, (bins // 2 // 2, width), activation='elu')
+        output = Conv2D(bins, (1,1), activation='sigmoid')
+        inputs = Input(shape=(bins, None, 1))
+        x = convolutions[1](convolutions[0](inputs))
+        # Pooling depends on where a window starts, so every starting column modulo 4 gets its own branch.
+        # Branch a + 2 * b predicts the frames that are a + 2 * b + 4 * n columns into the block.
+        outputs = []
+        for a in (0, 1):
+            y = MaxPooling2D(pool_size=(2,2))(Cropping2D(((0,0),(a,0)))(x))
+            y = convolutions[3](convolutions[2](y))
+            for b in (0, 1):
+                z = MaxPooling2D(pool_size=(2,2))(Cropping2D(((0,0),(b,0)))(y))
+                outputs.append(output(dense(z)))
+        model = KerasModel(inputs=inputs, outputs=[outputs[0], outputs[2], outputs[1], outputs[3]])
+        for layer, trained in zip(convolutions, layers[:4]):
+            layer.set_weights(trained.get_weights())
+        kernel, bias = layers[4].get_weights()
+        dense.set_weights([kernel.reshape(dense.kernel_size + (-1, layers[4].units)), bias])
+        kernel, bias = layers[5].get_weights()
+        output.set_weights([kernel.reshape((1, 1) + kernel.shape), bias])
+        self.convolutional_model = model
+
+    # Predict every frame of a padded block with the fully convolutional model
+    def predict_block(self, block):
+        frames = block.shape[1] - 2 * (self.config.getint("song", "sample_length") // 2)
+        branches = self.convolutional_model.predict(block.reshape((1,) + block.shape + (1,)))
+        prediction = np.empty((block.shape[0], frames), dtype=np.float32)
+        for offset, branch in enumerate(branches):
+            count = len(range(offset, frames, 4))
+            prediction[:, offset::4] = np.transpose(branch[0, 0, :count, :])
+        return prediction
+
+    # How much the predictions of the convolutional engine differ from the sliding engine's for a song. Returns the
+    # largest and the mean absolute difference of the probabilities and the fraction of bins that end up on the other
+    # side of the binary mask threshold. Given the original vocals (and a mixture with its spectrogram), the SDR of the
+    # vocals separated by each engine and how much the convolutional one loses (sdr_delta) are returned as well.
+    def compare_engines(self, mixture, batch=32, vocals=None):
+        predictions = {name: self.predict(mixture, batch, engine=name) for name in ("sliding", "convolutional")}
+        difference = np.abs(predictions["convolutional"] - predictions["sliding"])
+        threshold = self.config.getfloat("separate", "mask_threshold")
+        result = {
+            "max_abs_diff": float(np.max(difference)) if difference.size > 0 else 0.0,
+            "mean_abs_diff": float(np.mean(difference)) if difference.size > 0 else 0.0,
+            "mask_bins_changed": float(np.mean((predictions["convolutional"] > threshold) != (predictions["sliding"] > threshold))) if difference.size > 0 else 0.0
+        }
+        if vocals is not None:
+            for name, prediction in predictions.items():
+                mask, _ = get_masks(self.logger, prediction, self.config.get("separate", "mask_type"), threshold, False)
+                istft = StreamingISTFT(self.config.getint("song", "window_size"), self.config.getint("song", "hop_length"), len(vocals))
+                result["sdr_" + name] = get_sdr(vocals, np.concatenate((istft.push(mixture.get_spectrogram() * mask), istft.flush())))
+            result["sdr_delta"] = result["sdr_convolutional"] - result["sdr_sliding"]
+        return result
+
+    def is_ready(self):
+        return self.model is not None
+
+    def predict_windows(self, windows, batch=32):
+        return self.model.predict(windows, batch_size=batch)
+
+    # The convolutional engine predicts whole chunks at once, the sliding one goes through Separator.iter_predictions.
+    # The convolutional engine isn't in the config, since how much its output differs depends on the trained weights
+    # and can't be bounded. It's only used when asked for, by compare_engines and benchmark.py.
+    def iter_predictions(self, mixture, batch=32, engine=None):
+        if engine != "convolutional":
+            yield from super(Model, self).iter_predictions(mixture, batch)
+            return
+        length = self.config.getint("song", "sample_length")
+        chunk_size = self.config.getint("separate", "chunk_size")
+        if self.convolutional_model is None:
+            self.build_convolutional()
+        for start, block in mixture.iter_chunks(length, chunk_size if chunk_size > 0 else max(mixture.amplitude.shape[1], 1)):
+            self.logger.debug("Predicting frames %i-%i...", start, start + block.shape[1] - 2 * (length // 2))
+            with profiler.stage("predict"):
+                yield start, self.predict_block(block)
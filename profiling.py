@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+
+# Returns the current resident set size in megabytes. Falls back to the peak RSS where /proc isn't available.
+def get_rss():
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (IOError, OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 if sys.platform != "darwin" else peak / (1024 * 1024)
+
+# Returned when profiling is disabled so that timing a stage costs next to nothing
+class NullStage:
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+NULL_STAGE = NullStage()
+
+class Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.tracemalloc is True:
+            import tracemalloc
+            self.allocated = tracemalloc.get_traced_memory()[0]
+        self.rss = get_rss()
+        self.cpu = time.process_time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.perf_counter() - self.started
+        record = {
+            "stage": self.name,
+            "start": self.started - self.profiler.started,
+            "wall": wall,
+            "cpu": time.process_time() - self.cpu,
+            "rss_delta": get_rss() - self.rss,
+            "pid": os.getpid(),
+            "tid": threading.get_ident()
+        }
+        if self.profiler.tracemalloc is True:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            record["allocated_delta"] = (current - self.allocated) / (1024 * 1024)
+            record["allocated_peak"] = peak / (1024 * 1024)
+        self.profiler.records.append(record)
+        return False
+
+# Profiler: Records the wall time, CPU time and memory change of each stage of the pipeline (decode, resample, stft,
+# windowing, predict, mask, istft, write) and exports them as JSON lines or as a Chrome trace (chrome://tracing).
+# Disabled by default, in which case stages aren't recorded at all.
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.tracemalloc = False
+        self.cprofile = None
+        self.output = "profile"
+        self.format = "jsonl"
+        self.records = []
+        self.started = time.perf_counter()
+
+    def configure(self, config, enabled=None):
+        self.enabled = config.getboolean("profiling", "enabled") if enabled is None else enabled
+        if self.enabled is False:
+            return
+        self.output = config.get("profiling", "output")
+        self.format = config.get("profiling", "format")
+        if config.getboolean("profiling", "tracemalloc"):
+            import tracemalloc
+            tracemalloc.start()
+            self.tracemalloc = True
+        if config.getboolean("profiling", "cprofile"):
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        atexit.register(self.save)
+
+    def stage(self, name):
+        if self.enabled is False:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def save(self):
+        if self.enabled is False:
+            return
+        if self.format == "chrome":
+            filename = self.output + ".json"
+            events = [{
+                "name": record["stage"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": record["start"] * 1000000,
+                "dur": record["wall"] * 1000000,
+                "pid": record["pid"],
+                "tid": record["tid"],
+                "args": {key: value for key, value in record.items() if key not in ("stage", "start", "wall", "pid", "tid")}
+            } for record in self.records]
+            with open(filename, 'w') as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        else:
+            filename = self.output + ".jsonl"
+            with open(filename, 'w') as f:
+                for record in self.records:
+                    f.write(json.dumps(record) + "\n")
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.output + ".prof")
+        # Only save once, even if save is called before the script exits
+        self.enabled = False
+
+profiler = Profiler()
@@ -0,0 +1,214 @@
+# Separation of live audio. Audio comes in as blocks of 16-bit mono PCM samples (at the configured sample rate) and the
+# separated stem goes out the same way, delayed by the lookahead and a window of the STFT.
+import sys
+import time
+import socket
+import collections
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy.signal import get_window
+from stream import StreamingISTFT
+from mask import get_masks
+from audio import read_audio, resample, AudioWriter
+
+# StreamingSTFT: Computes the STFT of a signal a block at a time. The frames are the same as librosa.stft's, except
+# that the start of the signal is padded with zeros instead of being reflected, since the future isn't known yet.
+class StreamingSTFT:
+    def __init__(self, window_size=1024, hop_length=256):
+        self.window_size = window_size
+        self.hop_length = hop_length
+        self.window = get_window("hann", window_size, fftbins=True).astype(np.float32)
+        self.buffer = np.zeros(window_size // 2, dtype=np.float32)
+
+    # Returns the columns of all frames that are complete
+    def push(self, samples):
+        self.buffer = np.concatenate((self.buffer, samples.astype(np.float32, copy=False)))
+        if len(self.buffer) < self.window_size:
+            return np.zeros((self.window_size // 2 + 1, 0), dtype=np.complex64)
+        count = 1 + (len(self.buffer) - self.window_size) // self.hop_length
+        frames = as_strided(self.buffer, shape=(count, self.window_size), strides=(self.buffer.strides[0] * self.hop_length, self.buffer.strides[0]), writeable=False)
+        columns = np.fft.rfft(frames * self.window, axis=1).T.astype(np.complex64)
+        self.buffer = self.buffer[count * self.hop_length:]
+        return columns
+
+    # Pads the end like the start, so that the last samples get frames of their own
+    def flush(self):
+        return self.push(np.zeros(self.window_size // 2, dtype=np.float32))
+
+# RingBuffer: Keeps the last few columns of the amplitude
+class RingBuffer:
+    def __init__(self, height, size, dtype=np.float32):
+        self.data = np.zeros((height, size), dtype=dtype)
+        self.size = size
+        self.position = 0
+        self.count = 0
+
+    def append(self, column):
+        self.data[:, self.position] = column
+        self.position = (self.position + 1) % self.size
+        self.count += 1
+
+    # The columns in the order they were added, oldest first. Columns that haven't been added yet are zeros.
+    def get(self):
+        return np.roll(self.data, -self.position, axis=1)
+
+# RealtimeSeparator: Predicts the mask of each frame as soon as the frames it looks ahead at have arrived. The window
+# for a frame is the same as when separating a whole file, except that the frames past the lookahead are zeros.
+class RealtimeSeparator:
+    def __init__(self, logger, config, separator):
+        self.logger = logger
+        self.config = config
+        self.separator = separator
+        self.half = config.getint("song", "sample_length") // 2
+        self.lookahead = min(max(config.getint("realtime", "lookahead"), 0), self.half)
+        self.stem = config.get("realtime", "stem")
+        self.dtype = config.get("song", "dtype")
+        bins = config.getint("song", "window_size") // 2 + 1
+        self.stft = StreamingSTFT(config.getint("song", "window_size"), config.getint("song", "hop_length"))
+        self.istft = StreamingISTFT(config.getint("song", "window_size"), config.getint("song", "hop_length"))
+        self.amplitudes = RingBuffer(bins, self.half + self.lookahead + 1, np.float32)
+        self.columns = collections.deque() # Columns of the spectrogram waiting for their mask
+        self.peak = -np.inf
+        self.received = 0
+        self.returned = 0
+        self.block_times = []
+        self.delays = []
+
+    # Same as librosa.power_to_db with top_db=80, except that the peak is the loudest bin so far instead of the loudest one in the song
+    def power_to_db(self, columns):
+        amplitude = 10 * np.log10(np.maximum(np.abs(columns) ** 2, 1e-10))
+        if amplitude.size > 0:
+            self.peak = max(self.peak, float(np.max(amplitude)))
+        return np.maximum(amplitude, self.peak - 80).astype(self.dtype, copy=False)
+
+    # Takes new spectrogram columns and returns the audio of the frames whose masks could be predicted
+    def process_columns(self, columns, final=False):
+        windows = []
+        for column, amplitude in zip(columns.T, self.power_to_db(columns).T):
+            self.amplitudes.append(amplitude)
+            self.columns.append(column)
+            if len(self.columns) > self.lookahead:
+                windows.append(self.get_window())
+        # At the end the remaining frames are predicted without any frames after them. If the stream was shorter than
+        # the lookahead, the first frame still needs the frames up to the lookahead after it before its window is centred.
+        if final is True:
+            pending = len(self.columns) - len(windows)
+            for _ in range(0, self.lookahead - pending):
+                self.amplitudes.append(np.zeros(self.amplitudes.data.shape[0], dtype=np.float32))
+            for _ in range(0, pending):
+                self.amplitudes.append(np.zeros(self.amplitudes.data.shape[0], dtype=np.float32))
+                windows.append(self.get_window())
+        if len(windows) == 0:
+            return self.istft.push(np.zeros((columns.shape[0], 0), dtype=np.complex64))
+        windows = np.stack(windows)
+        probabilities = np.transpose(self.separator.predict_windows(windows.reshape(windows.shape + (1,)), self.config.getint("realtime", "batch")))
+        vocals, accompaniment = get_masks(self.logger, probabilities, self.config.get("separate", "mask_type"), self.config.getfloat("separate", "mask_threshold"), self.stem == "accompaniment")
+        masked = np.stack([self.columns.popleft() for _ in range(0, len(windows))], axis=1) * (accompaniment if self.stem == "accompaniment" else vocals)
+        return self.istft.push(masked)
+
+    # The frames before the newest ones, up to half a window back, followed by zeros in place of the frames that haven't arrived yet
+    def get_window(self):
+        window = np.zeros((self.amplitudes.data.shape[0], 2 * self.half + 1), dtype=self.dtype)
+        window[:, : self.half + self.lookahead + 1] = self.amplitudes.get()
+        return window
+
+    # Takes a block of samples and returns the separated samples that are ready
+    def process(self, samples):
+        started = time.perf_counter()
+        self.received += len(samples)
+        output = self.process_columns(self.stft.push(samples))
+        self.returned += len(output)
+        self.block_times.append(time.perf_counter() - started)
+        self.delays.append(self.received - self.returned)
+        return output
+
+    # Returns the rest of the output once the input has ended, so that it's exactly as long as the input
+    def flush(self):
+        output = self.process_columns(self.stft.flush(), final=True)
+        self.istft.length = self.received
+        output = np.concatenate((output, self.istft.flush()))[: max(self.received - self.returned, 0)]
+        self.returned += len(output)
+        return output
+
+    # Processing time of each block and how far the output is behind the input
+    def get_statistics(self):
+        sample_size = self.config.getint("song", "sample_size")
+        block_times = np.array(self.block_times) * 1000 if len(self.block_times) > 0 else np.zeros(1)
+        delays = np.array(self.delays) / sample_size * 1000 if len(self.delays) > 0 else np.zeros(1)
+        return {
+            "blocks": len(self.block_times),
+            "block_ms_mean": float(np.mean(block_times)),
+            "block_ms_p95": float(np.percentile(block_times, 95)),
+            "block_ms_max": float(np.max(block_times)),
+            "latency_ms_mean": float(np.mean(delays)),
+            "latency_ms_max": float(np.max(delays)),
+            # Fraction of the real time that the processing takes, has to stay below 1 to keep up
+            "realtime_factor": float(np.sum(block_times) / 1000 / max(self.received / sample_size, 1e-9))
+        }
+
+    def log_statistics(self):
+        statistics = self.get_statistics()
+        self.logger.info("%i blocks: %.2f ms per block on average (p95 %.2f ms, max %.2f ms), output %.1f ms behind the input on average (max %.1f ms), real-time factor %.3f.",
+            statistics["blocks"], statistics["block_ms_mean"], statistics["block_ms_p95"], statistics["block_ms_max"], statistics["latency_ms_mean"], statistics["latency_ms_max"], statistics["realtime_factor"])
+        return statistics
+
+# Reads blocks of 16-bit PCM from input_stream and writes the separated stem to output_stream until the input ends
+def run_stream(realtime, read, write, block_size):
+    remainder = b''
+    while True:
+        data = read(block_size * 2 - len(remainder))
+        if not data:
+            break
+        data = remainder + data
+        # A block can end in the middle of a sample
+        usable = len(data) - len(data) % 2
+        remainder = data[usable:]
+        samples = np.frombuffer(data[:usable], dtype='<i2').astype(np.float32) / 32768
+        write(to_pcm(realtime.process(samples)))
+    write(to_pcm(realtime.flush()))
+
+def to_pcm(samples):
+    return (np.clip(samples, -1, 32767 / 32768) * 32768).astype('<i2').tobytes()
+
+# Separate stdin to stdout, or every connection to a TCP socket (one at a time) back to the same connection
+def serve_realtime(logger, config, separator):
+    block_size = config.getint("realtime", "block_size")
+    if config.get("realtime", "input") == "stdin":
+        realtime = RealtimeSeparator(logger, config, separator)
+        run_stream(realtime, sys.stdin.buffer.read, lambda data: (sys.stdout.buffer.write(data), sys.stdout.buffer.flush()), block_size)
+        realtime.log_statistics()
+        return
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((config.get("realtime", "host"), config.getint("realtime", "port")))
+    server.listen(1)
+    logger.info("Listening on %s:%i.", config.get("realtime", "host"), config.getint("realtime", "port"))
+    try:
+        while True:
+            connection, address = server.accept()
+            logger.info("Separating a stream from %s.", address[0])
+            realtime = RealtimeSeparator(logger, config, separator)
+            with connection:
+                try:
+                    run_stream(realtime, connection.recv, connection.sendall, block_size)
+                except (ConnectionError, OSError) as e:
+                    logger.warning("Connection from %s ended: %s", address[0], e)
+            realtime.log_statistics()
+    except KeyboardInterrupt:
+        logger.info("Shutting down...")
+    finally:
+        server.close()
+
+# Feed a file through the realtime separator block by block, as if it was coming in live, and write the output to
+# a file. Returns the latency statistics.
+def simulate(logger, config, separator, filename, output):
+    data, sample_rate = read_audio(filename)
+    data = resample(data, sample_rate, config.getint("song", "sample_size"), config.get("song", "resampler"))
+    block_size = config.getint("realtime", "block_size")
+    realtime = RealtimeSeparator(logger, config, separator)
+    with AudioWriter(output, config.getint("song", "sample_size"), config.get("separate", "output_subtype")) as writer:
+        for start in range(0, len(data), block_size):
+            writer.write(realtime.process(data[start : start + block_size]))
+        writer.write(realtime.flush())
+    logger.info("Wrote %i samples to %s.", realtime.returned, output)
+    return realtime.log_statistics()
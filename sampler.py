@@ -0,0 +1,113 @@
+# Draws training windows on the fly from the amplitudes of whole songs instead of cutting every song into a fixed set of
+# non-overlapping windows. Windows can start at any frame, and every epoch draws a fixed number of them that is balanced
+# between windows with little and a lot of vocal activity, so mostly silent songs don't make up most of the epoch.
+import sys
+import numpy as np
+from mask import label_mask
+from song import label_offset
+
+# WindowSampler: Keeps the amplitudes of the mixture and the vocals of each song (memory mapped from the feature cache
+# when possible) and where the windows of each level of vocal activity start.
+class WindowSampler:
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+        self.length = config.getint("song", "sample_length")
+        self.offset = label_offset(self.length)
+        self.threshold = config.getfloat("song", "label_threshold")
+        self.dtype = config.get("song", "dtype")
+        self.epoch_size = config.getint("sampler", "epoch_size")
+        self.samples_per_song = config.getint("sampler", "samples_per_song")
+        try:
+            self.edges = np.array(sorted(float(edge) for edge in config.get("sampler", "strata").split(",") if edge.strip() != ""))
+        except ValueError:
+            logger.critical("Invalid sampler strata %s, expected a list of vocal activity ratios such as 0.01,0.1,0.3.", config.get("sampler", "strata"))
+            sys.exit(22)
+        self.names = []
+        self.mixtures = []
+        self.vocals = []
+        # Song index and first frame of every window, for each stratum
+        self.strata = [([], []) for _ in range(0, len(self.edges) + 1)]
+        self.candidates = None
+
+    # The number of windows that can be drawn
+    def __len__(self):
+        return sum(sum(len(starts) for starts in stratum[1]) for stratum in self.strata)
+
+    # The activity of a window is the fraction of bins of its labelled frame that are vocals
+    def add(self, name, mixture, vocals):
+        frames = min(mixture.shape[1], vocals.shape[1])
+        if frames < self.length:
+            self.logger.warning("Song %s is too short, skipping it.", name)
+            return
+        song = len(self.names)
+        self.names.append(name)
+        self.mixtures.append(mixture)
+        self.vocals.append(vocals)
+        activity = label_mask(vocals[:, :frames], self.threshold).mean(axis=0, dtype=np.float32)
+        starts = np.arange(0, frames - self.length + 1, dtype=np.int64)
+        strata = np.digitize(activity[starts + self.offset], self.edges)
+        for stratum in range(0, len(self.strata)):
+            selected = starts[strata == stratum]
+            self.strata[stratum][0].append(np.full(len(selected), song, dtype=np.int32))
+            self.strata[stratum][1].append(selected)
+        self.candidates = None
+
+    def get_candidates(self):
+        if self.candidates is None:
+            self.candidates = [(np.concatenate(songs) if len(songs) > 0 else np.zeros(0, dtype=np.int32), np.concatenate(starts) if len(starts) > 0 else np.zeros(0, dtype=np.int64)) for songs, starts in self.strata]
+        return self.candidates
+
+    def log_strata(self):
+        total = max(len(self), 1)
+        bounds = [0.0] + list(self.edges) + [1.0]
+        for stratum, (songs, _) in enumerate(self.get_candidates()):
+            self.logger.info("%.1f%% of the windows have %.0f-%.0f%% vocal bins.", len(songs) / total * 100, bounds[stratum] * 100, bounds[stratum + 1] * 100)
+
+    # Returns the song and the first frame of the windows of an epoch, which only depend on the seed. Every stratum gets
+    # the same share of the epoch, and strata that don't have enough windows leave the rest of their share to the others.
+    # No song gives more than samples_per_song windows (0 for no limit).
+    def get_epoch(self, seed):
+        random = np.random.RandomState(seed)
+        candidates = sorted(self.get_candidates(), key=lambda candidate: len(candidate[0]))
+        budget = np.full(len(self.names), self.samples_per_song if self.samples_per_song > 0 else self.epoch_size, dtype=np.int64)
+        remaining = self.epoch_size
+        drawn_songs = []
+        drawn_starts = []
+        for number, (songs, starts) in enumerate(candidates):
+            quota = int(np.ceil(remaining / (len(candidates) - number)))
+            order = random.permutation(len(songs))
+            shuffled = songs[order]
+            # Rank of each window among the windows of its song, in the shuffled order
+            grouped = np.argsort(shuffled, kind="stable")
+            first = np.searchsorted(shuffled[grouped], shuffled[grouped])
+            rank = np.empty(len(shuffled), dtype=np.int64)
+            rank[grouped] = np.arange(len(shuffled)) - first
+            selected = order[rank < budget[shuffled]][:quota]
+            np.subtract.at(budget, songs[selected], 1)
+            drawn_songs.append(songs[selected])
+            drawn_starts.append(starts[selected])
+            remaining -= len(selected)
+        if remaining > 0:
+            self.logger.warning("Only %i of the %i windows of the epoch could be drawn, increase samples_per_song or add more songs.", self.epoch_size - remaining, self.epoch_size)
+        order = random.permutation(self.epoch_size - remaining)
+        return np.concatenate(drawn_songs)[order], np.concatenate(drawn_starts)[order]
+
+    # The same non-overlapping windows that are used without the sampler, for validation
+    def get_grid(self):
+        songs = []
+        starts = []
+        for song, mixture in enumerate(self.mixtures):
+            count = min(mixture.shape[1], self.vocals[song].shape[1]) // self.length
+            songs.append(np.full(count, song, dtype=np.int32))
+            starts.append(np.arange(count, dtype=np.int64) * self.length)
+        return np.concatenate(songs), np.concatenate(starts)
+
+    # The windows and labels in the format the network expects
+    def get_windows(self, songs, starts):
+        windows = np.empty((len(songs), self.mixtures[0].shape[0], self.length, 1), dtype=self.dtype)
+        labels = np.empty((len(songs), self.mixtures[0].shape[0]), dtype=np.uint8)
+        for number, (song, start) in enumerate(zip(songs, starts)):
+            windows[number, :, :, 0] = self.mixtures[song][:, start : start + self.length]
+            labels[number] = label_mask(self.vocals[song][:, start + self.offset], self.threshold)
+        return windows, labels
@@ -0,0 +1,99 @@
+import os
+import sys
+import math
+import numpy as np
+from abc import ABC, abstractmethod
+from mask import get_masks
+from stream import SpectrogramWriter
+from profiling import profiler
+
+# Separator: Turns the predictions of a network into vocal and accompaniment files. Doesn't depend on how the
+# network is run, subclasses only have to implement is_ready and predict_windows.
+class Separator(ABC):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+    @abstractmethod
+    def is_ready(self):
+        pass
+
+    # Returns the vocal probabilities of each bin of the middle frame of each window, shaped (windows, bins)
+    @abstractmethod
+    def predict_windows(self, windows, batch=32):
+        pass
+
+    # Yields the index of the first frame and the vocal probabilities of each bin of the next chunk of frames, so that
+    # only a chunk worth of windows is ever in memory. Only subclasses with more than one engine use engine.
+    def iter_predictions(self, mixture, batch=32, engine=None):
+        length = self.config.getint("song", "sample_length")
+        chunk_size = self.config.getint("separate", "chunk_size")
+        if chunk_size <= 0:
+            with profiler.stage("windowing"):
+                split_x = mixture.split_slidingwindow(length)
+                split_x = split_x.reshape(split_x.shape + (1,))
+            with profiler.stage("predict"):
+                yield 0, np.transpose(self.predict_windows(split_x, batch)) # Transpose the mask into the format librosa uses
+            return
+        # Keep the chunks a multiple of the batch size so that the network sees exactly the same batches as it would without chunking
+        chunk_size = int(math.ceil(chunk_size / batch)) * batch
+        for start, split_x in mixture.iter_slidingwindow(length, chunk_size):
+            self.logger.debug("Predicting frames %i-%i...", start, start + len(split_x))
+            with profiler.stage("windowing"):
+                split_x = split_x.reshape(split_x.shape + (1,))
+            with profiler.stage("predict"):
+                yield start, np.transpose(self.predict_windows(split_x, batch))
+
+    # Predict the vocal probability of each time-frequency bin of the song
+    def predict(self, mixture, batch=32, engine=None):
+        prediction = np.empty(mixture.amplitude.shape, dtype=np.float32)
+        for start, chunk in self.iter_predictions(mixture, batch, engine):
+            prediction[:, start : start + chunk.shape[1]] = chunk
+        return prediction
+
+    # The accompaniment is written next to the vocals, with instrumental_ in front of the file name
+    def isolate(self, mixture, output="output.wav", save_accompaniment=True, save_original_mask=False, save_original_probabilities=False):
+        if not self.is_ready():
+            self.logger.critical("Model not set up, cannot attempt to isolate.")
+            sys.exit(4)
+        accompaniment_output = os.path.join(os.path.dirname(output), "instrumental_" + os.path.basename(output))
+        self.logger.info("Extracting vocals from the audio file...")
+        # Dumping the mask and the probabilities needs all of them at once
+        if self.config.getboolean("separate", "streaming") is False or save_original_mask is True or save_original_probabilities is True:
+            prediction = self.predict(mixture)
+            if save_original_probabilities is True:
+                np.savetxt('original_predicted_probabilities.out', prediction)
+            self.logger.info("Calculating the %s mask...", self.config.get("separate", "mask_type"))
+            # Probability to label conversion, as there's no other way to get the output from the network in the right format
+            with profiler.stage("mask"):
+                prediction, accompaniment = get_masks(self.logger, prediction, self.config.get("separate", "mask_type"), self.config.getfloat("separate", "mask_threshold"), save_accompaniment)
+            if save_original_mask is True:
+                np.savetxt('predicted_mask.out', prediction)
+            if save_accompaniment is True:
+                spectrogram_bak = mixture.get_spectrogram()
+                mixture.apply_binary_mask(accompaniment)
+                mixture.reverse_stft()
+                mixture.save_file(accompaniment_output)
+                mixture.set_spectrogram(spectrogram_bak)
+            mixture.apply_binary_mask(prediction)
+            mixture.reverse_stft()
+            mixture.save_file(output)
+            return
+        # Both outputs are written while the network is still going through the song, a chunk of columns at a time
+        writers = [(SpectrogramWriter(self.config, output, mixture.get_length()), 0)]
+        if save_accompaniment is True:
+            writers.append((SpectrogramWriter(self.config, accompaniment_output, mixture.get_length()), 1))
+        try:
+            for start, prediction in self.iter_predictions(mixture):
+                with profiler.stage("mask"):
+                    masks = get_masks(self.logger, prediction, self.config.get("separate", "mask_type"), self.config.getfloat("separate", "mask_threshold"), save_accompaniment)
+                columns = mixture.get_spectrogram()[:, start : start + prediction.shape[1]]
+                for writer, mask in writers:
+                    writer.write(columns * masks[mask])
+        except BaseException:
+            for writer, _ in writers:
+                writer.abort()
+            raise
+        for writer, _ in writers:
+            writer.close()
+        self.logger.info("Saved the vocals to %s.", output)
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import queue
+import tempfile
+import threading
+import socketserver
+import collections
+import numpy as np
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+from song import Song
+from mask import get_masks
+
+# A slice of windows from one request waiting to go through the network
+class PredictionJob:
+    def __init__(self, windows):
+        self.windows = windows
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+# PredictionBatcher: Collects the windows of all requests that are being processed at the same time and
+# passes them to the network in a single predict call. Has to run on the thread that owns the model.
+class PredictionBatcher:
+    def __init__(self, logger, model, max_batch=256, max_wait=0.01):
+        self.logger=logger
+        self.model=model
+        self.max_batch=max_batch
+        self.max_wait=max_wait
+        self.jobs=queue.Queue()
+        self.running=True
+        self.batches=0
+        self.windows=0
+
+    # Called from the request threads, blocks until the prediction is done
+    def predict(self, windows):
+        job = PredictionJob(windows)
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def run(self):
+        while self.running:
+            try:
+                jobs = [self.jobs.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            # Wait a little bit for other requests so that their windows can share the predict call
+            size = len(jobs[0].windows)
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    job = self.jobs.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                jobs.append(job)
+                size += len(job.windows)
+            try:
+                windows = np.concatenate([job.windows for job in jobs])
+                prediction = self.model.predict_windows(windows.reshape(windows.shape + (1,)))
+                start = 0
+                for job in jobs:
+                    job.result = prediction[start : start + len(job.windows)]
+                    start += len(job.windows)
+            except Exception as e:
+                self.logger.error("Prediction failed: %s", e)
+                for job in jobs:
+                    job.error = e
+            self.batches += 1
+            self.windows += size
+            for job in jobs:
+                job.done.set()
+
+    def stop(self):
+        self.running = False
+
+# SeparationService: Everything the HTTP handlers need - the batcher, the request queue and the metrics
+class SeparationService:
+    def __init__(self, logger, config, model):
+        self.logger=logger
+        self.config=config
+        self.batcher=PredictionBatcher(logger, model, config.getint("server", "max_batch"), config.getfloat("server", "max_wait") / 1000)
+        self.slots=threading.BoundedSemaphore(config.getint("server", "max_requests"))
+        self.queue_size=config.getint("server", "queue_size")
+        self.lock=threading.Lock()
+        self.waiting=0
+        self.active=0
+        self.requests=0
+        self.failures=0
+        self.rejected=0
+        self.latencies=collections.deque(maxlen=1000)
+        self.started=time.time()
+
+    # Returns the requested stem as wav data or None if the queue is full
+    def separate(self, data, stem="vocals", extension="wav"):
+        with self.lock:
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return None
+            self.waiting += 1
+        started = time.time()
+        with self.slots:
+            with self.lock:
+                self.waiting -= 1
+                self.active += 1
+            try:
+                result = self.process(data, stem, extension)
+            except Exception:
+                with self.lock:
+                    self.failures += 1
+                raise
+            finally:
+                with self.lock:
+                    self.active -= 1
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(time.time() - started)
+        return result
+
+    def process(self, data, stem, extension):
+        length = self.config.getint("song", "sample_length")
+        chunk_size = self.config.getint("separate", "chunk_size")
+        with tempfile.TemporaryDirectory() as folder:
+            # librosa can only load files from disk
+            filename = os.path.join(folder, "input." + extension)
+            with open(filename, 'wb') as f:
+                f.write(data)
+            song = Song(self.logger, "a request", self.config)
+            song.load_file(filename)
+            song.compute_stft(keep_spectrogram=True)
+            if chunk_size <= 0:
+                chunk_size = max(song.get_amplitude().shape[1], 1)
+            prediction = np.empty(song.get_amplitude().shape, dtype=np.float32)
+            for start, windows in song.iter_slidingwindow(length, chunk_size):
+                prediction[:, start : start + len(windows)] = np.transpose(self.batcher.predict(windows))
+            vocals, accompaniment = get_masks(self.logger, prediction, self.config.get("separate", "mask_type"), self.config.getfloat("separate", "mask_threshold"), stem == "accompaniment")
+            song.apply_binary_mask(accompaniment if stem == "accompaniment" else vocals)
+            song.reverse_stft()
+            output = os.path.join(folder, "output.wav")
+            song.save_file(output)
+            with open(output, 'rb') as f:
+                return f.read()
+
+    def get_metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+            return {
+                "uptime": time.time() - self.started,
+                "requests": self.requests,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "active": self.active,
+                "queued": self.waiting,
+                "latency_mean": float(np.mean(latencies)),
+                "latency_p50": float(np.percentile(latencies, 50)),
+                "latency_p95": float(np.percentile(latencies, 95)),
+                "latency_max": float(np.max(latencies)),
+                "batches": self.batcher.batches,
+                "windows_per_batch": self.batcher.windows / max(self.batcher.batches, 1)
+            }
+
+class RequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif path == "/metrics":
+            self.send_json(200, self.service.get_metrics())
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/separate":
+            self.send_json(404, {"error": "Not found"})
+            return
+        parameters = parse_qs(url.query)
+        stem = parameters.get("stem", ["vocals"])[0]
+        extension = parameters.get("format", ["wav"])[0]
+        if stem not in ("vocals", "accompaniment"):
+            self.send_json(400, {"error": "stem has to be vocals or accompaniment"})
+            return
+        # The format becomes the extension of a temporary file, so it can't contain dots or slashes
+        if not extension.isalnum():
+            self.send_json(400, {"error": "format has to be a file extension such as wav or flac"})
+            return
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if len(data) == 0:
+            self.send_json(400, {"error": "No audio in the request body"})
+            return
+        try:
+            output = self.service.separate(data, stem, extension)
+        except Exception as e:
+            self.service.logger.error("Could not separate a request: %s", e)
+            self.send_json(500, {"error": str(e)})
+            return
+        if output is None:
+            self.send_json(503, {"error": "Too many requests"})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/wav")
+        self.send_header("Content-Length", str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Unix sockets don't have a client address
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        self.service.logger.debug("%s - " + format, self.address_string(), *args)
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# Serve requests on background threads while the batcher uses the model on the calling thread
+def serve(logger, config, model):
+    service = SeparationService(logger, config, model)
+    RequestHandler.service = service
+    socket_path = config.get("server", "socket")
+    if socket_path != "":
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, RequestHandler)
+        logger.info("Listening on %s.", socket_path)
+    else:
+        server = ThreadingHTTPServer((config.get("server", "host"), config.getint("server", "port")), RequestHandler)
+        logger.info("Listening on http://%s:%i.", config.get("server", "host"), config.getint("server", "port"))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        service.batcher.run()
+    except KeyboardInterrupt:
+        logger.info("Shutting down...")
+    finally:
+        server.shutdown()
+        server.server_close()
+        if socket_path != "" and os.path.exists(socket_path):
+            os.remove(socket_path)
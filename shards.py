@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+import collections
+import numpy as np
+
+# ShardStore: Keeps CNN inputs and labels on disk as .npy files (one pair per song) and reads them back through
+# memory maps, so only the windows of the batch that is currently being used have to be in RAM.
+class ShardStore:
+    def __init__(self, logger, folder, max_open=64):
+        self.logger=logger
+        self.folder=folder
+        self.max_open=max_open
+        self.shards=[]
+        self.settings=None
+        self.offsets=np.zeros(1, dtype=np.int64)
+        self.open_shards=collections.OrderedDict()
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.load_index()
+
+    def get_index_path(self):
+        return os.path.join(self.folder, "index.json")
+
+    def load_index(self):
+        if os.path.isfile(self.get_index_path()):
+            with open(self.get_index_path(), 'r') as f:
+                index = json.load(f)
+            self.shards = index["shards"]
+            self.settings = index.get("settings")
+        self.update_offsets()
+
+    def save_index(self):
+        temporary = self.get_index_path() + ".tmp"
+        with open(temporary, 'w') as f:
+            json.dump({"settings": self.settings, "shards": self.shards}, f, indent=1)
+        os.replace(temporary, self.get_index_path())
+
+    def update_offsets(self):
+        self.offsets = np.concatenate(([0], np.cumsum([shard["count"] for shard in self.shards], dtype=np.int64)))
+        self.open_shards.clear()
+
+    # The settings the shards were generated with. If they change, the shards have to be generated again.
+    def set_settings(self, settings):
+        self.settings = settings
+        self.save_index()
+
+    def get_shard_info(self, name):
+        for shard in self.shards:
+            if shard["name"] == name:
+                return shard
+        return None
+
+    # Store the windows and labels of a single song as a new shard. Files describes the audio files it was generated from.
+    def write(self, name, windows, labels, files=None):
+        number = max([shard["number"] for shard in self.shards], default=-1) + 1
+        shard = {
+            "name": name,
+            "number": number,
+            "windows": "%05i-windows.npy" % number,
+            "labels": "%05i-labels.npy" % number,
+            "count": len(windows),
+            "files": files if files is not None else {}
+        }
+        np.save(os.path.join(self.folder, shard["windows"]), windows)
+        np.save(os.path.join(self.folder, shard["labels"]), labels)
+        self.shards.append(shard)
+        self.save_index()
+        self.update_offsets()
+        self.logger.debug("Wrote %i windows of %s to shard %i.", len(windows), name, number)
+
+    def remove(self, name):
+        for shard in [shard for shard in self.shards if shard["name"] == name]:
+            self.logger.debug("Removing shard %i of %s.", shard["number"], name)
+            for file in (shard["windows"], shard["labels"]):
+                if os.path.isfile(os.path.join(self.folder, file)):
+                    os.remove(os.path.join(self.folder, file))
+            self.shards.remove(shard)
+        self.save_index()
+        self.update_offsets()
+
+    def clear(self):
+        self.logger.debug("Clearing shards in %s.", self.folder)
+        self.open_shards.clear()
+        shutil.rmtree(self.folder)
+        os.makedirs(self.folder, exist_ok=True)
+        self.shards = []
+        self.save_index()
+        self.update_offsets()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    # Memory map the shard at the given position, keeping at most max_open of them open at once
+    def get_shard(self, position):
+        if position in self.open_shards:
+            self.open_shards.move_to_end(position)
+        else:
+            if len(self.open_shards) >= self.max_open:
+                self.open_shards.popitem(last=False)
+            shard = self.shards[position]
+            self.open_shards[position] = (
+                np.load(os.path.join(self.folder, shard["windows"]), mmap_mode='r'),
+                np.load(os.path.join(self.folder, shard["labels"]), mmap_mode='r')
+            )
+        return self.open_shards[position]
+
+    # Gather the windows and labels with the given (global) indices. Sorted indices give the best disk access pattern.
+    def get(self, indices):
+        indices = np.asarray(indices)
+        positions = np.searchsorted(self.offsets, indices, side='right') - 1
+        windows, labels = self.get_shard(int(positions[0]))
+        batch_windows = np.empty((len(indices),) + windows.shape[1:], dtype=windows.dtype)
+        batch_labels = np.empty((len(indices),) + labels.shape[1:], dtype=labels.dtype)
+        for position in np.unique(positions):
+            selection = positions == position
+            windows, labels = self.get_shard(int(position))
+            local = indices[selection] - self.offsets[position]
+            batch_windows[selection] = windows[local]
+            batch_labels[selection] = labels[local]
+        return batch_windows, batch_labels
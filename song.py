@@ -1,10 +1,17 @@
-import librosa
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from profiling import profiler
+from audio import read_audio, resample, get_length
+from mask import label_mask
 import math
 import os
+import sys
+
+# The frame of a window whose bins are labelled, the network gets the frames around it for context
+def label_offset(length):
+    return math.ceil(length/2) if length > 1 else 0
 
 # Song: Holds an information about a particular sound file and functions for modifying the raw sound data
-# TODO: To decrease memory usage don't maintain all this data in RAM. Simply generate stfts, export them to a file and reuse them in the future.
 class Song:
     def __init__(self, logger, name, config):
         self.logger=logger
@@ -13,19 +20,59 @@ class Song:
         self.type=None
         self.amplitude=None
         self.spectrogram=None
+        self.length=None # Number of samples in the loaded audio, so that the output can be exactly as long
 
     # Load a file and resample it if necessary. This is a good idea if the data is inconsistent or has more samples than we need (22kHz is more than enough)
-    # Resampling is really slow though. You're better off resampling your audio manually beforehand.
+    # Resampling still takes a while though. Run the normalize mode on your dataset once to avoid it entirely.
     def load_file(self, filename):
         self.type=os.path.splitext(os.path.basename(filename))[0]
         self.logger.debug("Loading file %s of type %s", filename, self.type)
-        self.data, _ = librosa.load(filename, sr=self.config.getint("song", "sample_size"), mono=True)
+        with profiler.stage("decode"):
+            self.data, sample_rate = read_audio(filename)
+        if sample_rate != self.config.getint("song", "sample_size"):
+            with profiler.stage("resample"):
+                self.data = resample(self.data, sample_rate, self.config.getint("song", "sample_size"), self.config.get("song", "resampler"))
+        self.length = len(self.data)
         self.logger.debug("File loaded.")
 
+    # Get the amplitude (and the spectrogram if requested) of a file. If a feature cache is given, the decoding
+    # and the STFT are skipped entirely when the file has been processed before with the same settings.
+    # If the cache also keeps decoded audio, only the STFT is computed again when just the STFT settings have changed.
+    def load_features(self, filename, cache=None, keep_spectrogram=False):
+        self.type=os.path.splitext(os.path.basename(filename))[0]
+        key = None
+        if cache is not None:
+            file_hash = cache.get_file_hash(filename)
+            key = cache.get_key(filename, file_hash)
+            entry = cache.get(key, keep_spectrogram)
+            if entry is not None:
+                self.amplitude, spectrogram = entry
+                if keep_spectrogram is True:
+                    self.spectrogram = spectrogram
+                self.data = None
+                self.length = get_length(filename, self.config.getint("song", "sample_size"))
+                return
+            if self.config.getboolean("cache", "audio"):
+                audio_key = cache.get_audio_key(filename, file_hash)
+                self.data = cache.get_audio(audio_key)
+                if self.data is None:
+                    self.load_file(filename)
+                    cache.put_audio(audio_key, self.data)
+                self.length = len(self.data)
+            else:
+                self.load_file(filename)
+        else:
+            self.load_file(filename)
+        self.compute_stft(keep_spectrogram=keep_spectrogram)
+        if cache is not None:
+            cache.put(key, self.amplitude, self.spectrogram if keep_spectrogram is True else None)
+
     def save_file(self, filename):
         #TODO: Don't save as a 32bit float since librosa can't load it afterwards
         self.logger.info("Saving audio data to %s", filename)
-        librosa.output.write_wav(filename, self.data, self.config.getint("song", "sample_size"), norm=True)
+        import librosa
+        with profiler.stage("write"):
+            librosa.output.write_wav(filename, self.data, self.config.getint("song", "sample_size"), norm=True)
 
     def dump_amplitude(self, note=""):
         if self.amplitude is not None:
@@ -40,6 +87,16 @@ class Song:
     def set_spectrogram(self, spectrogram):
         self.spectrogram = spectrogram
 
+    def get_amplitude(self):
+        return self.amplitude
+    def set_amplitude(self, amplitude):
+        self.amplitude = amplitude
+
+    def get_length(self):
+        return self.length
+    def set_length(self, length):
+        self.length = length
+
     def get_name(self):
         return self.name
     def get_raw_data(self):
@@ -49,8 +106,11 @@ class Song:
     def compute_stft(self, keep_spectrogram=False, keep_data=False):
         if self.data is not None:
             self.logger.debug("Generating sftf for %s", self.name)
-            spectrogram = librosa.stft(self.data, self.config.getint("song", "window_size"), hop_length=self.config.getint("song", "hop_length"))
-            self.amplitude = librosa.power_to_db(np.abs(spectrogram)**2)
+            import librosa # Only imported when it's needed, since it takes a while to import
+            with profiler.stage("stft"):
+                spectrogram = librosa.stft(self.data, self.config.getint("song", "window_size"), hop_length=self.config.getint("song", "hop_length"), dtype=np.complex64)
+                # The amplitudes are stored as float32 (or float16 to halve the memory used), the network doesn't need more precision
+                self.amplitude = librosa.power_to_db(np.abs(spectrogram)**2).astype(self.config.get("song", "dtype"), copy=False)
             if keep_spectrogram is True:
                 self.spectrogram = spectrogram
             self.data = None
@@ -66,46 +126,55 @@ class Song:
         # Each time entry corresponds to hop_size/sample_rate (i.e. 5ms @ 44100 Hz with hop size 256)
         # We only need to predict the middle bin, the rest are there for context
         # FIXME: This loses a few ms of data from the input audio since it rounds down.
-        # TODO: Save the spectrogram data to a file to avoid needing to generate and store it in RAM it every time
-        slices = []
-        for x in range (0, self.amplitude.shape[1] // length):
-            _slice = self.amplitude[:,x * length : (x + 1) * length]
-            slices.append(_slice)
-        return slices
+        # The slices are a strided view of the amplitude, so no data is copied here.
+        count = self.amplitude.shape[1] // length
+        row_stride, column_stride = self.amplitude.strides
+        return as_strided(self.amplitude, shape=(count, self.amplitude.shape[0], length), strides=(length * column_stride, row_stride, column_stride), writeable=False)
 
     def split_slidingwindow(self, length=25):
         # Similar to the previous function but we create a sliding window for each
         # bin. We do this only when predicting for a real song because of the memory requirements.
-        height = self.amplitude.shape[0]
-        # Pad the dataset
-        amplitude = self.amplitude
-        amplitude = np.column_stack((np.zeros((height, math.floor(length/2))), amplitude))
-        amplitude = np.column_stack((amplitude, np.zeros((height, math.floor(length/2)))))
-        slices = []
-        for x in range(math.floor(length/2), amplitude.shape[1] - math.floor(length/2)):
-            length_before = x - math.floor(length/2)
-            length_after = x + math.floor(length/2)
-            slices.append(np.array(amplitude[:, length_before : (length_after + 1)]))
-        return slices
+        # The padded amplitude is the only copy that is made, each window is a view into it.
+        height, frames = self.amplitude.shape
+        half = math.floor(length/2)
+        amplitude = np.zeros((height, frames + 2 * half), dtype=self.amplitude.dtype)
+        amplitude[:, half : half + frames] = self.amplitude
+        row_stride, column_stride = amplitude.strides
+        return as_strided(amplitude, shape=(frames, height, 2 * half + 1), strides=(column_stride, row_stride, column_stride), writeable=False)
+
+    # Splits the amplitude into blocks of chunk_size frames, each padded with the half a window of context on both sides
+    # that the frames at its edges need. Yields the index of the first frame and the block.
+    def iter_chunks(self, length=25, chunk_size=512):
+        height, frames = self.amplitude.shape
+        half = math.floor(length/2)
+        for start in range(0, frames, chunk_size):
+            end = min(start + chunk_size, frames)
+            # Column 0 of the block is the frame (start - half). Anything outside of the song stays zero, same as the padding in split_slidingwindow
+            amplitude = np.zeros((height, end - start + 2 * half), dtype=self.amplitude.dtype)
+            first = max(start - half, 0)
+            last = min(end + half, frames)
+            amplitude[:, first - (start - half) : last - (start - half)] = self.amplitude[:, first:last]
+            yield start, amplitude
+
+    # Same windows as split_slidingwindow, but generated chunk_size frames at a time so that the memory
+    # used doesn't depend on the length of the song. Yields the index of the first frame and the windows.
+    def iter_slidingwindow(self, length=25, chunk_size=512):
+        half = math.floor(length/2)
+        for start, amplitude in self.iter_chunks(length, chunk_size):
+            row_stride, column_stride = amplitude.strides
+            yield start, as_strided(amplitude, shape=(amplitude.shape[1] - 2 * half, amplitude.shape[0], 2 * half + 1), strides=(column_stride, row_stride, column_stride), writeable=False)
 
     def get_labels(self, length=25):
         # The labels contain the value of the middle slice of each time container
         # in each frequency. The network understands which slice to target eventually.
         # TODO: Maybe generate binary masks with librosa's softmask instead?
-        slices = []
-        for x in range(0, self.amplitude.shape[1] // length):
-            _slice = []
-            for y in range(0, self.amplitude.shape[0]):
-                # Mark whether there's voice acitivity in the given freq. in the given time bin
-                # The vocals might actually have some activity that equal silence but isn't a 0 in the original mix
-                # so we have to filter these out accordingly.
-                # NOTE: This _might_ clean out whispering and such. Test with your data set.
-                if self.amplitude[y,x*length+(math.ceil(length/2) if length > 1 else 0)] > 1:
-                    _slice.append(1)
-                else:
-                    _slice.append(0)
-            slices.append(_slice)
-        return slices
+        # Mark whether there's voice acitivity in the given freq. in the given time bin
+        # The vocals might actually have some activity that equal silence but isn't a 0 in the original mix
+        # so we have to filter these out accordingly.
+        # NOTE: This _might_ clean out whispering and such. Test with your data set.
+        count = self.amplitude.shape[1] // length
+        columns = np.arange(count) * length + label_offset(length)
+        return label_mask(self.amplitude[:, columns], self.config.getfloat("song", "label_threshold")).T
 
     # Apply network predictions and get useable output
     def apply_binary_mask(self, mask):
@@ -113,7 +182,10 @@ class Song:
 
     def reverse_stft(self):
         if self.amplitude is not None:
-            self.data = librosa.istft(self.spectrogram, self.config.getint("song", "hop_length"), self.config.getint("song", "window_size"))
+            import librosa
+            with profiler.stage("istft"):
+                # Without the length the last (up to hop_length - 1) samples of the song would be lost
+                self.data = librosa.istft(self.spectrogram, self.config.getint("song", "hop_length"), self.config.getint("song", "window_size"), length=self.length)
         else:
             self.logger.critical("Cannot find a STFT spectrogram to reverse - was it not generated?")
             sys.exit(7)
@@ -0,0 +1,82 @@
+import numpy as np
+from scipy.signal import get_window
+from audio import AudioWriter
+from profiling import profiler
+
+# StreamingISTFT: Inverts a spectrogram a few columns at a time with overlap-add. Gives the same result as
+# librosa.istft (hann window, centered frames), but audio is returned as soon as no later frame can change it, so the
+# whole signal never has to be in memory. If the length of the original signal is given, exactly that many samples are
+# returned, otherwise as many as librosa.istft would return.
+class StreamingISTFT:
+    def __init__(self, window_size=1024, hop_length=256, length=None):
+        self.window_size = window_size
+        self.hop_length = hop_length
+        self.length = length
+        self.window = get_window("hann", window_size, fftbins=True).astype(np.float32)
+        # Samples that later frames will still add to, along with the sum of the squared windows over them
+        self.tail = np.zeros(window_size - hop_length, dtype=np.float32)
+        self.tail_norm = np.zeros(window_size - hop_length, dtype=np.float32)
+        self.trim = window_size // 2 # The frames are centered, so the first half a window is padding
+        self.frames = 0
+        self.returned = 0
+
+    # Takes the next columns of the spectrogram and returns the samples that are complete
+    def push(self, columns):
+        count = columns.shape[1]
+        if count == 0:
+            return np.zeros(0, dtype=np.float32)
+        frames = np.fft.irfft(columns, n=self.window_size, axis=0).astype(np.float32) * self.window[:, np.newaxis]
+        samples = np.zeros((count - 1) * self.hop_length + self.window_size, dtype=np.float32)
+        norm = np.zeros(len(samples), dtype=np.float32)
+        samples[:len(self.tail)] = self.tail
+        norm[:len(self.tail)] = self.tail_norm
+        window_square = self.window ** 2
+        for frame in range(0, count):
+            start = frame * self.hop_length
+            samples[start : start + self.window_size] += frames[:, frame]
+            norm[start : start + self.window_size] += window_square
+        self.frames += count
+        complete = count * self.hop_length
+        self.tail = samples[complete:]
+        self.tail_norm = norm[complete:]
+        return self.emit(samples[:complete], norm[:complete])
+
+    # Returns the rest of the signal, padded with silence if it's shorter than the original
+    def flush(self):
+        if self.length is None:
+            self.length = max(self.frames - 1, 0) * self.hop_length
+        samples = self.emit(self.tail, self.tail_norm)
+        if self.returned < self.length:
+            samples = np.concatenate((samples, np.zeros(self.length - self.returned, dtype=np.float32)))
+            self.returned = self.length
+        return samples
+
+    def emit(self, samples, norm):
+        samples = np.where(norm > np.finfo(np.float32).tiny, samples / np.maximum(norm, np.finfo(np.float32).tiny), samples)
+        if self.trim > 0:
+            trimmed = min(self.trim, len(samples))
+            samples = samples[trimmed:]
+            self.trim -= trimmed
+        if self.length is not None:
+            samples = samples[:max(self.length - self.returned, 0)]
+        self.returned += len(samples)
+        return samples
+
+# SpectrogramWriter: Inverts masked spectrogram columns as they come in and appends the audio to a wav file
+class SpectrogramWriter:
+    def __init__(self, config, filename, length=None):
+        self.istft = StreamingISTFT(config.getint("song", "window_size"), config.getint("song", "hop_length"), length)
+        self.writer = AudioWriter(filename, config.getint("song", "sample_size"), config.get("separate", "output_subtype"))
+
+    def write(self, columns):
+        with profiler.stage("istft"):
+            samples = self.istft.push(columns)
+        with profiler.stage("write"):
+            self.writer.write(samples)
+
+    def close(self):
+        self.writer.write(self.istft.flush())
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
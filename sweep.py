@@ -0,0 +1,179 @@
+# Hyperparameter sweeps. Every trial trains a network with its own combination of settings, on a process of its own,
+# and is evaluated on a set of songs. Trials share the feature cache: the audio is only decoded once, the STFT is only
+# computed again for trials whose STFT settings haven't been seen yet, and trials that only change sample_length
+# window the cached amplitudes without touching the audio at all.
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import itertools
+import multiprocessing
+import numpy as np
+from config import config_to_dict, config_from_dict
+
+# Settings that change the contents of the feature cache
+STFT_SETTINGS = ("sample_size", "window_size", "hop_length", "resampler", "dtype")
+METRICS = ("vocals_sdr", "vocals_sir", "vocals_sar", "accompaniment_sdr", "accompaniment_sir", "accompaniment_sar")
+
+# Parses "song.window_size=512,1024; song.hop_length=256,512" into [("song", "window_size", ["512", "1024"]), ...]
+def parse_parameters(logger, config, spec):
+    parameters = []
+    for entry in filter(lambda e: e.strip() != "", spec.split(";")):
+        name, _, values = entry.partition("=")
+        section, _, option = name.strip().partition(".")
+        values = [value.strip() for value in values.split(",") if value.strip() != ""]
+        if not config.has_option(section, option) or len(values) == 0:
+            logger.critical("Invalid sweep parameter %s, expected section.option=value,value,...", entry.strip())
+            sys.exit(21)
+        parameters.append((section, option, values))
+    if len(parameters) == 0:
+        logger.critical("No parameters to sweep over, set them in the sweep section of the config.")
+        sys.exit(21)
+    return parameters
+
+# Every combination of the values for grid search, or a random subset of them (without repeats) for random search
+def get_trials(logger, config):
+    parameters = parse_parameters(logger, config, config.get("sweep", "parameters"))
+    names = ["%s.%s" % (section, option) for section, option, _ in parameters]
+    grid = [dict(zip(names, values)) for values in itertools.product(*[values for _, _, values in parameters])]
+    search = config.get("sweep", "search")
+    if search == "random":
+        order = np.random.RandomState(config.getint("sweep", "seed")).permutation(len(grid))
+        grid = [grid[index] for index in order[: config.getint("sweep", "trials")]]
+    elif search != "grid":
+        logger.critical("Unknown search type %s.", search)
+        sys.exit(21)
+    return names, grid
+
+# The config of a trial. Paths are made absolute because each trial runs in its own folder, and the workers are
+# limited to one since trials already run on a pool of their own (and pool workers can't start pools).
+def get_trial_config(config, parameters):
+    trial = config_from_dict(config_to_dict(config))
+    for name, value in parameters.items():
+        section, _, option = name.partition(".")
+        trial.set(section, option, value)
+    trial.set("cache", "enabled", "true")
+    trial.set("cache", "audio", "true")
+    trial.set("cache", "directory", os.path.abspath(config.get("cache", "directory")))
+    trial.set("evaluation", "cache_directory", os.path.abspath(config.get("evaluation", "cache_directory")))
+    trial.set("dataset", "workers", "1")
+    trial.set("evaluation", "workers", "1")
+    return trial
+
+# Runs in a worker process - trains and evaluates a network in the trial's folder
+def run_trial(task):
+    number, parameters, config_values, datadir, validationdir, evaluationdir, folder = task
+    config = config_from_dict(config_values)
+    os.makedirs(folder, exist_ok=True)
+    os.chdir(folder)
+    logging.basicConfig(filename="trial.log", level=logging.getLevelName(config.get('logging', 'loglevel')), format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+    result = {"trial": number, "status": "ok", "error": ""}
+    result.update(parameters)
+    try:
+        from dataset import Dataset
+        from model import Model
+        from evaluate import compare_separators
+        started = time.time()
+        dataset = Dataset(logging, config)
+        validation_set = Dataset(logging, config)
+        if config.get("dataset", "storage") == "shards":
+            dataset.build_shards(datadir, os.path.join(config.get("dataset", "shard_directory"), "train"))
+            validation_set.build_shards(validationdir, os.path.join(config.get("dataset", "shard_directory"), "validation"))
+            samples = len(dataset.store)
+        elif config.get("dataset", "storage") == "sampler":
+            dataset.load_sampler(datadir)
+            validation_set.load_sampler(validationdir)
+            samples = config.getint("sampler", "epoch_size")
+        else:
+            for data in (dataset, validation_set):
+                data.load(datadir if data is dataset else validationdir)
+                data.get_data_for_cnn()
+                data.get_labels_for_cnn()
+            samples = len(dataset.mixture_windows)
+        result["load_time"] = time.time() - started
+        model = Model(logging, config, dataset, validation_set)
+        model.build()
+        epochs = config.getint("sweep", "epochs")
+        started = time.time()
+        model.train(epochs, save_log=True, log_name="history.csv")
+        result["train_time"] = time.time() - started
+        result["samples"] = samples
+        result["samples_per_second"] = samples * epochs / max(result["train_time"], 1e-6)
+        model.save("network.weights")
+        if evaluationdir != "":
+            report = compare_separators(logging, config, [("trial", model)], evaluationdir)["trial"]
+            for metric in METRICS:
+                source, _, name = metric.partition("_")
+                result[metric] = report[source][name]
+    # sys.exit has to be caught as well, otherwise the pool would wait for the result forever
+    except (Exception, SystemExit) as e:
+        logging.exception("Trial %i failed.", number)
+        result["status"] = "failed"
+        result["error"] = repr(e)
+    return result
+
+# Sweeper: Runs the trials of a sweep and collects their results into a table
+class Sweeper:
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+        self.folder = os.path.abspath(config.get("sweep", "directory"))
+        self.names, self.trials = get_trials(logger, config)
+        self.results = []
+
+    # Decodes the songs and computes the amplitudes for every distinct STFT setting before the trials start, so that
+    # trials running at the same time don't decode the same files. Only the first setting has to decode the audio.
+    def prewarm(self, folders):
+        from dataset import Dataset
+        settings = []
+        for parameters in self.trials:
+            config = get_trial_config(self.config, parameters)
+            config.set("dataset", "workers", self.config.get("dataset", "workers"))
+            setting = tuple(config.get("song", key) for key in STFT_SETTINGS)
+            if setting in settings:
+                continue
+            settings.append(setting)
+            self.logger.info("Caching the features for %s...", ", ".join("%s=%s" % pair for pair in zip(STFT_SETTINGS, setting)))
+            dataset = Dataset(self.logger, config)
+            for folder in folders:
+                for _ in dataset.load_songs(dataset.find_songs(folder)):
+                    pass
+        self.logger.info("%i trials share %i STFT settings.", len(self.trials), len(settings))
+
+    def run(self, datadir, validationdir):
+        datadir = os.path.abspath(datadir)
+        validationdir = os.path.abspath(validationdir)
+        evaluationdir = self.config.get("sweep", "evaluation_directory")
+        evaluationdir = os.path.abspath(evaluationdir) if evaluationdir != "" else ""
+        self.prewarm([datadir, validationdir])
+        workers = self.config.getint("sweep", "workers")
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(self.trials))
+        os.makedirs(self.folder, exist_ok=True)
+        self.logger.info("Running %i trials on %i processes...", len(self.trials), workers)
+        tasks = [(number, parameters, config_to_dict(get_trial_config(self.config, parameters)), datadir, validationdir, evaluationdir, os.path.join(self.folder, "trial_%03i" % number)) for number, parameters in enumerate(self.trials)]
+        # Every trial gets a fresh process, so that the memory used by tensorflow is freed when it's done
+        with multiprocessing.get_context("spawn").Pool(workers, maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(run_trial, tasks):
+                if result["status"] == "ok":
+                    self.logger.info("Trial %i finished: trained in %.1f s (%.1f samples/s), vocal SDR %s.", result["trial"], result["train_time"], result["samples_per_second"], "%.2f dB" % result["vocals_sdr"] if "vocals_sdr" in result else "not evaluated")
+                else:
+                    self.logger.warning("Trial %i failed: %s. See %s for details.", result["trial"], result["error"], os.path.join(self.folder, "trial_%03i" % result["trial"], "trial.log"))
+                self.results.append(result)
+                # The table is written after every trial so that the results so far aren't lost if the sweep is stopped
+                self.save_results(os.path.join(self.folder, self.config.get("sweep", "results")))
+        return self.results
+
+    # Write a row per trial to <filename>.csv and all of them to <filename>.json
+    def save_results(self, filename):
+        results = sorted(self.results, key=lambda result: result["trial"])
+        columns = ["trial"] + self.names + ["status", "load_time", "train_time", "samples", "samples_per_second"] + list(METRICS) + ["error"]
+        with open(filename + ".csv", 'w') as f:
+            w = csv.DictWriter(f, columns, restval="")
+            w.writeheader()
+            w.writerows(results)
+        with open(filename + ".json", 'w') as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,5 @@
+# The modules live in the root of the repository, next to main.py, and aren't installed as a package
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,38 @@
+import logging
+import pytest
+from config import prepare_config
+from batch import BatchSeparator
+
+@pytest.fixture
+def separator(tmp_path):
+    config = prepare_config(str(tmp_path / "config.ini"))
+    return BatchSeparator(logging, config, None, str(tmp_path / "separated"))
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'')
+
+# Dataset songs are only separated from their mixture, loose files are all separated
+def test_find_tracks(separator, tmp_path):
+    for name in ("mixture.wav", "vocals.wav", "accompaniment.wav", "drums.wav"):
+        touch(tmp_path / "songs" / "dataset" / "song1" / name)
+    touch(tmp_path / "songs" / "album" / "track1.mp3")
+    touch(tmp_path / "songs" / "album" / "track2.wav")
+    tracks = separator.find_tracks(str(tmp_path / "songs"))
+    assert [name for name, _ in tracks] == ["album/track1", "album/track2", "dataset/song1"]
+    assert tracks[2][1].endswith("mixture.wav")
+
+# Files that only differ in their extension keep it in their name, so both are separated into folders of their own
+def test_find_tracks_same_name(separator, tmp_path):
+    touch(tmp_path / "songs" / "album" / "track1.mp3")
+    touch(tmp_path / "songs" / "album" / "track1.wav")
+    touch(tmp_path / "songs" / "album" / "track2.wav")
+    tracks = separator.find_tracks(str(tmp_path / "songs"))
+    assert [name for name, _ in tracks] == ["album/track1.mp3", "album/track1.wav", "album/track2"]
+    assert len(set(separator.get_outputs(name)[0] for name, _ in tracks)) == 3
+
+def test_find_tracks_manifest(separator, tmp_path):
+    touch(tmp_path / "songs" / "track1.wav")
+    manifest = tmp_path / "songs.txt"
+    manifest.write_text("songs/track1.wav\nsongs/./track1.wav\n")
+    assert [name for name, _ in separator.find_tracks(str(manifest))] == ["songs/track1"]
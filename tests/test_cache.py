@@ -0,0 +1,47 @@
+import os
+import logging
+import pytest
+import cache
+from cache import FeatureCache, hash_file
+from config import prepare_config
+
+@pytest.fixture
+def feature_cache(tmp_path):
+    config = prepare_config(str(tmp_path / "config.ini"))
+    config.set("cache", "directory", str(tmp_path / "cache"))
+    return FeatureCache(logging, config)
+
+@pytest.fixture
+def hashes(monkeypatch):
+    hashed = []
+    def counting_hash_file(filename):
+        hashed.append(filename)
+        return hash_file(filename)
+    monkeypatch.setattr(cache, "hash_file", counting_hash_file)
+    return hashed
+
+# Files are only hashed again when their size or modification time changes
+def test_file_hash(feature_cache, hashes, tmp_path):
+    filename = tmp_path / "mixture.wav"
+    filename.write_bytes(b'first')
+    assert feature_cache.get_file_hash(str(filename)) == hash_file(str(filename))
+    assert feature_cache.get_key(str(filename)) == feature_cache.get_key(str(filename))
+    assert len(hashes) == 1
+    filename.write_bytes(b'second')
+    assert feature_cache.get_file_hash(str(filename)) == hash_file(str(filename))
+    assert len(hashes) == 2
+    # Same size, different time
+    filename.write_bytes(b'third!')
+    stat = os.stat(str(filename))
+    os.utime(str(filename), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert feature_cache.get_file_hash(str(filename)) == hash_file(str(filename))
+    assert len(hashes) == 3
+
+def test_purge(feature_cache, hashes, tmp_path):
+    filename = tmp_path / "mixture.wav"
+    filename.write_bytes(b'audio')
+    feature_cache.get_file_hash(str(filename))
+    feature_cache.purge()
+    assert os.listdir(feature_cache.folder) == []
+    feature_cache.get_file_hash(str(filename))
+    assert len(hashes) == 2
@@ -0,0 +1,18 @@
+import os
+from config import prepare_config
+
+def test_write(tmp_path):
+    filename = str(tmp_path / "config.ini")
+    prepare_config(filename)
+    assert os.path.isfile(filename)
+
+# Read-only tools get the defaults without the file being created or changed
+def test_read_only(tmp_path):
+    filename = tmp_path / "config.ini"
+    assert prepare_config(str(filename), write=False).get("song", "window_size") == "1024"
+    assert not filename.exists()
+    filename.write_text("[song]\nwindow_size = 2048\n")
+    config = prepare_config(str(filename), write=False)
+    assert config.get("song", "window_size") == "2048"
+    assert config.get("song", "hop_length") == "256"
+    assert filename.read_text() == "[song]\nwindow_size = 2048\n"
@@ -0,0 +1,149 @@
+# Runs the distributed trainer with two local spawn workers. The network is replaced with a stub whose weights and
+# optimizer state depend on the order of the windows it was trained on, so that the averaging and the order of a
+# resumed run can be checked without tensorflow.
+import pickle
+import logging
+import numpy as np
+import pytest
+import distributed
+from config import prepare_config
+from distributed import DistributedTrainer, WeightBuffer, get_state
+
+WINDOWS = 96
+
+class StubWeights:
+    def get_weights(self):
+        return [np.array(layer) for layer in self.weights]
+
+    def set_weights(self, weights):
+        self.weights = [np.array(layer) for layer in weights]
+
+class StubOptimizer(StubWeights):
+    def __init__(self):
+        self.weights = [np.zeros(2)]
+
+# Stands in for the keras model: every batch moves the weights halfway to the mean of its windows and the optimizer
+# counts the batches and accumulates a decaying sum of their means
+class StubNetwork(StubWeights):
+    def __init__(self):
+        self.weights = [np.zeros(3), np.zeros((2, 2))]
+        self.optimizer = StubOptimizer()
+
+    def _make_train_function(self):
+        pass
+
+    def train_on_batch(self, windows, labels):
+        self.weights = [layer * 0.5 + np.mean(windows) for layer in self.weights]
+        self.optimizer.weights = [self.optimizer.weights[0] * np.array([1.0, 0.5]) + np.array([1.0, np.mean(windows)])]
+        return [float(np.mean(labels)), 0.0]
+
+    def save(self, filename, overwrite=True, include_optimizer=True):
+        with open(filename, 'wb') as f:
+            pickle.dump(get_state(self), f)
+
+class StubModel:
+    def __init__(self):
+        self.model = StubNetwork()
+
+# Window i is filled with i, so the weights show which windows were used
+class StubStore:
+    def __init__(self, folder):
+        self.folder = folder
+
+    def __len__(self):
+        return WINDOWS
+
+    def get(self, indices):
+        return np.array(indices, dtype=np.float64).reshape(-1, 1), np.ones((len(indices), 1))
+
+class StubDataset:
+    def __init__(self, folder):
+        self.store = StubStore(folder)
+
+    def get_reference(self):
+        return {"folder": self.store.folder, "samples": len(self.store)}
+
+# Runs in the worker processes instead of distributed.init_worker
+def init_stub_worker(config_values, folder, threads, buffer_filename):
+    distributed.worker["model"] = StubModel()
+    distributed.worker["store"] = StubStore(folder)
+    distributed.worker["buffer"] = WeightBuffer(buffer_filename)
+
+class StubCheckpoint(distributed.Checkpoint):
+    def load_model(self, filename):
+        network = StubNetwork()
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+        network.weights = state[:2]
+        network.optimizer.weights = state[2:]
+        return network
+
+@pytest.fixture
+def config(tmp_path):
+    config = prepare_config(str(tmp_path / "config.ini"))
+    config.set("distributed", "workers", "2")
+    config.set("distributed", "sync_steps", "2")
+    config.set("distributed", "checkpoint", str(tmp_path / "distributed"))
+    return config
+
+def make_trainer(config, tmp_path):
+    trainer = DistributedTrainer(logging, config, StubModel(), StubDataset(str(tmp_path)), initializer=init_stub_worker)
+    trainer.checkpoint = StubCheckpoint(logging, config, config.get("distributed", "checkpoint"))
+    return trainer
+
+# The first round of the epoch, trained in the test process instead of the workers
+def train_locally(indices, batch):
+    network = StubNetwork()
+    store = StubStore("")
+    for start in range(0, len(indices), batch):
+        windows, labels = store.get(np.sort(indices[start : start + batch]))
+        network.train_on_batch(windows, labels)
+    return get_state(network)
+
+def test_average(config, tmp_path):
+    trainer = make_trainer(config, tmp_path)
+    batch = 8
+    step = trainer.sync_steps * batch
+    order = np.random.RandomState(trainer.seed).permutation(WINDOWS)
+    with trainer.get_buffer_folder() as folder, trainer.start_pool(2, folder) as pool:
+        trainer.run_epoch(pool, 2, 0, batch, rounds=1)
+        trainer.update_model()
+    results = [train_locally(order[offset : offset + step], batch) for offset in (0, step)]
+    # The weights and the optimizer state are both averaged
+    for layer, averaged in enumerate(get_state(trainer.model.model)):
+        assert np.allclose(averaged, np.mean([state[layer] for state in results], axis=0), rtol=0, atol=1e-5)
+    assert trainer.model.model.optimizer.weights[0][0] == step // batch
+    # The workers got different windows, so the average isn't just one of them
+    assert not np.allclose(results[0][0], results[1][0])
+
+# Different amounts of windows are weighted by their count
+def test_average_weighted(tmp_path):
+    state = [np.zeros(2), np.zeros((1, 1))]
+    buffer = WeightBuffer(str(tmp_path / "weights.npy"), state, 3)
+    buffer.write(1, [np.full(2, 1.0), np.full((1, 1), 2.0)])
+    buffer.write(2, [np.full(2, 4.0), np.full((1, 1), 6.0)])
+    buffer.average([1, 2], [30, 10])
+    averaged = buffer.read(0, [layer.shape for layer in state])
+    assert np.allclose(averaged[0], np.full(2, 1.75))
+    assert np.allclose(averaged[1], np.full((1, 1), 3.0))
+
+def test_resume(config, tmp_path):
+    uninterrupted = make_trainer(config, tmp_path)
+    uninterrupted.train(3, batch=8)
+    expected = get_state(uninterrupted.model.model)
+    uninterrupted.checkpoint.remove()
+    interrupted = make_trainer(config, tmp_path)
+    interrupted.train(1, batch=8)
+    resumed = make_trainer(config, tmp_path)
+    resumed.train(3, batch=8, resume=True)
+    # The optimizer state is saved along with the weights, so it continues where it stopped instead of starting over
+    for layer, state in zip(expected, get_state(resumed.model.model)):
+        assert np.array_equal(layer, state)
+    # The order matters, so continuing with another seed ends up somewhere else
+    config.set("distributed", "seed", "1")
+    interrupted = make_trainer(config, tmp_path)
+    interrupted.train(1, batch=8)
+    config.set("distributed", "seed", "0")
+    resumed = make_trainer(config, tmp_path)
+    resumed.train(3, batch=8, resume=True)
+    assert not np.array_equal(expected[0], get_state(resumed.model.model)[0])
@@ -0,0 +1,46 @@
+import logging
+import numpy as np
+import pytest
+import soundfile
+from config import prepare_config
+from evaluate import Evaluator, SONG_TYPES
+
+@pytest.fixture
+def config(tmp_path):
+    config = prepare_config(str(tmp_path / "config.ini"))
+    config.set("evaluation", "cache_directory", str(tmp_path / "cache"))
+    return config
+
+# Writes the four tracks of a song, filled with the given value so that songs can be told apart
+def write_song(folder, value):
+    folder.mkdir(parents=True)
+    for song_type in SONG_TYPES:
+        soundfile.write(str(folder / (song_type + ".wav")), np.full(1000, value, dtype=np.float32), 22050, subtype="FLOAT")
+
+def test_same_names(config, tmp_path):
+    write_song(tmp_path / "songs" / "a" / "track1", 0.1)
+    write_song(tmp_path / "songs" / "b" / "track1", 0.2)
+    evaluator = Evaluator(logging, config)
+    evaluator.find_songs(str(tmp_path / "songs"))
+    assert evaluator.names == ["track1", "track1"]
+    assert len(set(paths["vocals"] for paths in evaluator.paths)) == 2
+    assert evaluator.get_cache_path(0) != evaluator.get_cache_path(1)
+    values = [original[0, 0, 0] for _, original, _ in evaluator.iter_songs([0, 1])]
+    assert np.allclose(values, [0.1, 0.2])
+
+def test_no_songs(config, tmp_path):
+    (tmp_path / "songs" / "empty").mkdir(parents=True)
+    evaluator = Evaluator(logging, config)
+    with pytest.raises(SystemExit):
+        evaluator.find_songs(str(tmp_path / "songs"))
+
+# Changing any setting that changes the loaded audio invalidates the cached metrics
+@pytest.mark.parametrize("section,option,value", (("song", "resampler", "kaiser_best"), ("song", "sample_size", "16000"), ("evaluation", "window", "1")))
+def test_cache_path(config, tmp_path, section, option, value):
+    write_song(tmp_path / "songs" / "track1", 0.1)
+    evaluator = Evaluator(logging, config)
+    evaluator.find_songs(str(tmp_path / "songs"))
+    path = evaluator.get_cache_path(0)
+    assert evaluator.get_cache_path(0) == path
+    config.set(section, option, value)
+    assert evaluator.get_cache_path(0) != path
@@ -0,0 +1,66 @@
+# Compares the convolutional engine with the sliding one. A freshly built network has zero biases, so columns outside
+# of a window's input stay zero in the convolutional network as well. A frame whose window is the only non-zero part
+# of the song therefore has to get exactly the same prediction from both engines.
+import logging
+import numpy as np
+import pytest
+from config import prepare_config
+from song import Song
+from realtime import StreamingSTFT
+
+keras = pytest.importorskip("keras")
+from model import Model
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory):
+    config = prepare_config(str(tmp_path_factory.mktemp("config") / "config.ini"))
+    config.set("separate", "chunk_size", "64")
+    model = Model(logging, config)
+    model.build()
+    return model
+
+def make_song(model, amplitude):
+    song = Song(logging, "test", model.config)
+    song.set_amplitude(amplitude.astype(model.config.get("song", "dtype")))
+    return song
+
+def test_isolated_windows(model):
+    bins = model.config.getint("song", "window_size") // 2 + 1
+    half = model.config.getint("song", "sample_length") // 2
+    random = np.random.RandomState(0)
+    amplitude = np.zeros((bins, 280), dtype=np.float32)
+    # One frame for each branch of the convolutional model (the frame modulo 4), far enough apart that their windows don't overlap
+    frames = (30, 91, 152, 213)
+    for frame in frames:
+        amplitude[:, frame - half : frame + half + 1] = random.uniform(0, 80, (bins, 2 * half + 1))
+    song = make_song(model, amplitude)
+    sliding = model.predict(song, engine="sliding")
+    convolutional = model.predict(song, engine="convolutional")
+    assert convolutional.shape == sliding.shape
+    for frame in frames:
+        assert np.allclose(convolutional[:, frame], sliding[:, frame], atol=1e-5)
+
+def test_compare_engines(model):
+    bins = model.config.getint("song", "window_size") // 2 + 1
+    song = make_song(model, np.random.RandomState(1).uniform(0, 80, (bins, 150)))
+    difference = model.compare_engines(song)
+    assert 0 <= difference["mean_abs_diff"] <= difference["max_abs_diff"] <= 1
+    assert 0 <= difference["mask_bins_changed"] <= 1
+
+# A vibrato tone over noise. The STFT is computed with the realtime one so that librosa isn't needed.
+def test_compare_engines_sdr(model):
+    sample_rate = model.config.getint("song", "sample_size")
+    random = np.random.RandomState(2)
+    time_axis = np.arange(sample_rate * 2) / sample_rate
+    vocals = (0.3 * np.sin(2 * np.pi * 300 * time_axis * (1 + 0.01 * np.sin(2 * np.pi * 5 * time_axis)))).astype(np.float32)
+    mixture = vocals + 0.1 * random.randn(len(vocals)).astype(np.float32)
+    stft = StreamingSTFT(model.config.getint("song", "window_size"), model.config.getint("song", "hop_length"))
+    spectrogram = np.concatenate((stft.push(mixture), stft.flush()), axis=1)
+    song = make_song(model, np.maximum(10 * np.log10(np.maximum(np.abs(spectrogram) ** 2, 1e-10)), -80))
+    song.set_spectrogram(spectrogram)
+    difference = model.compare_engines(song, vocals=vocals)
+    assert np.isfinite(difference["sdr_sliding"]) and np.isfinite(difference["sdr_convolutional"])
+    assert difference["sdr_delta"] == pytest.approx(difference["sdr_convolutional"] - difference["sdr_sliding"])
+    # When no bin of the mask changes, both engines separate exactly the same vocals
+    if difference["mask_bins_changed"] == 0:
+        assert difference["sdr_delta"] == pytest.approx(0, abs=1e-6)
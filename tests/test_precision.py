@@ -0,0 +1,84 @@
+# Bounds the precision lost by storing amplitudes as float16 and spectrograms as complex64 instead of computing
+# everything in double precision. The STFT and power_to_db are reimplemented the way librosa computes them, so that
+# the reference can be kept in float64 and the test doesn't need librosa.
+import logging
+import configparser
+import numpy as np
+import pytest
+from scipy.signal import get_window
+from mask import label_mask
+from song import Song
+from stream import StreamingISTFT
+
+SAMPLE_RATE = 22050
+WINDOW_SIZE = 1024
+HOP_LENGTH = 256
+LABEL_THRESHOLD = 1
+
+# Two seconds of a vibrato tone that comes and goes over chords and noise
+def generate_song():
+    random = np.random.RandomState(0)
+    time_axis = np.arange(2 * SAMPLE_RATE) / SAMPLE_RATE
+    phase = 2 * np.pi * np.cumsum(250 * (1 + 0.02 * np.sin(2 * np.pi * 5 * time_axis))) / SAMPLE_RATE
+    vocals = sum(np.sin(phase * harmonic) / harmonic for harmonic in range(1, 6)) * (np.sin(2 * np.pi * time_axis) > -0.3)
+    accompaniment = sum(np.sin(2 * np.pi * frequency * time_axis) for frequency in (110, 220, 330, 440)) / 4 + 0.05 * random.randn(len(time_axis))
+    return 0.3 * vocals / np.max(np.abs(vocals)) + 0.3 * accompaniment, 0.3 * vocals / np.max(np.abs(vocals))
+
+# librosa.stft with center=True, computed in float64
+def stft(signal):
+    padded = np.pad(signal, WINDOW_SIZE // 2, mode="reflect")
+    starts = np.arange(0, len(padded) - WINDOW_SIZE + 1, HOP_LENGTH)
+    frames = padded[starts[:, np.newaxis] + np.arange(WINDOW_SIZE)] * get_window("hann", WINDOW_SIZE, fftbins=True)
+    return np.fft.rfft(frames, axis=1).T
+
+# librosa.power_to_db with its defaults (amin=1e-10, top_db=80)
+def power_to_db(spectrogram):
+    amplitude = 10 * np.log10(np.maximum(np.abs(spectrogram) ** 2, 1e-10))
+    return np.maximum(amplitude, np.max(amplitude) - 80)
+
+def istft(spectrogram, length):
+    istft = StreamingISTFT(WINDOW_SIZE, HOP_LENGTH, length)
+    return np.concatenate((istft.push(spectrogram), istft.flush()))
+
+def snr(reference, estimate):
+    return 10 * np.log10(np.sum(reference ** 2) / np.sum((reference - estimate) ** 2))
+
+@pytest.fixture(scope="module")
+def song():
+    mixture, vocals = generate_song()
+    return mixture, stft(mixture), stft(vocals)
+
+# The dB amplitudes lie within [-80, 80], where float16 is spaced 1/16 dB apart at most, so the rounding error is
+# below 1/32 dB. Only bins within that distance of the label threshold can change their label.
+@pytest.mark.parametrize("dtype,tolerance", (("float32", 1e-5), ("float16", 1 / 32)))
+def test_amplitude(song, dtype, tolerance):
+    _, mixture, vocals = song
+    reference = power_to_db(mixture)
+    stored = reference.astype(dtype)
+    assert np.max(np.abs(stored.astype(np.float64) - reference)) <= tolerance
+    labels = label_mask(power_to_db(vocals), LABEL_THRESHOLD)
+    stored_labels = label_mask(power_to_db(vocals).astype(dtype), LABEL_THRESHOLD)
+    assert np.mean(labels != stored_labels) <= 1e-3
+
+# The windows the network sees are the stored amplitudes, padded with zeros of the same type
+def test_windows(song):
+    _, mixture, _ = song
+    config = configparser.ConfigParser()
+    windows = {}
+    for dtype in ("float32", "float16"):
+        data = Song(logging, "test", config)
+        data.set_amplitude(power_to_db(mixture).astype(dtype))
+        windows[dtype] = data.split_slidingwindow(25)
+        assert windows[dtype].dtype == np.dtype(dtype)
+    assert np.max(np.abs(windows["float16"].astype(np.float32) - windows["float32"])) <= 1 / 32
+
+# Masking and inverting a complex64 spectrogram gives the same audio as a complex128 one to within single precision
+def test_reconstruction(song):
+    signal, mixture, vocals = song
+    mask = label_mask(power_to_db(vocals), LABEL_THRESHOLD)
+    reference = istft(mixture * mask, len(signal))
+    reduced = istft(mixture.astype(np.complex64) * mask, len(signal))
+    assert reduced.dtype == np.float32
+    assert snr(reference, reduced) >= 100
+    # For scale, the error of the separation itself is many orders of magnitude larger
+    assert snr(istft(vocals, len(signal)), reference) < 40
@@ -0,0 +1,89 @@
+# Feeds WAV files through the realtime separator block by block with a stub network, and checks the output against
+# what separating the whole file at once gives.
+import logging
+import numpy as np
+import pytest
+import soundfile
+from config import prepare_config
+from song import Song
+from realtime import RealtimeSeparator, StreamingSTFT, simulate
+
+# Records the windows it gets and predicts that every bin is vocals
+class StubSeparator:
+    def __init__(self):
+        self.windows = []
+
+    def predict_windows(self, windows, batch=32):
+        self.windows.append(np.array(windows[..., 0]))
+        return np.ones((len(windows), windows.shape[1]), dtype=np.float32)
+
+@pytest.fixture
+def config(tmp_path):
+    config = prepare_config(str(tmp_path / "config.ini"))
+    config.set("realtime", "stem", "vocals")
+    config.set("realtime", "lookahead", str(config.getint("song", "sample_length") // 2))
+    config.set("separate", "output_subtype", "FLOAT")
+    return config
+
+# Noise with a loud burst at the start, so that the loudest bin (which power_to_db clips to) is in the first frame
+def make_signal(length):
+    data = np.random.RandomState(length).randn(length).astype(np.float32) * 0.05
+    data[:64] = 0.9
+    return data
+
+# The amplitude of the whole signal at once, the same way the realtime separator computes it
+def get_amplitude(config, data):
+    stft = StreamingSTFT(config.getint("song", "window_size"), config.getint("song", "hop_length"))
+    spectrogram = np.concatenate((stft.push(data), stft.flush()), axis=1)
+    amplitude = 10 * np.log10(np.maximum(np.abs(spectrogram) ** 2, 1e-10))
+    return np.maximum(amplitude, np.max(amplitude) - 80).astype(config.get("song", "dtype"))
+
+def separate(config, data, block_size):
+    separator = StubSeparator()
+    realtime = RealtimeSeparator(logging, config, separator)
+    output = [realtime.process(data[start : start + block_size]) for start in range(0, len(data), block_size)]
+    output.append(realtime.flush())
+    return np.concatenate(output), np.concatenate(separator.windows)
+
+# Shorter than the lookahead, a few windows and a few seconds
+@pytest.mark.parametrize("length", (300, 1500, 5001, 20000))
+@pytest.mark.parametrize("block_size", (1, 97, 333, 1021))
+def test_block_by_block(config, length, block_size):
+    if block_size == 1 and length > 1500:
+        pytest.skip("Too slow with a sample at a time")
+    data = make_signal(length)
+    output, windows = separate(config, data, block_size)
+    assert len(output) == length
+    mixture = Song(logging, "mixture", config)
+    mixture.set_amplitude(get_amplitude(config, data))
+    assert np.array_equal(windows, mixture.split_slidingwindow(config.getint("song", "sample_length")))
+    # All of the mixture is vocals, so the output is the input
+    assert np.max(np.abs(output - data)) < 1e-4
+
+@pytest.mark.parametrize("block_size", (97, 1021))
+def test_simulate(config, tmp_path, block_size):
+    data = make_signal(15000)
+    soundfile.write(str(tmp_path / "mixture.wav"), data, config.getint("song", "sample_size"), subtype="FLOAT")
+    config.set("realtime", "block_size", str(block_size))
+    separator = StubSeparator()
+    statistics = simulate(logging, config, separator, str(tmp_path / "mixture.wav"), str(tmp_path / "vocals.wav"))
+    output, _ = soundfile.read(str(tmp_path / "vocals.wav"), dtype="float32")
+    assert len(output) == len(data)
+    assert np.max(np.abs(output - data)) < 1e-4
+    assert statistics["blocks"] == -(-len(data) // block_size)
+    mixture = Song(logging, "mixture", config)
+    mixture.set_amplitude(get_amplitude(config, data))
+    assert np.array_equal(np.concatenate(separator.windows), mixture.split_slidingwindow(config.getint("song", "sample_length")))
+
+# Less lookahead than half a window means that the frames after it are zeros instead
+def test_short_lookahead(config):
+    config.set("realtime", "lookahead", "3")
+    data = make_signal(1500)
+    output, windows = separate(config, data, 333)
+    assert len(output) == len(data)
+    expected = Song(logging, "mixture", config)
+    expected.set_amplitude(get_amplitude(config, data))
+    expected = np.array(expected.split_slidingwindow(config.getint("song", "sample_length")))
+    half = config.getint("song", "sample_length") // 2
+    expected[:, :, half + 4:] = 0
+    assert np.array_equal(windows, expected)
@@ -0,0 +1,174 @@
+import json
+import time
+import logging
+import threading
+import urllib.request
+import urllib.error
+from http.server import HTTPServer
+import numpy as np
+import pytest
+from config import prepare_config
+from server import RequestHandler, PredictionBatcher, SeparationService, ThreadingHTTPServer
+
+BINS = 5
+LENGTH = 3
+
+# Fails the test if a request gets past the validation
+class StubService:
+    logger = logging
+
+    def separate(self, data, stem, extension):
+        raise AssertionError("the request should have been rejected")
+
+class StubHandler(RequestHandler):
+    service = StubService()
+
+# Predicts the mean of each window for every bin and remembers how many windows each predict call got
+class StubSeparator:
+    def __init__(self):
+        self.calls = []
+
+    def predict_windows(self, windows, batch=32):
+        self.calls.append(len(windows))
+        if np.any(windows < 0):
+            raise ValueError("negative window")
+        return np.repeat(windows.mean(axis=(1, 2, 3))[:, np.newaxis], BINS, axis=1)
+
+# Decoding and writing audio needs librosa, so requests skip it: every byte of the body becomes a window that is
+# filled with the byte's value, and the predictions are returned as the output. Requests block until release is set.
+class StubSeparationService(SeparationService):
+    def __init__(self, config):
+        super(StubSeparationService, self).__init__(logging, config, StubSeparator())
+        self.release = threading.Event()
+
+    def process(self, data, stem, extension):
+        self.release.wait()
+        if data == b'fail':
+            raise ValueError("could not decode")
+        windows = np.repeat(np.frombuffer(data, dtype=np.uint8).astype(np.float32), BINS * LENGTH).reshape(-1, BINS, LENGTH)
+        return self.batcher.predict(windows).astype(np.float32).tobytes()
+
+def start_server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%i" % server.server_address[1]
+
+@pytest.fixture
+def address():
+    server = HTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%i" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def service(tmp_path):
+    config = prepare_config(str(tmp_path / "config.ini"))
+    config.set("server", "max_requests", "1")
+    config.set("server", "queue_size", "1")
+    config.set("server", "max_wait", "1")
+    service = StubSeparationService(config)
+    batcher = threading.Thread(target=service.batcher.run, daemon=True)
+    batcher.start()
+    handler = type("ServiceHandler", (RequestHandler,), {"service": service})
+    server, url = start_server(handler)
+    service.url = url
+    yield service
+    service.release.set()
+    server.shutdown()
+    server.server_close()
+    service.batcher.stop()
+    batcher.join()
+
+def post(url, data=b'audio'):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, method="POST")) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())["error"]
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+# Invalid parameters are rejected before the request reaches the separator
+@pytest.mark.parametrize("query,message", (("stem=drums", "stem"), ("format=../wav", "format"), ("stem=vocals&format=a.b", "format")))
+def test_invalid_parameters(address, query, message):
+    code, error = post(address + "/separate?" + query)
+    assert code == 400
+    assert error.startswith(message)
+
+# The windows of requests that wait at the same time go through the network in a single call, and each request gets
+# the predictions of its own windows back
+def test_batcher_merges_requests():
+    separator = StubSeparator()
+    batcher = PredictionBatcher(logging, separator, max_batch=256, max_wait=1)
+    results = {}
+    def request(value, count):
+        results[value] = batcher.predict(np.full((count, BINS, LENGTH), value, dtype=np.float32))
+    threads = [threading.Thread(target=request, args=(value, value)) for value in (1, 2, 3)]
+    for thread in threads:
+        thread.start()
+    # The batcher only starts once all of the requests are waiting
+    wait_for(lambda: batcher.jobs.qsize() == 3)
+    runner = threading.Thread(target=batcher.run)
+    runner.start()
+    for thread in threads:
+        thread.join()
+    batcher.stop()
+    runner.join()
+    assert separator.calls == [6]
+    assert batcher.batches == 1 and batcher.windows == 6
+    for value in (1, 2, 3):
+        assert np.array_equal(results[value], np.full((value, BINS), value, dtype=np.float32))
+
+# A batch is closed as soon as it has max_batch windows, and an error reaches every request of its batch
+def test_batcher_limits_and_errors():
+    separator = StubSeparator()
+    batcher = PredictionBatcher(logging, separator, max_batch=4, max_wait=1)
+    errors = []
+    def request(value):
+        try:
+            batcher.predict(np.full((3, BINS, LENGTH), value, dtype=np.float32))
+        except ValueError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=request, args=(value,)) for value in (-1, -1, 1)]
+    for thread in threads:
+        thread.start()
+        wait_for(lambda: batcher.jobs.qsize() == threads.index(thread) + 1)
+    runner = threading.Thread(target=batcher.run)
+    runner.start()
+    for thread in threads:
+        thread.join()
+    batcher.stop()
+    runner.join()
+    assert separator.calls == [6, 3]
+    assert len(errors) == 2
+
+# With one slot and room for one waiting request, a third request is rejected with 503 while the other two are
+# processed, and the counters in /metrics add up
+def test_capacity_and_metrics(service):
+    codes = []
+    threads = [threading.Thread(target=lambda data=data: codes.append(post(service.url + "/separate", data))) for data in (b'\x01\x02', b'fail')]
+    threads[0].start()
+    wait_for(lambda: service.get_metrics()["active"] == 1)
+    threads[1].start()
+    wait_for(lambda: service.get_metrics()["queued"] == 1)
+    assert post(service.url + "/separate") == (503, "Too many requests")
+    service.release.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(code for code, _ in codes) == [200, 500]
+    output = [body for code, body in codes if code == 200][0]
+    assert np.array_equal(np.frombuffer(output, dtype=np.float32).reshape(2, BINS), np.array([[1] * BINS, [2] * BINS], dtype=np.float32))
+    with urllib.request.urlopen(service.url + "/metrics") as response:
+        metrics = json.loads(response.read())
+    assert metrics["requests"] == 1
+    assert metrics["failures"] == 1
+    assert metrics["rejected"] == 1
+    assert metrics["active"] == 0 and metrics["queued"] == 0
+    assert metrics["batches"] == 1 and metrics["windows_per_batch"] == 2
+    assert metrics["latency_max"] > 0
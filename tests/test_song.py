@@ -0,0 +1,89 @@
+# The windows and labels have to stay bit-identical to what the original loops produced, since the network was
+# trained on them. The loops are kept here as references.
+import math
+import logging
+import configparser
+import numpy as np
+import pytest
+from song import Song
+
+HEIGHT = 7
+LENGTH = 25
+
+def reference_split_spectrogram(amplitude, length):
+    slices = []
+    for x in range (0, amplitude.shape[1] // length):
+        _slice = amplitude[:,x * length : (x + 1) * length]
+        slices.append(_slice)
+    return slices
+
+def reference_split_slidingwindow(amplitude, length):
+    height = amplitude.shape[0]
+    amplitude = np.column_stack((np.zeros((height, math.floor(length/2))), amplitude))
+    amplitude = np.column_stack((amplitude, np.zeros((height, math.floor(length/2)))))
+    slices = []
+    for x in range(math.floor(length/2), amplitude.shape[1] - math.floor(length/2)):
+        length_before = x - math.floor(length/2)
+        length_after = x + math.floor(length/2)
+        slices.append(np.array(amplitude[:, length_before : (length_after + 1)]))
+    return slices
+
+def reference_get_labels(amplitude, length):
+    slices = []
+    for x in range(0, amplitude.shape[1] // length):
+        _slice = []
+        for y in range(0, amplitude.shape[0]):
+            if amplitude[y,x*length+(math.ceil(length/2) if length > 1 else 0)] > 1:
+                _slice.append(1)
+            else:
+                _slice.append(0)
+        slices.append(_slice)
+    return slices
+
+# The loops return lists, which are empty when the song is shorter than a window
+def stack(slices, shape):
+    return np.array(slices).reshape((len(slices),) + shape)
+
+def make_song(frames, order, dtype):
+    config = configparser.ConfigParser()
+    config.read_dict({"song": {"label_threshold": "1"}})
+    amplitude = (np.random.RandomState(frames).randn(HEIGHT, frames) * 4).astype(dtype)
+    song = Song(logging, "test", config)
+    song.set_amplitude(np.asfortranarray(amplitude) if order == "F" else np.ascontiguousarray(amplitude))
+    return song
+
+# Shorter than a window, exact multiples of it and ones with a remainder
+FRAMES = (1, 12, 24, 25, 50, 75, 26, 61, 113)
+LAYOUTS = [(order, dtype) for order in ("C", "F") for dtype in (np.float32, np.float16)]
+
+@pytest.mark.parametrize("frames", FRAMES)
+@pytest.mark.parametrize("order,dtype", LAYOUTS)
+def test_split_spectrogram(frames, order, dtype):
+    song = make_song(frames, order, dtype)
+    expected = stack(reference_split_spectrogram(song.get_amplitude(), LENGTH), (HEIGHT, LENGTH))
+    assert np.array_equal(song.split_spectrogram(LENGTH), expected)
+
+@pytest.mark.parametrize("frames", FRAMES)
+@pytest.mark.parametrize("order,dtype", LAYOUTS)
+@pytest.mark.parametrize("length", (LENGTH, 24, 1))
+def test_split_slidingwindow(frames, order, dtype, length):
+    song = make_song(frames, order, dtype)
+    windows = song.split_slidingwindow(length)
+    expected = stack(reference_split_slidingwindow(song.get_amplitude(), length), (HEIGHT, 2 * (length // 2) + 1))
+    assert windows.dtype == dtype
+    assert np.array_equal(windows, expected)
+
+@pytest.mark.parametrize("frames", FRAMES)
+@pytest.mark.parametrize("order,dtype", LAYOUTS)
+def test_iter_slidingwindow(frames, order, dtype):
+    song = make_song(frames, order, dtype)
+    windows = np.concatenate([chunk for _, chunk in song.iter_slidingwindow(LENGTH, 10)])
+    assert np.array_equal(windows, song.split_slidingwindow(LENGTH))
+
+@pytest.mark.parametrize("frames", FRAMES)
+@pytest.mark.parametrize("order,dtype", LAYOUTS)
+@pytest.mark.parametrize("length", (LENGTH, 24, 1))
+def test_get_labels(frames, order, dtype, length):
+    song = make_song(frames, order, dtype)
+    expected = stack(reference_get_labels(song.get_amplitude(), length), (HEIGHT,))
+    assert np.array_equal(song.get_labels(length), expected)
@@ -0,0 +1,41 @@
+# Which interpreter TFLiteSeparator runs the exported model with, depending on what's installed
+import sys
+import types
+import pytest
+from separator import Separator
+from tflite import get_interpreter_class
+
+def make_tensorflow(lite=True, contrib=True):
+    tensorflow = types.ModuleType("tensorflow")
+    if lite:
+        tensorflow.lite = types.SimpleNamespace(Interpreter="tf.lite.Interpreter")
+    if contrib:
+        tensorflow.contrib = types.SimpleNamespace(lite=types.SimpleNamespace(Interpreter="tf.contrib.lite.Interpreter"))
+    return tensorflow
+
+# Setting a module to None in sys.modules makes importing it fail the way it does when it isn't installed
+@pytest.mark.parametrize("lite,expected", ((True, "tf.lite.Interpreter"), (False, "tf.contrib.lite.Interpreter")))
+def test_tensorflow_fallback(monkeypatch, lite, expected):
+    monkeypatch.setitem(sys.modules, "tflite_runtime", None)
+    monkeypatch.setitem(sys.modules, "tflite_runtime.interpreter", None)
+    monkeypatch.setitem(sys.modules, "tensorflow", make_tensorflow(lite=lite))
+    assert get_interpreter_class() == expected
+
+def test_installed_tensorflow(monkeypatch):
+    tf = pytest.importorskip("tensorflow")
+    monkeypatch.setitem(sys.modules, "tflite_runtime", None)
+    monkeypatch.setitem(sys.modules, "tflite_runtime.interpreter", None)
+    interpreter = get_interpreter_class()
+    assert interpreter is getattr(getattr(tf, "lite", None), "Interpreter", None) or interpreter is tf.contrib.lite.Interpreter
+
+def test_installed_tflite_runtime():
+    interpreter = pytest.importorskip("tflite_runtime.interpreter")
+    assert get_interpreter_class() is interpreter.Interpreter
+
+# Subclasses have to implement both methods before they can be created
+def test_abstract_separator():
+    class Incomplete(Separator):
+        def is_ready(self):
+            return True
+    with pytest.raises(TypeError):
+        Incomplete(None, None)
@@ -0,0 +1,97 @@
+# Export of the trained network to TensorFlow Lite and a separator that runs the exported file.
+# Running the exported network only needs tflite_runtime (or tensorflow if it isn't installed), not keras.
+import os
+import sys
+import json
+import tempfile
+import numpy as np
+from separator import Separator
+
+QUANTIZATION_TYPES = ("none", "weights", "float16")
+
+# Convert the keras model to a .tflite file. "weights" stores the weights as int8 and "float16" as float16,
+# both of which the interpreter converts back to float32 when it loads the file.
+def export_tflite(logger, config, model, filename):
+    import tensorflow as tf
+    quantization = config.get("export", "quantization")
+    if quantization not in QUANTIZATION_TYPES:
+        logger.critical("Unknown quantization type %s.", quantization)
+        sys.exit(20)
+    with tempfile.TemporaryDirectory() as folder:
+        model_path = os.path.join(folder, "model.h5")
+        model.model.save(model_path, include_optimizer=False)
+        converter = tf.lite.TFLiteConverter.from_keras_model_file(model_path)
+        # Older versions of tensorflow only support quantizing the weights to int8
+        optimize = getattr(tf.lite, "Optimize", None)
+        if quantization == "weights":
+            if optimize is not None:
+                converter.optimizations = [optimize.DEFAULT]
+            else:
+                converter.post_training_quantize = True
+        elif quantization == "float16":
+            if optimize is None:
+                logger.critical("This version of tensorflow can't quantize to float16, use weights instead.")
+                sys.exit(20)
+            converter.optimizations = [optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        logger.info("Converting the model with %s quantization...", quantization)
+        data = converter.convert()
+    with open(filename + ".partial", 'wb') as f:
+        f.write(data)
+    os.replace(filename + ".partial", filename)
+    logger.info("Exported the model to %s (%.1f MB).", filename, len(data) / (1024 * 1024))
+
+# tflite_runtime if it's installed, tensorflow otherwise. tf.lite is only an attribute of the tensorflow module (it
+# can't be imported as tensorflow.lite in 1.x), and versions before 1.13 only have the interpreter in contrib.
+def get_interpreter_class():
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    import tensorflow as tf
+    lite = getattr(tf, "lite", None)
+    if lite is not None and hasattr(lite, "Interpreter"):
+        return lite.Interpreter
+    return tf.contrib.lite.Interpreter
+
+def load_interpreter(filename):
+    return get_interpreter_class()(model_path=filename)
+
+# TFLiteSeparator: Separates songs with an exported .tflite file
+class TFLiteSeparator(Separator):
+    def __init__(self, logger, config, filename):
+        super(TFLiteSeparator, self).__init__(logger, config)
+        self.interpreter = None
+        if os.path.isfile(filename):
+            self.interpreter = load_interpreter(filename)
+            self.input = self.interpreter.get_input_details()[0]
+            self.output = self.interpreter.get_output_details()[0]
+            self.batch = None
+        else:
+            logger.critical("Couldn't find the exported model %s.", filename)
+            sys.exit(11)
+
+    def is_ready(self):
+        return self.interpreter is not None
+
+    # The input size is fixed when the tensors are allocated, so they're only reallocated when the batch size changes
+    def resize(self, batch):
+        if self.batch != batch:
+            self.interpreter.resize_tensor_input(self.input["index"], [batch] + list(self.input["shape"][1:]))
+            self.interpreter.allocate_tensors()
+            self.batch = batch
+
+    def predict_windows(self, windows, batch=32):
+        prediction = np.empty((len(windows), self.output["shape"][-1]), dtype=np.float32)
+        for start in range(0, len(windows), batch):
+            part = windows[start : start + batch]
+            self.resize(len(part))
+            self.interpreter.set_tensor(self.input["index"], np.ascontiguousarray(part, dtype=np.float32))
+            self.interpreter.invoke()
+            prediction[start : start + len(part)] = self.interpreter.get_tensor(self.output["index"])
+        return prediction
+
+def save_report(report, filename):
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=1)